@@ -20,6 +20,7 @@ import seaborn as sns
 from datetime import datetime
 from glob import glob
 import numpy as np
+import pupil_redcap
 
 
 def glob_files(datadir, suffix):
@@ -27,39 +28,57 @@ def glob_files(datadir, suffix):
     return glob(globstr)
     
     
+def timestamp_seconds(timestamps):
+    """Timestamp column as integer seconds. Outputs written before seconds
+    were stored as integers hold '%H:%M:%S' strings."""
+    if pd.api.types.is_numeric_dtype(timestamps):
+        return np.asarray(timestamps, dtype=np.int64)
+    return np.asarray(pd.to_timedelta(timestamps) // pd.Timedelta(seconds=1), dtype=np.int64)
+
+
+def summarize_loads(sessdf):
+    """Values at the last second of each subject, session and load, with max
+    dilation and the second when it occurred. Loads without data at their
+    last second (Load + 1) are dropped. Rows are sorted once and each load 
+    is reduced with reduceat over the sorted arrays."""
+    sessdf = sessdf.reset_index(drop=True)
+    seconds = timestamp_seconds(sessdf.Timestamp)
+    keys = [pd.factorize(sessdf[col], sort=True)[0] for col in ['Subject', 'Session', 'Load']]
+    order = np.lexsort([seconds] + keys[::-1])
+    codes = np.column_stack(keys)[order]
+    starts = np.flatnonzero(np.r_[True, (codes[1:] != codes[:-1]).any(axis=1)])
+    stops = np.r_[starts[1:], len(order)]
+    # Max dilation and second when it occurred (first one if tied)
+    dilation = sessdf.Dilation.values[order].astype(np.float64)
+    maxdilation = np.fmax.reduceat(dilation, starts)
+    is_max = dilation == np.repeat(maxdilation, stops - starts)
+    maxpos = np.minimum.reduceat(np.where(is_max, np.arange(len(order)), len(order)), starts)
+    has_max = maxpos < len(order)
+    # Values at last second of each load
+    loaddf = sessdf.iloc[order[stops - 1]].reset_index(drop=True)
+    loaddf['Timestamp'] = seconds[order[stops - 1]]
+    maxtime = seconds[order[np.minimum(maxpos, len(order) - 1)]]
+    loaddf['MaxTime'] = maxtime if has_max.all() else np.where(has_max, maxtime, np.nan)
+    loaddf['MaxDilation'] = maxdilation
+    # Filter for loads that have data at the last second
+    idx = loaddf.Timestamp.values == loaddf.Load.values + 1
+    return loaddf.loc[idx,:].reset_index(drop=True)
+
+
 def get_sess_data(datadir):
     sess_filelist = glob_files(datadir, suffix='_ProcessedPupil.csv')
     sess_list = []
     for sub_file in sess_filelist:
         subdf = pd.read_csv(sub_file)
+        subdf['Timestamp'] = timestamp_seconds(subdf.Timestamp)
         sess_list.append(subdf)
     sessdf = pd.concat(sess_list).reset_index(drop=True)
-    sessdf = sessdf.sort_values(by=['Subject', 'Load', 'Timestamp'])
-    # Max dilation and second when it occurred
-    maxdf = sessdf.reindex(sessdf.groupby(['Subject', 'Load'])['Dilation'].idxmax())
-    maxdf = maxdf[['Subject', 'Session', 'Load', 'Timestamp', 'Dilation']]
-    maxdf = maxdf.rename(columns={'Timestamp':'MaxTime', 'Dilation':'MaxDilation'})
-    sessdf = sessdf.groupby(['Subject','Load']).last().reset_index()
-    # Merge in max dilation and max time
-    sessdf = sessdf.merge(maxdf, on=['Subject','Session','Load'])
-    # Filter for loads that have data at the last second
-    idx = sessdf.Timestamp.str.slice(-2).values.astype(np.int64) == sessdf.Load.values+1
-    return sessdf.loc[idx,:] 
-
-
-
+    return summarize_loads(sessdf)
 
 
 def unstack_conditions(dflong):
-    colnames = ['Session', 'Baseline', 'Diameter', 'Dilation', 'BlinkPct', 
-                'ntrials', 'MaxTime', 'MaxDilation'] 
-    df = dflong.pivot(index="Subject", columns='Load', 
-                      values=colnames)
-    df.columns = ['_'.join([str(col[0]),'digitspan',str(col[1])]).strip() for col in df.columns.values]
-    neworder = [j+'_digitspan_'+str(i) for i in np.arange(3,10) for j in colnames ]
-    df = df.reindex(neworder, axis=1)
-    df = df.reset_index()
-    return df
+    """Wide REDCap columns of each load, as declared in pupil_redcap.SPECS"""
+    return pupil_redcap.pivot_wide(dflong, pupil_redcap.get_spec('digitspan'))
 
  
     
@@ -78,7 +97,6 @@ def proc_group(datadir):
     p.despine()
     p.savefig(plot_outfile, dpi=300)
     sessdf_wide = unstack_conditions(sessdf_long)
-    sessdf_wide.columns = sessdf_wide.columns.str.lower()
     sessdf_wide_outfile = os.path.join(datadir, 'digitspan_group_REDCap_' + tstamp + '.csv')
     sessdf_wide.to_csv(sessdf_wide_outfile, index=False)
     
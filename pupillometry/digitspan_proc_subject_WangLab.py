@@ -25,14 +25,14 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 import pupil_utils
-try:
-    # for Python2
-    import Tkinter as tkinter
-    import tkFileDialog as filedialog
-except ImportError:
-    # for Python3
-    import tkinter
-    from tkinter import filedialog
+import pupil_dataset
+import pupil_segments
+
+# Each Ready run is one trial. Its first second is the Ready phase and the
+# rest the Record phase (see get_trial_events).
+SEGMENT_RULES = [('Ready', '^Ready$', None)]
+READY_SEC = 1.
+
 
 def plot_trials(pupildf, fname):
     palette = sns.cubehelix_palette(len(pupildf.Load.unique()))
@@ -41,16 +41,18 @@ def plot_trials(pupildf, fname):
     plt.ylim(-.2, .5)
     plt.tight_layout()
     plot_outname = pupil_utils.get_proc_outfile(fname, "_PupilPlot.png")
-    p.figure.savefig(plot_outname)
+    pupil_utils.savefig_atomic(p.figure, plot_outname)
     plt.close()
     
     
-def clean_trials(trialevents):
+def clean_trials(df, trialevents):
     resampled_dict = {}
-    for trial in trialevents.Trial.unique():
-        starttime, stoptime =  trialevents.loc[trialevents.Trial==trial,'TETTime'].iloc[[0,-1]]
-        rawtrial = trialevents.loc[(trialevents.TETTime>=starttime) & (trialevents.TETTime<=stoptime)]
-        cleantrial = pupil_utils.deblink(rawtrial)
+    for trial, phases in trialevents.groupby('Trial', sort=False):
+        start, stop = phases.Start.min(), phases.Stop.max()
+        cleantrial = pupil_utils.deblink(df.iloc[start:stop])
+        cleantrial['Load'] = phases.Load.iat[0]
+        cleantrial['Trial'] = trial
+        cleantrial['Condition'] = np.repeat(phases.Phase.values, (phases.Stop - phases.Start).values)
         string_cols = ['Load', 'Trial', 'Condition']
         trial_resamp = pupil_utils.resamp_filt_data(cleantrial, filt_type='low', string_cols=string_cols)
         baseline = trial_resamp.loc[trial_resamp.Condition=='Ready', 'DiameterPupilLRFilt'].last('250ms').mean()
@@ -62,44 +64,47 @@ def clean_trials(trialevents):
     dfresamp = pd.concat(resampled_dict, names=['Trial','Timestamp'])
     return dfresamp
     
-def define_condition(trialdf):
-    trialdf['Condition'] = np.where((trialdf.TETTime - trialdf.TETTime.iloc[0]) / 1000. > 1., 'Record', 'Ready')
-    return trialdf
-
-
 def get_trial_events(df):
     """
-    Create dataframe of trial events. This includes:
+    Find trial events. Returns one row per trial phase with:
         Load: [3, 4, 5, 6, 7, 8, 9] Number of digits to recall
         Trial: Lists load and trial number within each load
-        Condition: ['Ready', 'Record'] Phase of trial
-    First finds timestamps where each load trial begins and ends. Appends info
-    about the load and trial number. Also defines phase of each trial. 
+        Phase: ['Ready', 'Record'] Phase of trial
+        Start, Stop: Row positions of first and one past last sample of phase
+    Trials are runs of the Ready object (split where TrialId changes). Each
+    trial belongs to the load of the first Recall object whose last sample 
+    follows it. The first second of a trial is the Ready phase.
     """
-    loads = [x for x in df.CurrentObject.unique() if "Recall" in str(x)]
-    # Find last index of each load
-    lastidx = [df[df.CurrentObject==x].index[-1] for x in loads]
-    stopidx = [x + 1 for x in lastidx]
-    startidx = stopidx[:-1]
-    startidx.insert(0,0)
-    triallist = []
-    for i, cond in enumerate(loads):
-        loaddf = df[startidx[i]:stopidx[i]]
-        loaddf = loaddf[loaddf['CurrentObject']=='Ready']
-        loaddf['Load'] = cond.replace('RecallDS','')
-        loaddf['Trial'] = cond + '_' + loaddf['TrialId'].astype(str)
-        loaddf = loaddf.groupby('Trial').apply(define_condition)
-        triallist.append(loaddf)
-    trialevents = pd.concat(triallist)    
+    trials = pupil_segments.segment(df.CurrentObject, SEGMENT_RULES, by=df.TrialId.values)
+    loads, load_stops = pupil_segments.last_stops(df.CurrentObject, 'Recall')
+    order = np.argsort(load_stops, kind='mergesort')
+    loads, load_stops = loads[order], load_stops[order]
+    load_idx = np.searchsorted(load_stops, trials.Start.values, side='right')
+    trials = trials[load_idx < len(loads)]
+    load_names = loads[load_idx[load_idx < len(loads)]].astype(str)
+    trialids = df.TrialId.values[trials.Start.values].astype(str)
+    starts, stops = trials.Start.values, trials.Stop.values
+    split = pupil_segments.split_at_time(df.TETTime.values, starts, stops, READY_SEC)
+    trial_labels = np.char.add(np.char.add(load_names, '_'), trialids)
+    loadnums = np.char.replace(load_names, 'RecallDS', '')
+    trialevents = pd.DataFrame({'Load': np.repeat(loadnums, 2),
+                                'Trial': np.repeat(trial_labels, 2),
+                                'Phase': np.tile(['Ready','Record'], len(starts)),
+                                'Start': np.column_stack((starts, split)).ravel(),
+                                'Stop': np.column_stack((split, stops)).ravel()})
+    # Drop empty Record phases of trials no longer than READY_SEC
+    trialevents = trialevents[trialevents.Stop > trialevents.Start].reset_index(drop=True)
     return trialevents
 
    
-def proc_subject(filelist):
+def proc_subject(filelist, dataset=None):
     """Given an infile of raw pupil data, saves out:
         1. Session level data with dilation data summarized for each trial
         2. Dataframe of average peristumulus timecourse for each condition
         3. Plot of average peristumulus timecourse for each condition
-        4. Percent of samples with blinks """
+        4. Percent of samples with blinks 
+    If dataset is given, cleaned samples are also written to the per-sample
+    dataset at that directory (see pupil_dataset.py)."""
     for fname in filelist: 
         print('Processing {}'.format(fname))
         if (os.path.splitext(fname)[-1] == ".gazedata") | (os.path.splitext(fname)[-1] == ".csv"):
@@ -111,7 +116,9 @@ def proc_subject(filelist):
         subid = pupil_utils.get_subid(df['Subject'], fname)
         timepoint = pupil_utils.get_timepoint(df['Session'], fname)
         trialevents = get_trial_events(df)
-        dfresamp = clean_trials(trialevents)
+        dfresamp = clean_trials(df, trialevents)
+        if dataset:
+            pupil_dataset.write_samples(dfresamp, dataset, 'digitspan', subid, timepoint)
         dfresamp = dfresamp.reset_index(level='Timestamp').set_index(['Load','Trial'])
         # # Save out dfresamp for cleaned pupil at 30Hz for individuals trials 
         # pupil_outname = pupil_utils.get_proc_outfile(fname, '_ProcessedPupil30Hz.csv')
@@ -129,8 +136,9 @@ def proc_subject(filelist):
         intermed_outname = intermed_outname.replace('Processed Pupil Data', 'Wang Lab')
         if not os.path.exists(os.path.dirname(intermed_outname)):
             os.makedirs(os.path.dirname(intermed_outname))
-        dfresamp1s['Timestamp'] = dfresamp1s.Timestamp.dt.strftime('%H:%M:%S')
-        dfresamp1s.to_csv(intermed_outname, index=False)
+        # Seconds since start of recording phase (end of each 1s bin)
+        dfresamp1s['Timestamp'] = (dfresamp1s.Timestamp - pd.Timestamp(0)) // pd.Timedelta(seconds=1)
+        pupil_utils.to_csv_atomic(dfresamp1s, intermed_outname, index=False)
 
 
 
@@ -143,12 +151,8 @@ if __name__ == '__main__':
               csv files for use in further group analysis. Takes eye tracker 
               data text file (*.gazedata) as input. Removes artifacts, filters, 
               and calculates dilation per 1sec.""")
-        root = tkinter.Tk()
-        root.withdraw()
         # Select files to process
-        filelist = filedialog.askopenfilenames(parent=root,
-                                              title='Choose Digit Span pupil gazedata file to process')
-        filelist = list(filelist)
+        filelist = pupil_utils.ask_filenames('Choose Digit Span pupil gazedata file to process')
         
         # Run script
         proc_subject(filelist)
@@ -27,15 +27,13 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 import pupil_utils
-try:
-    # for Python2
-    import Tkinter as tkinter
-    import tkFileDialog as filedialog
-except ImportError:
-    # for Python3
-    import tkinter
-    from tkinter import filedialog
+import pupil_dataset
+import pupil_segments
 
+# Baseline runs from the start of ReadLetter to the end of the following
+# BeginFile, Response is the RecordLetter run.
+SEGMENT_RULES = [('Baseline', '^ReadLetter$', '^BeginFile$'),
+                 ('Response', '^RecordLetter$', None)]
 
 def plot_trials(pupildf, fname):
     sns.set_style("ticks")
@@ -46,20 +44,23 @@ def plot_trials(pupildf, fname):
     plt.tight_layout()
     plt.legend(loc='best')
     plot_outname = pupil_utils.get_proc_outfile(fname, "_PupilPlot.png")
-    p.figure.savefig(plot_outname)
+    pupil_utils.savefig_atomic(p.figure, plot_outname)
     plt.close()
     
     
 def clean_trials(df, trialevents):
     resampled_dict = {}
-    for trialnum in trialevents.Trial.unique():
-        basestart, basestop, respstart, respstop =  trialevents.loc[trialevents.Trial==trialnum,'TETTime']
-        condition = trialevents.loc[trialevents.Trial==trialnum,'Condition'].iat[0]
-        rawtrial = df.loc[(df.TETTime>=basestart) & (df.TETTime<=respstop)]
-        rawtrial.loc[(rawtrial.TETTime>=basestart) & (rawtrial.TETTime<=basestop),'Phase'] = 'Baseline' 
-        rawtrial.loc[(rawtrial.TETTime>=respstart) & (rawtrial.TETTime<=respstop),'Phase'] = 'Response' 
-#        rawtrial = rawtrial[rawtrial.Condition=='Response']
-        cleantrial = pupil_utils.deblink(rawtrial)
+    for trialnum, phases in trialevents.groupby('Trial'):
+        base = phases[phases.Phase=='Baseline'].iloc[0]
+        resp = phases[phases.Phase=='Response'].iloc[0]
+        condition = base.Condition
+        start, stop = base.Start, resp.Stop
+        # Samples between the two phases have no phase
+        phase = np.full(stop - start, np.nan, dtype=object)
+        phase[base.Start-start:base.Stop-start] = 'Baseline'
+        phase[resp.Start-start:] = 'Response'
+        cleantrial = pupil_utils.deblink(df.iloc[start:stop])
+        cleantrial['Phase'] = phase
         trial_resamp = pupil_utils.resamp_filt_data(cleantrial, filt_type='low', string_cols=['CurrentObject', 'Phase'])
         baseline = trial_resamp['DiameterPupilLRFilt'].first('1000ms').mean()
 #        baseline = trial_resamp.DiameterPupilLRFilt.iat[0]
@@ -74,44 +75,32 @@ def clean_trials(df, trialevents):
 
 def get_trial_events(df):
     """
-    Create dataframe of trial events. This includes:
+    Find trial events. Returns one row per trial phase with:
         Condition: ['Letter', 'Category']
         Trial: [1, 2, 3, 4, 5, 6]
-        TrialPhase = ['Baseline', 'Response']
-        StartStop = ['Start', 'Stop']
-    First finds timestamps where CurrentObject changes to determine starts and stops.
-    Combines these and defines trial, phase and whether it is start or stop time. 
-    Checks for either 4 or 6 trials, otherwise raises an error. Assumes first 
-    half of trials are Lett fluency and second half are Category fluency.
+        Phase = ['Baseline', 'Response']
+        Start, Stop: Row positions of first and one past last sample of phase
+    Phases are found from runs of CurrentObject (see SEGMENT_RULES). Checks 
+    for either 4 or 6 trials, otherwise raises an error. Assumes first half 
+    of trials are Lett fluency and second half are Category fluency.
     """
-    startidx = df['CurrentObject'].ne(df['CurrentObject'].shift().ffill()).astype(bool)
-    stopidx = df['CurrentObject'].ne(df['CurrentObject'].shift(-1).bfill()).astype(bool)
-    trialevents_start = pd.DataFrame(df.loc[startidx, ['TETTime','CurrentObject']])
-    trialevents_stop = pd.DataFrame(df.loc[stopidx, ['TETTime','CurrentObject']])
-    trialevents_start = trialevents_start.loc[(trialevents_start.CurrentObject=="ReadLetter") | 
-                                              (trialevents_start.CurrentObject == "RecordLetter")]
-    trialevents_stop = trialevents_stop.loc[(trialevents_stop.CurrentObject=="BeginFile") | 
-                                            (trialevents_stop.CurrentObject == "RecordLetter")]
-    ntrials = np.sum(trialevents_start['CurrentObject']=='ReadLetter')
-    if (ntrials==4) | (ntrials==6):
-        trialevents_start['TrialPhase'] = np.tile(['Baseline','Response'], ntrials)
-        trialevents_start['StatStop'] = 'Start'
-        trialevents_stop['TrialPhase'] = np.tile(['Baseline','Response'], ntrials)
-        trialevents_stop['StartStop'] = 'Stop'
-        trialevents = trialevents_start.append(trialevents_stop).sort_index()
-        trialevents['Trial'] = np.repeat(range(1,ntrials+1), 4)
-        trialevents['Condition'] = np.repeat(['Letter', 'Category'], ntrials*2)
+    trialevents = pupil_segments.segment(df.CurrentObject, SEGMENT_RULES)
+    ntrials = np.sum(trialevents.Phase=='Baseline')
+    if ((ntrials==4) | (ntrials==6)) and np.sum(trialevents.Phase=='Response') == ntrials:
+        trialevents['Condition'] = np.where(trialevents.Trial <= ntrials // 2, 'Letter', 'Category')
     else:
         raise Exception('Expected 4 or 6 trials, subject has {} trials'.format(ntrials))
     return trialevents
 
    
-def proc_subject(filelist):
+def proc_subject(filelist, dataset=None):
     """Given an infile of raw pupil data, saves out:
         1. Session level data with dilation data summarized for each trial
         2. Dataframe of average peristumulus timecourse for each condition
         3. Plot of average peristumulus timecourse for each condition
-        4. Percent of samples with blinks """
+        4. Percent of samples with blinks 
+    If dataset is given, cleaned samples are also written to the per-sample
+    dataset at that directory (see pupil_dataset.py)."""
     for fname in filelist:
         print('Processing {}'.format(fname))
         if (os.path.splitext(fname)[-1] == ".gazedata") | (os.path.splitext(fname)[-1] == ".csv"):
@@ -124,6 +113,8 @@ def proc_subject(filelist):
         timepoint = pupil_utils.get_timepoint(df['Session'], fname)
         trialevents = get_trial_events(df)
         dfresamp = clean_trials(df, trialevents)
+        if dataset:
+            pupil_dataset.write_samples(dfresamp, dataset, 'fluency', subid, timepoint)
         dfresamp = dfresamp.reset_index(drop=False).set_index(['Condition','Trial'])
         dfresamp['Timestamp'] = dfresamp.groupby(level='Trial')['Timestamp'].transform(lambda x: x - x.iat[0])
         dfresamp['Timestamp'] = pd.to_datetime(dfresamp.Timestamp.values.astype(np.int64))
@@ -140,7 +131,7 @@ def proc_subject(filelist):
         pupildf['Timestamp'] = pd.to_datetime(pupildf.Timestamp).dt.strftime('%H:%M:%S')
         pupil_outname = pupil_utils.get_proc_outfile(fname, '_ProcessedPupil.csv')
         print('Writing processed data to {0}'.format(pupil_outname))
-        pupildf.to_csv(pupil_outname, index=False)
+        pupil_utils.to_csv_atomic(pupildf, pupil_outname, index=False)
         plot_trials(pupildf, fname)
         
         #### Create data for 15 second blocks
@@ -156,7 +147,7 @@ def proc_subject(filelist):
         pupildf15s['Timestamp'] = pd.to_datetime(pupildf15s.Timestamp).dt.strftime('%H:%M:%S')
         pupil15s_outname = pupil_utils.get_proc_outfile(fname, '_ProcessedPupil_Quartiles.csv')
         'Writing quartile data to {0}'.format(pupil15s_outname)
-        pupildf15s.to_csv(pupil15s_outname, index=False)
+        pupil_utils.to_csv_atomic(pupildf15s, pupil15s_outname, index=False)
 
 
 
@@ -170,12 +161,8 @@ if __name__ == '__main__':
               text file (*.gazedata) as input. Removes artifacts, filters, and 
               calculates dilation per 1s.Also creates averages over 15s blocks.""")
         print('')
-        root = tkinter.Tk()
-        root.withdraw()
         # Select files to process
-        filelist = filedialog.askopenfilenames(parent=root,
-                                              title='Choose Fluency pupil gazedata file to process')       
-        filelist = list(filelist)
+        filelist = pupil_utils.ask_filenames('Choose Fluency pupil gazedata file to process')
         # Run script
         proc_subject(filelist)
 
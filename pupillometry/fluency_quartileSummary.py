@@ -16,28 +16,12 @@ import numpy as np
 import pandas as pd
 from glob import glob
 from datetime import datetime
+import pupil_redcap
 
 
 def pivot_wide(dflong):
-    dflong = dflong.replace({'Timestamp' : 
-                                      {'00:00:15' : '1_15', '00:00:30' : '15_30', 
-                                       '00:00:45' : '30_45', '00:01:00' : '45_60'},
-                              'Condition' : 
-                                      {'Category' : 'cat', 'Letter' : 'let'}})
-
-    dflong = dflong[dflong.Timestamp!='00:00:00']
-    dflong['ConditionTime'] = dflong.Condition + '_' + dflong.Timestamp
-    dflong = dflong.drop(columns=['Condition','Timestamp'])
-    colnames = ['Session', 'Dilation', 'Baseline','Diameter', 'BlinkPct', 'ntrials']
-    dfwide = dflong.pivot(index="Subject", columns='ConditionTime', values=colnames)
-    dfwide.columns = ['_'.join([str(col[0]),'fluency',str(col[1])]).strip() for col in dfwide.columns.values]
-    condition = ['cat', 'let']
-    quart = ['1_15','15_30','30_45','45_60']
-    neworder = [n+'_fluency_'+c+'_'+q for c in condition for q in quart for n in colnames]
-    dfwide = dfwide.reindex(neworder, axis=1)
-    dfwide = dfwide.reset_index()
-    dfwide.columns = dfwide.columns.str.lower()
-    return dfwide
+    """Wide REDCap columns of summarized data, as declared in pupil_redcap.SPECS"""
+    return pupil_redcap.pivot_wide(dflong, pupil_redcap.get_spec('fluency'))
     
     
     
@@ -27,15 +27,13 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 import pupil_utils
-try:
-    # for Python2
-    import Tkinter as tkinter
-    import tkFileDialog as filedialog
-except ImportError:
-    # for Python3
-    import tkinter
-    from tkinter import filedialog
+import pupil_dataset
+import pupil_segments
 
+# Trials are blocks of samples separated by a blank CurrentObject. Ready is
+# the baseline and the words played are the response.
+SEGMENT_RULES = [('Baseline', '^Ready$', None),
+                 ('Response', 'PlayWord', None)]
 
 def plot_trials(pupildf, fname):
     palette = sns.color_palette('muted',n_colors=len(pupildf['Trial'].unique()))
@@ -43,17 +41,16 @@ def plot_trials(pupildf, fname):
     plt.xticks(rotation=45)
     plt.tight_layout()
     plot_outname = pupil_utils.get_proc_outfile(fname, "_PupilPlot.png")
-    p.figure.savefig(plot_outname)
+    pupil_utils.savefig_atomic(p.figure, plot_outname)
     plt.close()
     
     
-def clean_trials(trialevents):
+def clean_trials(df, trialevents):
     resampled_dict = {}
-    for trial in trialevents.Trial.unique():
-        rawtrial =  trialevents.loc[trialevents.Trial==trial]
-        rawtrial = rawtrial.loc[(rawtrial.CurrentObject=='Ready')|(rawtrial.CurrentObject.str.contains('PlayWord'))]
+    for trial, phases in trialevents.groupby('Trial'):
+        rawtrial = df.iloc[pupil_segments.segment_index(phases.Start, phases.Stop)]
         cleantrial = pupil_utils.deblink(rawtrial, pupilthresh_hi=4., pupilthresh_lo=1.5)
-        cleantrial.loc[:,'Trial'] = cleantrial.Trial.astype('str')
+        cleantrial['Trial'] = str(trial)
         string_cols = ['Trial', 'CurrentObject']
         trial_resamp = pupil_utils.resamp_filt_data(cleantrial, filt_type='low', string_cols=string_cols)        
         baseline = trial_resamp.loc[trial_resamp.CurrentObject=="Ready","DiameterPupilLRFilt"].last("500ms").mean()
@@ -72,27 +69,22 @@ def define_condition(trialdf):
 
 def get_trial_events(df):
     """
-    Split data for each of the 3 trials. This requires splitting the dataframe
-    based on consecutive rows where CurrentObject is blank. 
-
+    Find trial events. Returns one row per run of Ready or PlayWord objects
+    with the trial (block of consecutive rows where CurrentObject is not 
+    blank), phase, and row positions of the first and one past the last
+    sample of the run.
     """
-    isnull = df.CurrentObject.isnull()
-    partitions = (isnull != isnull.shift()).cumsum()
-    gb = df[~isnull].groupby(partitions)
-    trial_nums = range(1, len(gb.groups) + 1)
-    dfs = pd.concat([group for name, group in gb], keys=trial_nums)
-    trialevents = dfs.reset_index(level=1, drop=True)
-    trialevents.index.name = 'Trial'
-    trialevents = trialevents.reset_index()
-    return trialevents
+    return pupil_segments.segment(df.CurrentObject, SEGMENT_RULES, trials='block')
 
    
-def proc_subject(filelist):
+def proc_subject(filelist, dataset=None):
     """Given an infile of raw pupil data, saves out:
         1. Session level data with dilation data summarized for each trial
         2. Dataframe of average peristumulus timecourse for each condition
         3. Plot of average peristumulus timecourse for each condition
-        4. Percent of samples with blinks """
+        4. Percent of samples with blinks 
+    If dataset is given, cleaned samples are also written to the per-sample
+    dataset at that directory (see pupil_dataset.py)."""
     for fname in filelist:
         print('Processing {}'.format(fname))
         if (os.path.splitext(fname)[-1] == ".gazedata") | (os.path.splitext(fname)[-1] == ".csv"):
@@ -104,7 +96,9 @@ def proc_subject(filelist):
         subid = pupil_utils.get_subid(df['Subject'], fname)
         timepoint = pupil_utils.get_timepoint(df['Session'], fname)
         trialevents = get_trial_events(df)
-        dfresamp = clean_trials(trialevents)
+        dfresamp = clean_trials(df, trialevents)
+        if dataset:
+            pupil_dataset.write_samples(dfresamp, dataset, 'hvlt_encoding', subid, timepoint)
         dfresamp = dfresamp.reset_index(level='Trial', drop=True).reset_index()
         pupildf = dfresamp.groupby('Trial').apply(lambda x: x.resample('1s', on='Timestamp', closed='right', label='right').mean()).reset_index()
         pupilcols = ['Subject', 'Trial', 'Timestamp', 'Dilation',
@@ -117,7 +111,7 @@ def proc_subject(filelist):
                                          'BlinksLR':'BlinkPct'})
         pupildf.loc[:,'Timestamp'] = pupildf.Timestamp.dt.strftime('%H:%M:%S')
         pupil_outname = pupil_utils.get_proc_outfile(fname, '_ProcessedPupil.csv')
-        pupildf.to_csv(pupil_outname, index=False)
+        pupil_utils.to_csv_atomic(pupildf, pupil_outname, index=False)
         print('Writing processed data to {0}'.format(pupil_outname))
         plot_trials(pupildf, fname)
 
@@ -134,7 +128,7 @@ def proc_subject(filelist):
         pupildf6s['Timestamp'] = pd.to_datetime(pupildf6s.Timestamp).dt.strftime('%H:%M:%S')
         pupil6s_outname = pupil_utils.get_proc_outfile(fname, '_ProcessedPupil_Quartiles.csv')
         'Writing quartile data to {0}'.format(pupil6s_outname)
-        pupildf6s.to_csv(pupil6s_outname, index=False)
+        pupil_utils.to_csv_atomic(pupildf6s, pupil6s_outname, index=False)
 
     
 if __name__ == '__main__':
@@ -146,13 +140,8 @@ if __name__ == '__main__':
               csv files for use in further group analysis. Takes eye tracker 
               data text file (*.gazedata) as input. Removes artifacts, filters, 
               and calculates dilation per 1sec.""")
-        root = tkinter.Tk()
-        root.withdraw()
         # Select files to process
-        filelist = filedialog.askopenfilenames(parent=root,
-                                              title='Choose HVLT Encoding pupil gazedata file to process')
-
-        filelist = list(filelist)
+        filelist = pupil_utils.ask_filenames('Choose HVLT Encoding pupil gazedata file to process')
         # Run script
         proc_subject(filelist)
 
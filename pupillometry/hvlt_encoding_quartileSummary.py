@@ -15,23 +15,12 @@ import numpy as np
 import pandas as pd
 from glob import glob
 from datetime import datetime
+import pupil_redcap
 
 
 def pivot_wide(dflong):
-    dflong = dflong.replace({'Timestamp' : 
-                                      {'00:00:06' : '1_6', '00:00:12' : '6_12', 
-                                       '00:00:18' : '12_18', '00:00:24' : '18_24'}})
-
-    dflong = dflong[(dflong.Timestamp!='00:00:00') & (dflong.Timestamp!='00:00:30')]
-    colnames = ['Session', 'Baseline','Diameter', 'Dilation', 'BlinkPct', 'ntrials']
-    dfwide = dflong.pivot(index="Subject", columns='Timestamp', values=colnames)
-    dfwide.columns = ['_'.join([str(col[0]),'hvlt_encoding',str(col[1])]).strip() for col in dfwide.columns.values]
-    quart = ['1_6','6_12','12_18','18_24']
-    neworder = [n+'_hvlt_encoding_'+q for q in quart for n in colnames]
-    dfwide = dfwide.reindex(neworder, axis=1)
-    dfwide = dfwide.reset_index()
-    dfwide.columns = dfwide.columns.str.lower()
-    return dfwide
+    """Wide REDCap columns of summarized data, as declared in pupil_redcap.SPECS"""
+    return pupil_redcap.pivot_wide(dflong, pupil_redcap.get_spec('hvlt_encoding'))
     
 
 def proc_group(datadir):
@@ -25,15 +25,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 import pupil_utils
-try:
-    # for Python2
-    import Tkinter as tkinter
-    import tkFileDialog as filedialog
-except ImportError:
-    # for Python3
-    import tkinter
-    from tkinter import filedialog
-
+import pupil_dataset
 
 def plot_trials(pupildf, fname):
     sns.set_style("ticks")
@@ -41,7 +33,7 @@ def plot_trials(pupildf, fname):
     plt.tight_layout()
     plot_outname = pupil_utils.get_proc_outfile(fname, "_PupilPlot.png")
     plot_outname = plot_outname.replace("-Delay","-Recall")
-    p.figure.savefig(plot_outname)
+    pupil_utils.savefig_atomic(p.figure, plot_outname)
     plt.close()
     
     
@@ -55,12 +47,14 @@ def clean_trials(df):
         return dfresamp
         
    
-def proc_subject(filelist):
+def proc_subject(filelist, dataset=None):
     """Given an infile of raw pupil data, saves out:
         1. Session level data with dilation data summarized for each trial
         2. Dataframe of average peristumulus timecourse for each condition
         3. Plot of average peristumulus timecourse for each condition
-        4. Percent of samples with blinks """
+        4. Percent of samples with blinks 
+    If dataset is given, cleaned samples are also written to the per-sample
+    dataset at that directory (see pupil_dataset.py)."""
     for fname in filelist:
         print('Processing {}'.format(fname))
         if (os.path.splitext(fname)[-1] == ".gazedata") | (os.path.splitext(fname)[-1] == ".csv"):
@@ -74,6 +68,8 @@ def proc_subject(filelist):
         df = df[df.CurrentObject.str.contains("Recall", na=False)]
         df = pupil_utils.deblink(df)
         dfresamp = clean_trials(df)
+        if dataset:
+            pupil_dataset.write_samples(dfresamp, dataset, 'hvlt_recall', subid, timepoint)
         dfresamp1s = dfresamp.resample('1S', closed='right', label='right').mean()
         dfresamp1s.index = dfresamp1s.index.round('S')
         dfresamp1s = dfresamp1s.dropna(how='all')
@@ -89,7 +85,7 @@ def proc_subject(filelist):
         pupildf['Session'] = timepoint  
         pupil_outname = pupil_utils.get_proc_outfile(fname, '_ProcessedPupil.csv')
         pupil_outname = pupil_outname.replace("-Delay","-Recall")
-        pupildf.to_csv(pupil_outname, index=False)
+        pupil_utils.to_csv_atomic(pupildf, pupil_outname, index=False)
         print('Writing processed data to {0}'.format(pupil_outname))
         plot_trials(pupildf, fname)
 
@@ -107,7 +103,7 @@ def proc_subject(filelist):
         pupil15s_outname = pupil_utils.get_proc_outfile(fname, '_ProcessedPupil_Quartiles.csv')
         pupil15s_outname = pupil15s_outname.replace("-Delay","-Recall")
         'Writing quartile data to {0}'.format(pupil15s_outname)
-        pupildf15s.to_csv(pupil15s_outname, index=False)
+        pupil_utils.to_csv_atomic(pupildf15s, pupil15s_outname, index=False)
 
     
 if __name__ == '__main__':
@@ -119,12 +115,8 @@ if __name__ == '__main__':
               text file (*.gazedata) as input. Removes artifacts, filters, and 
               calculates dilation per 1s.Also creates averages over 15s blocks.""")
         print('')
-        root = tkinter.Tk()
-        root.withdraw()
         # Select files to process
-        filelist = filedialog.askopenfilenames(parent=root,
-                                              title='Choose HVLT recall-recognition pupil gazedata file to process')       
-        filelist = list(filelist)
+        filelist = pupil_utils.ask_filenames('Choose HVLT recall-recognition pupil gazedata file to process')
         # Run script
         proc_subject(filelist)
 
@@ -15,22 +15,11 @@ import numpy as np
 import pandas as pd
 from glob import glob
 from datetime import datetime
+import pupil_redcap
 
 def pivot_wide(dflong):
-    dflong = dflong.replace({'Timestamp' : 
-                                      {'00:00:15' : '1_15', '00:00:30' : '15_30', 
-                                       '00:00:45' : '30_45', '00:01:00' : '45_60'}})
-
-    dflong = dflong[dflong.Timestamp!='00:00:00']
-    colnames = ['Session', 'Baseline','Diameter', 'Dilation', 'BlinkPct']
-    dfwide = dflong.pivot(index="Subject", columns='Timestamp', values=colnames)
-    dfwide.columns = ['_'.join([str(col[0]),'hvlt_recall',str(col[1])]).strip() for col in dfwide.columns.values]
-    quart = ['1_15','15_30','30_45','45_60']
-    neworder = [n+'_hvlt_recall_'+q for q in quart for n in colnames]
-    dfwide = dfwide.reindex(neworder, axis=1)
-    dfwide = dfwide.reset_index()
-    dfwide.columns = dfwide.columns.str.lower()
-    return dfwide
+    """Wide REDCap columns of summarized data, as declared in pupil_redcap.SPECS"""
+    return pupil_redcap.pivot_wide(dflong, pupil_redcap.get_spec('hvlt_recall'))
     
 
 
@@ -14,18 +14,12 @@ import sys
 import pandas as pd
 from glob import glob
 from datetime import datetime
+import pupil_redcap
 
 
 def pivot_wide(dflong):
-    colnames = ['Session','Dilation','Baseline','Diameter','BlinkPct','Duration','ntrials']
-    dfwide = dflong.pivot(index="Subject", columns='Condition', values=colnames)
-    dfwide.columns = ['_'.join([str(col[0]),'hvlt_recognition',str(col[1])]).strip() for col in dfwide.columns.values]
-    condition = ['old', 'new']
-    neworder = [n+'_hvlt_recognition_'+c for c in condition for n in colnames]
-    dfwide = dfwide.reindex(neworder, axis=1)
-    dfwide = dfwide.reset_index()
-    dfwide.columns = dfwide.columns.str.lower()
-    return dfwide
+    """Wide REDCap columns of summarized data, as declared in pupil_redcap.SPECS"""
+    return pupil_redcap.pivot_wide(dflong, pupil_redcap.get_spec('hvlt_recognition'))
     
     
     
@@ -28,15 +28,9 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 import pupil_utils
-try:
-    # for Python2
-    import Tkinter as tkinter
-    import tkFileDialog as filedialog
-except ImportError:
-    # for Python3
-    import tkinter
-    from tkinter import filedialog
-
+import pupil_dataset
+import pupil_epochs
+import pupil_segments
 
 
 def hvlt_conditions_df():
@@ -54,44 +48,77 @@ def hvlt_conditions_df():
     return hvlt_conds
 
 
+def get_trial_bounds(dfresamp):
+    """Start and stop (exclusive) positions and TrialId of each trial"""
+    return pupil_segments.find_runs(dfresamp.TrialId.values)
+
+
+def backfill_fixation(dfresamp, starts, stops):
+    """Resampling forward fills CurrentObject when missing. This
+    results in values of "Response" at beginning of trials. Replace these
+    by backfilling from first occurrence of "Fixation" in every trial. If a
+    trial has no "Fixation", only its first sample is relabeled."""
+    objects = dfresamp.CurrentObject.values.copy()
+    fixpos = np.flatnonzero(objects == "Fixation")
+    nextfix = np.searchsorted(fixpos, starts)
+    fixstart = fixpos[np.minimum(nextfix, len(fixpos) - 1)] if len(fixpos) else starts
+    fixstart = np.where((nextfix < len(fixpos)) & (fixstart < stops), fixstart, starts)
+    objects[pupil_segments.segment_index(starts, fixstart + 1)] = "Fixation"
+    dfresamp['CurrentObject'] = objects
+    return dfresamp
+
+
 def clean_trials(df):
-        dfresamp = pupil_utils.resamp_filt_data(df, filt_type='low', string_cols=['CurrentObject'])
-        # Resampling fills forward fills Current Object when missing. This
-        # results in values of "Response" at beginning of trials. Reaplce these
-        # by backfilling from first occurrence of "Fixation" in every trial.
-        for i in dfresamp.TrialId.unique():
-            trialstartidx = (dfresamp.TrialId==i).idxmax()
-            fixstartidx = (dfresamp.loc[dfresamp.TrialId==i,"CurrentObject"]=="Fixation").idxmax()
-            dfresamp.loc[trialstartidx:fixstartidx, "CurrentObject"] = "Fixation"
-        dfresamp.groupby("TrialId").apply(lambda x: x.index[-1] - x.index[0]).sum()
-        return dfresamp
-
-
-def proc_all_trials(dfresamp):
+    dfresamp = pupil_utils.resamp_filt_data(df, filt_type='low', string_cols=['CurrentObject'])
+    starts, stops, _ = get_trial_bounds(dfresamp)
+    dfresamp = backfill_fixation(dfresamp, starts, stops)
+    return dfresamp
+
+
+def proc_all_trials(dfresamp, samp_rate=30., windows=((0.5, 1.5),), baseline_sec=0.25):
     """ 
-    Process single trial using the following steps:
-        1) Get mean diameter of first 500ms as baseline 
+    Process all trials at once from the positions where each trial starts 
+    and stops:
+        1) Get mean diameter of first 250ms as baseline 
         2) Calculate dilation by subtracting baseline from diameter at all samples
-        3) Get mean dilation for each trial
+        3) Get mean dilation, peak latency, AUC and window means for each trial
         4) Get mean blink pct per trial
         5) Get duration of each trial
     """
-    dfresamp['Baseline'] = dfresamp.groupby('TrialId')['DiameterPupilLRFilt'].transform(lambda x: x.first('250ms').mean())
-    dfresamp['Dilation'] = dfresamp['DiameterPupilLRFilt'] - dfresamp['Baseline']
-    dfresamp['Duration'] = dfresamp.groupby('TrialId')['TrialId'].transform(lambda x: (x.index[-1] - x.index[0]) / np.timedelta64(1, 's'))
-    alltrialsdf = dfresamp.groupby('TrialId')[['Baseline','DiameterPupilLRFilt','Dilation','BlinksLR','Duration']].mean()
-    alltrialsdf = alltrialsdf.reset_index()    
+    starts, stops, trialids = get_trial_bounds(dfresamp)
+    times = dfresamp.index.values
+    diameter = dfresamp['DiameterPupilLRFilt'].values
+    # Baseline samples are those less than baseline_sec after trial start
+    basestops = np.searchsorted(times, times[starts] + np.timedelta64(int(baseline_sec * 1e9), 'ns'))
+    baseline = pupil_segments.segment_means(diameter, starts, np.minimum(basestops, stops))
+    dfresamp['Baseline'] = np.repeat(baseline, stops - starts)
+    dfresamp['Dilation'] = diameter - dfresamp['Baseline'].values
+    alltrialsdf = pd.DataFrame({'TrialId': trialids, 'Baseline': baseline,
+        'DiameterPupilLRFilt': pupil_segments.segment_means(diameter, starts, stops),
+        'BlinksLR': pupil_segments.segment_means(dfresamp['BlinksLR'].values, starts, stops),
+        'Duration': (times[stops - 1] - times[starts]) / np.timedelta64(1, 's')})
+    # Trial metrics from epochs of every trial
+    epochs = pupil_epochs.epochs_from_bounds(dfresamp.Dilation.values, starts, stops)
+    times = np.arange(epochs.shape[1]) / samp_rate
+    metrics = pupil_epochs.epoch_metrics(epochs, times, windows)
+    metrics = metrics.drop(columns=['DilationMax','DilationSD','ConstrictionMax'])
+    metrics = metrics.rename(columns={'DilationMean':'Dilation'})
+    # Metrics are in trial order, so a TrialId seen twice does not multiply rows
+    alltrialsdf = alltrialsdf.join(metrics)
     conditions = hvlt_conditions_df()
-    alltrialsdf = alltrialsdf.merge(conditions[['TrialId','Condition']], on='TrialId')
-    return alltrialsdf    
+    alltrialsdf = alltrialsdf.merge(conditions[['TrialId','Condition']], on='TrialId', 
+                                    validate='many_to_one')
+    return alltrialsdf.sort_values('TrialId').reset_index(drop=True)
     
-def proc_subject(filelist):
+def proc_subject(filelist, dataset=None):
     """
     Given an infile of raw pupil data, saves out:
         1) Session level data with dilation data summarized for each trial
         2) Dataframe of average peristumulus timecourse for each condition
         3) Plot of average peristumulus timecourse for each condition
         4) Percent of samples with blinks 
+    If dataset is given, cleaned samples are also written to the per-sample
+    dataset at that directory (see pupil_dataset.py).
     """
     for fname in filelist:
         print('Processing {}'.format(fname))
@@ -106,27 +133,22 @@ def proc_subject(filelist):
         # Keep only samples after last sample of Recall
         df = df[df[df.CurrentObject=="Recall"].index[-1]+1:]
         df = pupil_utils.deblink(df)
-        dfresamp = pupil_utils.resamp_filt_data(df, filt_type='low', string_cols=['CurrentObject'])
-        # Resampling fills forward fills Current Object when missing. This
-        # results in values of "Response" at beginning of trials. Reaplce these
-        # by backfilling from first occurrence of "Fixation" in every trial.
-        for i in dfresamp.TrialId.unique():
-            trialstartidx = (dfresamp.TrialId==i).idxmax()
-            fixstartidx = (dfresamp.loc[dfresamp.TrialId==i,"CurrentObject"]=="Fixation").idxmax()
-            dfresamp.loc[trialstartidx:fixstartidx, "CurrentObject"] = "Fixation"
         dfresamp = clean_trials(df)
         pupildf = proc_all_trials(dfresamp)
+        if dataset:
+            pupil_dataset.write_samples(dfresamp, dataset, 'hvlt_recognition', subid, timepoint)
         pupildf['Subject'] = subid
         pupildf['Session'] = timepoint
         pupildf = pupildf.rename(columns={'DiameterPupilLRFilt':'Diameter',
                                                   'BlinksLR':'BlinkPct'})
         # Reorder columns
         cols = ['Subject', 'Session', 'TrialId', 'Baseline', 'Diameter', 
-                'Dilation', 'BlinkPct', 'Duration','Condition']
+                'Dilation', 'BlinkPct', 'Duration','Condition', 'PeakLatency',
+                'HalfPeakLatency', 'AUC'] + [c for c in pupildf.columns if c.startswith('DilationMean_')]
         pupildf = pupildf[cols]
         pupil_outname = pupil_utils.get_proc_outfile(fname, '_ProcessedPupil.csv')
         pupil_outname = pupil_outname.replace("-Delay","-Recognition")
-        pupildf.to_csv(pupil_outname, index=False)
+        pupil_utils.to_csv_atomic(pupildf, pupil_outname, index=False)
         print('Writing processed data to {0}'.format(pupil_outname))
  
 
@@ -140,12 +162,8 @@ if __name__ == '__main__':
               text file (*.gazedata) as input. Removes artifacts, filters, and 
               calculates dilation per 1s.Also creates averages over 15s blocks.""")
         print('')
-        root = tkinter.Tk()
-        root.withdraw()
         # Select files to process
-        filelist = filedialog.askopenfilenames(parent=root,
-                                              title='Choose HVLT recall-recognition pupil gazedata file to process')       
-        filelist = list(filelist)
+        filelist = pupil_utils.ask_filenames('Choose HVLT recall-recognition pupil gazedata file to process')
         # Run script
         proc_subject(filelist)
 
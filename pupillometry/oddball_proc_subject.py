@@ -27,24 +27,16 @@ import os
 import sys
 import numpy as np
 import pandas as pd
-import json
 import matplotlib.pyplot as plt
 import seaborn as sns
-from scipy.signal import fftconvolve
 import nitime.timeseries as ts
 import nitime.analysis as nta
 import nitime.viz as viz
 from nistats.regression import ARModel, OLSModel
 import pupil_utils
-try:
-    # for Python2
-    import Tkinter as tkinter
-    import tkFileDialog as filedialog
-except ImportError:
-    # for Python3
-    import tkinter
-    from tkinter import filedialog
-
+import pupil_tasks
+import pupil_dataset
+import pupil_epochs
 
 
 def get_sessdf(dfresamp):
@@ -62,12 +54,10 @@ def save_total_blink_pct(dfresamp, infile):
     outfile = pupil_utils.get_outfile(infile, '_BlinkPct.json')
     blink_dict = {}
     blink_dict['BlinkPct'] = float(dfresamp.BlinksLR.mean())
-    blink_dict['Subject'] = pupil_utils.get_subid(dfresamp['Subject'])
+    blink_dict['Subject'] = pupil_utils.get_subid(dfresamp['Subject'], infile)
     blink_dict['Session'] = pupil_utils.get_timepoint(dfresamp['Session'], infile)
     blink_dict['OddballSession'] = get_oddball_session(infile)
-    blink_json = json.dumps(blink_dict)
-    with open(outfile, 'w') as f:
-        f.write(blink_json)
+    pupil_utils.write_json_atomic(blink_dict, outfile)
         
     
 def get_blink_pct(dfresamp, infile=None):
@@ -80,18 +70,12 @@ def get_blink_pct(dfresamp, infile=None):
     return trial_blinkpct
 
 
-def get_trial_dils(pupil_dils, onset, tpre, tpost, samp_rate):
-    """Given pupil dilations for entire session and an onset, returns a 
-    normalized timecourse for the trial. Calculates a baseline to subtract from
-    trial data."""
-    onset_idx = int(pupil_dils.index.get_loc(onset))
-    pre_idx = int(onset_idx - (tpre/(1/samp_rate)))
-    post_idx = int(onset_idx + (tpost/(1/samp_rate)) + 1)
-    baseline = pupil_dils.iloc[pre_idx:onset_idx].mean()
-#    baseline = pupil_dils[onset]
-    #trial_dils = pupil_dils[onset:post_event] - baseline
-    trial_dils = pupil_dils.iloc[pre_idx:post_idx] - baseline
-    return trial_dils
+def append_trials(conddf, epochs, trials, condition):
+    """Adds a column with the epoch of each trial in condition to conddf"""
+    is_cond = (trials.Condition==condition).values
+    trialdf = pd.DataFrame(epochs[is_cond].T, index=conddf.index, 
+                           columns=trials.TrialId.values[is_cond])
+    return pd.concat([conddf, trialdf], axis=1)
 
 
 def initiate_condition_df(tpre, tpost, samp_rate):
@@ -109,27 +93,22 @@ def initiate_condition_df(tpre, tpost, samp_rate):
     
     
     
-def proc_all_trials(sessdf, pupil_dils, tpre=.5, tpost=2.5, samp_rate=30.):
-    """FOr each trial, calculates the pupil dilation timecourse and saves to 
-    appropriate dataframe depending on trial condition (target or standard).
-    Saves summary metric of max dilation and standard deviation of dilation 
-    to session level dataframe."""
+def proc_all_trials(sessdf, pupil_dils, tpre=.5, tpost=2.5, samp_rate=30., windows=((0.5, 1.5),)):
+    """Calculates the pupil dilation timecourse of all trials at once and saves 
+    to appropriate dataframe depending on trial condition (target or standard).
+    Saves summary metrics of each trial (max, mean and standard deviation of 
+    dilation, peak latency, AUC, mean dilation in each window) to session 
+    level dataframe. The first trial and trials with >33% blinks are skipped."""
     targdf, standdf = initiate_condition_df(tpre, tpost, samp_rate)
-    for trial_series in sessdf.itertuples():
-        if (trial_series.TrialId==1) | (trial_series.BlinkPct>0.33):
-            continue
-        onset = trial_series.Timestamp
-        trial_dils = get_trial_dils(pupil_dils, onset, tpre, tpost, samp_rate)
-        sessdf.loc[sessdf.TrialId==trial_series.TrialId,'DilationMax'] = trial_dils.max()
-        sessdf.loc[sessdf.TrialId==trial_series.TrialId,'DilationMean'] = trial_dils.mean()
-        sessdf.loc[sessdf.TrialId==trial_series.TrialId,'DilationSD'] = trial_dils.std()
-        sessdf.loc[sessdf.TrialId==trial_series.TrialId,'ConstrictionMax'] = trial_dils.min()
-        if trial_series.Condition=='Standard':
-            standdf[trial_series.TrialId] = np.nan
-            standdf.loc[standdf.index[:len(trial_dils)], trial_series.TrialId] = trial_dils.values
-        elif trial_series.Condition=='Target':
-            targdf[trial_series.TrialId] = np.nan
-            targdf.loc[standdf.index[:len(trial_dils)], trial_series.TrialId] = trial_dils.values
+    trials = sessdf[(sessdf.TrialId!=1) & ~(sessdf.BlinkPct>0.33)]
+    trials, onset_idx = pupil_epochs.match_onsets(pupil_dils.index, trials)
+    epochs, times = pupil_epochs.get_epochs(pupil_dils.values, onset_idx, tpre, tpost, samp_rate)
+    metrics = pupil_epochs.epoch_metrics(epochs, times, windows)
+    metrics.index = trials.index
+    for col in metrics.columns:
+        sessdf[col] = metrics[col]
+    targdf = append_trials(targdf, epochs, trials, 'Target')
+    standdf = append_trials(standdf, epochs, trials, 'Standard')
     return sessdf, targdf, standdf
             
 
@@ -161,33 +140,74 @@ def plot_event(signal_filt, trg_ts, std_ts, kernel, infile):
     viz.plot_tseries(all_era.eta, yerror=all_era.ets, fig=fig)
     ax.plot((all_era.eta.time*(10**-12)), kernel)
     ax.legend(['Standard','Target','Pupil IRF'])
-    fig.savefig(outfile)
+    pupil_utils.savefig_atomic(fig, outfile)
     plt.close(fig)
 
     
     
-def ts_glm(pupilts, trg_onsets, std_onsets, blinks, sampling_rate=30.):
+def glm_contrasts(beta, cov, dof, columns):
+    """Evaluates the oddball contrasts and F-tests declared in pupil_tasks 
+    for a fitted GLM. Columns names the design columns, or maps each 
+    condition to its weights over the design (FIR model)."""
+    spec = pupil_tasks.TASKS['oddball']
+    return pupil_utils.contrast_results(beta, cov, dof, columns, spec['contrasts'], 
+                                        spec['f_tests'])
+
+
+def ts_glm(pupilts, trg_onsets, std_onsets, blinks, sampling_rate=30., upsample_rate=1000.,
+           model='canonical', fir_window=(0., 4.), irf_params=None):
+    """Fits GLM of target and standard regressors to pupil timeseries. Onsets 
+    are exact times (sec) from the start of the session. 
+    If model is 'canonical', regressors are the pupil irf convolved with onsets. 
+    They are built at upsample_rate and decimated to the signal, so onsets are 
+    not snapped to the resampled grid. 
+    If model is 'fir', a finite impulse response model estimates a free-form 
+    response for each condition over fir_window. Results are t-values of the 
+    mean response over the window, and FIR estimates are returned under 'FIR'.
+    Irf_params can be a dictionary overriding the default s1, n1, and tmax of 
+    the canonical pupil irf (e.g. output of fit_irf).
+    Contrasts are declared in pupil_tasks.TASKS and returned with their t 
+    under the contrast name, and effect, SE and p as <name>_effect, <name>_se 
+    and <name>_p. F-tests are returned as <name> and <name>_p."""
     signal_filt = ts.TimeSeries(pupilts, sampling_rate=sampling_rate)
-    trg_ts = get_event_ts(pupilts, trg_onsets)    
-    std_ts = get_event_ts(pupilts, std_onsets)
+    sample_times = pupil_utils.get_sample_times(pupilts)
+    if model == 'fir':
+        onsets = [pupil_utils.get_onset_samples(trg_onsets, sample_times, 'Target'),
+                  pupil_utils.get_onset_samples(std_onsets, sample_times, 'Standard')]
+        fit, firdf, mean_contrasts = pupil_utils.fir_glm(pupilts.values, onsets, blinks.values,
+                                                         ['Target','Standard'], sampling_rate, 
+                                                         fir_window=fir_window)
+        resultdict = glm_contrasts(fit['beta'], fit['cov'], fit['dof'], mean_contrasts)
+        resultdict['FIR'] = firdf
+        return resultdict
     kernel_end_sec = 2.5
-    kernel_length = kernel_end_sec / (1/sampling_rate)
-    kernel_x = np.linspace(0, kernel_end_sec, int(kernel_length))
-    trg_reg, trg_td_reg = pupil_utils.regressor_tempderiv(trg_ts, kernel_x)
-    std_reg, std_td_reg = pupil_utils.regressor_tempderiv(std_ts, kernel_x)
-    #kernel = pupil_irf(kernel_x)
+    irf = {'s1':50000., 'n1':10.1, 'tmax':0.930}
+    if irf_params:
+        irf.update((k, irf_params[k]) for k in irf if k in irf_params)
+    event_regs, outside = pupil_utils.event_design_precise([trg_onsets, std_onsets], sample_times,
+                                                           kernel_end_sec=kernel_end_sec,
+                                                           upsample_rate=upsample_rate, **irf)
+    pupil_utils.print_outside_onsets(outside, ['Target','Standard'])
+    #kernel, _ = pupil_utils.get_irf_kernels(sampling_rate, kernel_end_sec)
     #plot_event(signal_filt, trg_ts, std_ts, kernel, fname)
     intercept = np.ones_like(signal_filt.data)
-    X = np.array(np.vstack((intercept, trg_reg, std_reg, blinks.values)).T)
+    X = np.column_stack((intercept, event_regs, blinks.values))
     Y = np.atleast_2d(signal_filt).T
     model = ARModel(X, rho=1.).fit(Y)
-    tTrg = float(model.Tcontrast([0,1,0,0]).t)
-    tStd = float(model.Tcontrast([0,0,1,0]).t)
-    tTrgStd = float(model.Tcontrast([0,1,-1,0]).t)   
-    resultdict = {'Target_Beta':tTrg, 'Standard_Beta':tStd, 'ContrastT':tTrgStd}
+    resultdict = glm_contrasts(model.theta, model.vcov(), model.df_resid, 
+                               ['Intercept','Target','Standard','Blinks'])
     return resultdict
 
 
+def fit_irf(pupilts, trg_onsets, std_onsets, blinks):
+    """Grid search for the pupil irf shape (n1, tmax) that best fits this 
+    subject's data. Onsets are exact times (sec) from the start of the session."""
+    irf_fit, _ = pupil_utils.fit_irf_grid(pupilts.values, [trg_onsets, std_onsets],
+                                          pupil_utils.get_sample_times(pupilts), blinks.values,
+                                          kernel_end_sec=2.5, s1=50000.)
+    return irf_fit
+
+
 def get_oddball_session(infile):
     """Returns session as listed in the infile name (1=A, 2=B). If not listed, 
     default to SessionA."""
@@ -201,10 +221,8 @@ def get_oddball_session(infile):
 
 def save_glm_results(glm_results, infile):
     """Calculate and save out percent of trials with blinks in session"""
-    glm_json = json.dumps(glm_results)
     outfile = pupil_utils.get_outfile(infile, '_GLMresults.json')
-    with open(outfile, 'w') as f:
-        f.write(glm_json)
+    pupil_utils.write_json_atomic(glm_results, outfile)
         
         
 def plot_pstc(allconddf, infile, trial_start=0.):
@@ -212,7 +230,7 @@ def plot_pstc(allconddf, infile, trial_start=0.):
     outfile = pupil_utils.get_outfile(infile, '_PSTCplot.png')
     p = sns.lineplot(data=allconddf, x="Timepoint",y="Dilation", hue="Condition", legend="brief")
     plt.axvline(trial_start, color='k', linestyle='--')
-    p.figure.savefig(outfile)  
+    pupil_utils.savefig_atomic(p.figure, outfile)  
     plt.close()
     
 
@@ -220,62 +238,158 @@ def save_pstc(allconddf, infile, trial_start=0.):
     """Save out peristimulus timecourse plots"""
     outfile = pupil_utils.get_outfile(infile, '_PSTCdata.csv')
     pstcdf = allconddf.groupby(['Subject','Condition','Timepoint']).mean().reset_index()
-    pstcdf.to_csv(outfile, index=False)
+    pupil_utils.to_csv_atomic(pstcdf, outfile, index=False)
+    
+
+def save_fir(firdf, infile):
+    """Save out FIR estimates of the response to each condition"""
+    outfile = pupil_utils.get_outfile(infile, '_FIRdata.csv')
+    pupil_utils.to_csv_atomic(firdf, outfile, index=False)
     
 
-def proc_subject(filelist):
+def save_epochs(targdf, standdf, infile, subid, timepoint, oddball_sess):
+    """Save out baselined epochs of all included trials (trials x samples) for 
+    trial resampling analyses such as pupil_reliability"""
+    outfile = pupil_utils.get_outfile(infile, '_Epochs.npz')
+    trialdfs = [conddf.drop(columns=['Condition','Timepoint'], errors='ignore') 
+                for conddf in (targdf, standdf)]
+    epochs = np.hstack([trialdf.values for trialdf in trialdfs]).T
+    conditions = np.repeat(['Target','Standard'], [trialdf.shape[1] for trialdf in trialdfs])
+    trialids = np.concatenate([trialdf.columns.values for trialdf in trialdfs]).astype(np.int64)
+    with pupil_utils.atomic_write(outfile, 'wb') as f:
+        np.savez_compressed(f, epochs=epochs.astype(np.float64), times=targdf.index.values, 
+                            trialid=trialids, condition=conditions, subject=str(subid),
+                            session=str(timepoint), oddball_session=str(oddball_sess))
+
+
+def save_glm_input(glm_input, infile, subid, timepoint, oddball_sess):
+    """Save out the cleaned signal, blinks, sample times and onsets of each
+    condition that the GLM is fit to, so it can be refit for the group with
+    pupil_glm.py without reprocessing raw data"""
+    outfile = pupil_utils.get_outfile(infile, '_GLMinput.npz')
+    with pupil_utils.atomic_write(outfile, 'wb') as f:
+        np.savez_compressed(f, subject=str(subid), session=str(timepoint), 
+                            oddball_session=str(oddball_sess), **glm_input)
+
+
+QC_COLUMNS = ['Subject','Session','DiameterPupilLRResamp','DiameterPupilLRFilt','BlinksLR']
+
+
+def load_session(fname):
+    """Reads raw pupil data of one session"""
+    if (os.path.splitext(fname)[-1] == ".gazedata") | (os.path.splitext(fname)[-1] == ".csv"):
+        df = pd.read_csv(fname, sep="\t")
+    elif os.path.splitext(fname)[-1] == ".xlsx":
+        df = pd.read_excel(fname, parse_dates=False)
+    else: 
+        raise IOError('Could not open {}'.format(fname))   
+    return {'fname':fname, 'df':df}
+
+
+def process_session(session, glm_model='canonical', fit_subject_irf=False):
+    """Cleans pupil data of one session loaded by load_session, then 
+    calculates trial measures, epochs, peristimulus timecourses and GLM 
+    results. Nothing is written; returns dictionary of results for 
+    write_session."""
+    tpre = 0.5
+    tpost = 2.5
+    samp_rate = 30.
+    fname, df = session['fname'], session['df']
+    subid = pupil_utils.get_subid(df['Subject'], fname)
+    timepoint = pupil_utils.get_timepoint(df['Session'], fname)
+    oddball_sess = get_oddball_session(fname)
+    df = pupil_utils.deblink(df, inplace=True)
+    dfresamp = pupil_utils.resamp_filt_lean(df)
+    dfresamp['Condition'] = np.where(dfresamp.CRESP==5, 'Standard', 'Target')
+    sessdf = get_sessdf(dfresamp)
+    sessdf['BlinkPct'] = get_blink_pct(dfresamp)
+    dfresamp['zDiameterPupilLRFilt'] = pupil_utils.zscore(dfresamp['DiameterPupilLRFilt'])
+    sessdf, targdf, standdf = proc_all_trials(sessdf, dfresamp['zDiameterPupilLRFilt'], 
+                                              tpre, tpost, samp_rate)
+    # Trial, baseline and dilation of every sample for the per-sample dataset
+    samples = pupil_epochs.trial_samples(dfresamp['zDiameterPupilLRFilt'], sessdf, tpre, samp_rate)
+    onset_times = pupil_utils.get_onset_times(df)
+    trg_onsets = onset_times.reindex(sessdf.loc[sessdf.Condition=='Target', 'TrialId'])
+    std_onsets = onset_times.reindex(sessdf.loc[sessdf.Condition=='Standard', 'TrialId'])
+    irf_params = None
+    if fit_subject_irf:
+        irf_params = fit_irf(dfresamp.zDiameterPupilLRFilt, trg_onsets, std_onsets, 
+                             dfresamp.BlinksLR)
+    glm_results = ts_glm(dfresamp.zDiameterPupilLRFilt, trg_onsets, std_onsets,
+                         dfresamp.BlinksLR, model=glm_model, irf_params=irf_params)
+    glm_input = {'signal':dfresamp.zDiameterPupilLRFilt.values.astype(np.float64), 
+                 'blinks':dfresamp.BlinksLR.values.astype(np.float64),
+                 'times':pupil_utils.get_sample_times(dfresamp),
+                 'conditions':np.array(['Target','Standard']),
+                 'onsets_Target':trg_onsets.values.astype(np.float64), 
+                 'onsets_Standard':std_onsets.values.astype(np.float64),
+                 'glm_model':np.array(glm_model)}
+    if irf_params:
+        glm_results['IRF_n1'] = irf_params['n1']
+        glm_results['IRF_tmax'] = irf_params['tmax']
+        # Refits with pupil_glm.py use the irf fit to this session
+        glm_input['irf_n1'] = np.float64(irf_params['n1'])
+        glm_input['irf_tmax'] = np.float64(irf_params['tmax'])
+    firdf = glm_results.pop('FIR', None)
+    if firdf is not None:
+        firdf['Subject'] = subid
+        firdf['Session'] = timepoint
+        firdf['OddballSession'] = oddball_sess
+    # Set subject ID and session as (as type string)
+    glm_results['Subject'] = subid
+    glm_results['Session'] = timepoint
+    glm_results['OddballSession'] = oddball_sess
+    allconddf = pd.concat([reshape_df(standdf), reshape_df(targdf)]).reset_index(drop=True)
+    allconddf['Subject'] = subid
+    allconddf['Session'] = timepoint   
+    allconddf['OddballSession'] = oddball_sess
+    sessdf['Subject'] = subid
+    sessdf['Session'] = timepoint   
+    sessdf['OddballSession'] = oddball_sess        
+    return {'fname':fname, 'dfresamp':dfresamp[QC_COLUMNS].join(samples), 'sessdf':sessdf, 
+            'targdf':targdf, 'standdf':standdf, 'subid':subid, 'timepoint':timepoint, 
+            'oddball_sess':oddball_sess, 'glm_results':glm_results, 'firdf':firdf, 
+            'glm_input':glm_input, 'allconddf':allconddf}
+
+
+def write_session(results, dataset=None):
+    """Saves all outputs of one session processed by process_session. If 
+    dataset is given, samples are also written to the per-sample dataset at 
+    that directory (see pupil_dataset.py)."""
+    fname = results['fname']
+    if dataset:
+        pupil_dataset.write_samples(results['dfresamp'], dataset, 'oddball', results['subid'],
+                                    results['timepoint'], part=results['oddball_sess'])
+    pupil_utils.plot_qc(results['dfresamp'], fname)
+    save_total_blink_pct(results['dfresamp'], fname)
+    save_epochs(results['targdf'], results['standdf'], fname, results['subid'], 
+                results['timepoint'], results['oddball_sess'])
+    if results['firdf'] is not None:
+        save_fir(results['firdf'], fname)
+    save_glm_results(results['glm_results'], fname)
+    save_glm_input(results['glm_input'], fname, results['subid'], results['timepoint'], 
+                   results['oddball_sess'])
+    plot_pstc(results['allconddf'], fname)
+    save_pstc(results['allconddf'], fname)
+    sessout = pupil_utils.get_outfile(fname, '_SessionData.csv')    
+    pupil_utils.to_csv_atomic(results['sessdf'], sessout, index=False)
+
+
+def proc_subject(filelist, glm_model='canonical', fit_subject_irf=False, dataset=None):
     """Given an infile of raw pupil data, saves out:
         1. Session level data with dilation data summarized for each trial
         2. Dataframe of average peristumulus timecourse for each condition
         3. Plot of average peristumulus timecourse for each condition
-        4. Percent of samples with blinks """
-    tpre = 0.5
-    tpost = 2.5
-    samp_rate = 30.
+        4. Percent of samples with blinks 
+        5. GLM results (and FIR estimates if glm_model is 'fir')
+        6. Epochs of all included trials
+        7. GLM input (signal, blinks and onsets) for refitting with pupil_glm.py
+    If fit_subject_irf is True, the canonical GLM uses the pupil irf shape 
+    fitted to each subject and fitted parameters are saved with GLM results."""
     for fname in filelist:
         print('Processing {}'.format(fname))
-        if (os.path.splitext(fname)[-1] == ".gazedata") | (os.path.splitext(fname)[-1] == ".csv"):
-            df = pd.read_csv(fname, sep="\t")
-        elif os.path.splitext(fname)[-1] == ".xlsx":
-            df = pd.read_excel(fname, parse_dates=False)
-        else: 
-            raise IOError('Could not open {}'.format(fname))   
-        subid = pupil_utils.get_subid(df['Subject'], fname)
-        timepoint = pupil_utils.get_timepoint(df['Session'], fname)
-        oddball_sess = get_oddball_session(fname)
-        df = pupil_utils.deblink(df)
-        dfresamp = pupil_utils.resamp_filt_data(df)
-        dfresamp['Condition'] = np.where(dfresamp.CRESP==5, 'Standard', 'Target')
-        pupil_utils.plot_qc(dfresamp, fname)
-        sessdf = get_sessdf(dfresamp)
-        sessdf['BlinkPct'] = get_blink_pct(dfresamp, fname)
-        dfresamp['zDiameterPupilLRFilt'] = pupil_utils.zscore(dfresamp['DiameterPupilLRFilt'])
-        sessdf, targdf, standdf = proc_all_trials(sessdf, dfresamp['zDiameterPupilLRFilt'], 
-                                                  tpre, tpost, samp_rate)
-        targdf_long = reshape_df(targdf)
-        standdf_long = reshape_df(standdf)
-        glm_results = ts_glm(dfresamp.zDiameterPupilLRFilt, 
-                             sessdf.loc[sessdf.Condition=='Target', 'Timestamp'],
-                             sessdf.loc[sessdf.Condition=='Standard', 'Timestamp'],
-                             dfresamp.BlinksLR)
-        # Set subject ID and session as (as type string)
-        glm_results['Subject'] = subid
-        glm_results['Session'] = timepoint
-        glm_results['OddballSession'] = oddball_sess
-        save_glm_results(glm_results, fname)
-        allconddf = standdf_long.append(targdf_long).reset_index(drop=True)
-        # Set subject ID and session as (as type string)
-        allconddf['Subject'] = subid
-        allconddf['Session'] = timepoint   
-        allconddf['OddballSession'] = oddball_sess
-        plot_pstc(allconddf, fname)
-        save_pstc(allconddf, fname)
-        # Set subject ID and session as (as type string)
-        sessdf['Subject'] = subid
-        sessdf['Session'] = timepoint   
-        sessdf['OddballSession'] = oddball_sess        
-        sessout = pupil_utils.get_outfile(fname, '_SessionData.csv')    
-        sessdf.to_csv(sessout, index=False)
+        session = load_session(fname)
+        write_session(process_session(session, glm_model, fit_subject_irf), dataset)
 
     
 if __name__ == '__main__':
@@ -286,13 +400,9 @@ if __name__ == '__main__':
               for target vs. non-targets. Processes single subject data and
               outputs csv files for use in further group analysis.""")
         
-        root = tkinter.Tk()
-        root.withdraw()
         # Select files to process
-        filelist = filedialog.askopenfilenames(parent=root,
-                                                    title='Choose Oddball pupil gazedata file to process',
-                                                    filetypes = (("gazedata files","*recoded.gazedata"),("all files","*.*")))
-        filelist = list(filelist)
+        filelist = pupil_utils.ask_filenames('Choose Oddball pupil gazedata file to process',
+                                             filetypes=(("gazedata files","*recoded.gazedata"),("all files","*.*")))
         # Run script
         proc_subject(filelist)
 
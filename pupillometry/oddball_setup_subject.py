@@ -23,14 +23,6 @@ from glob import glob
 import numpy as np
 import pupil_utils
 
-try:
-    # for Python2
-    import Tkinter as tkinter
-    import tkFileDialog as filedialog
-except ImportError:
-    # for Python3
-    import tkinter
-    from tkinter import filedialog
 
 def check_setup(rawdir):
     globstr = os.path.join(rawdir, '*recoded.gazedata')
@@ -93,7 +85,7 @@ def setup_subject(filelist):
         session = get_oddball_session(fname)
         df = recode_gaze_data(fname)
         newfile = rename_gaze_file(fname, subid, session)
-        df.to_csv(newfile, index=False, sep="\t")
+        pupil_utils.to_csv_atomic(df, newfile, index=False, sep="\t")
         print('Writing recoded data to {0}'.format(newfile))
 
 
@@ -107,12 +99,8 @@ if __name__ == '__main__':
                   3. Swaps correct response in gazedata file
                   4. Saves out new .gazedata file with "recoded" suffix""")
         
-        root = tkinter.Tk()
-        root.withdraw()
         # Select files to process
-        filelist = filedialog.askopenfilenames(parent=root,
-                                                    title='Choose raw oddball pupil gazedata file to recode')
-        filelist = list(filelist)
+        filelist = pupil_utils.ask_filenames('Choose raw oddball pupil gazedata file to recode')
         # Run script
         setup_subject(filelist)
 
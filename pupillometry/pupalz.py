@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Batch processing of PupAlz pupillometry tasks from the command line.
+
+    pupalz.py subject [options] <path> [<path> ...]
+    pupalz.py group [options] <data directory> [<data directory> ...]
+    pupalz.py make [options] <path> [<path> ...]
+    pupalz.py watch [options] <data directory> [<data directory> ...]
+    pupalz.py server serve|submit|ping|shutdown [options]
+    pupalz.py redcap --out <export.csv> [options] <data directory> [<data directory> ...]
+    pupalz.py glm --task oddball|stroop [options] <data directory> [<data directory> ...]
+
+Paths may be files, directories (searched recursively) or glob patterns.
+Input files of each task are recognized by the file name patterns in
+pupil_tasks.py, so a whole timepoint folder can be given and every task in
+it processed in one run. Subjects of all tasks are processed by a single
+pool of worker processes; task modules are imported once per worker. The
+make command rebuilds only stale setup, subject and group outputs (see
+pupil_make.py). The watch command keeps running and processes new sessions
+as they are uploaded (see pupil_watch.py). The server command runs or talks
+to a resident pool of warm workers (see pupil_server.py). The redcap command
+updates one REDCap export with the processed data of all tasks (see
+pupil_redcap.py). The glm command refits the session GLMs of all subjects
+from their cached GLM input (see pupil_glm.py).
+
+Examples:
+    # All unprocessed Stroop and oddball sessions of timepoint 2 on 8 cores
+    pupalz.py subject --task stroop --task oddball --timepoint 2 --pending \\
+        --jobs 8 "/data/PupAlz/Timepoint 2"
+    # Group summaries of oddball data
+    pupalz.py group --task oddball --jobs 4 "/data/PupAlz/Oddball processed"
+    # Cohort run that can be restarted where it stopped
+    pupalz.py subject --journal cohort.jsonl --resume --retries 2 --jobs 8 /data/PupAlz
+    # Read the next sessions and write outputs while others are processed
+    pupalz.py subject --pipeline --prefetch 4 --jobs 6 /data/PupAlz
+"""
+
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+import time
+import argparse
+import functools
+import importlib
+import traceback
+from multiprocessing import Pool
+import pupil_tasks
+import pupil_catalog
+import pupil_journal
+import pupil_pipeline
+
+
+def find_sessions(paths, tasks=None, timepoints=None, pending=False):
+    """Returns list of session metadata (see pupil_catalog.parse_session) for
+    input files of the given tasks and timepoints found in paths. If pending,
+    only sessions without an up to date output are returned."""
+    sessions = []
+    seen = set()
+    for fname in pupil_catalog.expand_paths(paths):
+        for task, match in pupil_tasks.match_tasks(fname):
+            if (tasks and task not in tasks) or (fname, task) in seen:
+                continue
+            seen.add((fname, task))
+            meta = pupil_catalog.parse_session(fname, task, match)
+            if timepoints and meta['timepoint'] not in timepoints:
+                continue
+            if pending:
+                status = pupil_catalog.get_status(pupil_catalog.file_mtime(fname),
+                                                  pupil_catalog.file_mtime(meta['output_path']))
+                if status == 'processed':
+                    continue
+            sessions.append(meta)
+    return sessions
+
+
+def run_subject(args):
+    """Runs proc_subject of task on one file. Defined at module level so it
+    can be sent to worker processes. Records the start in the journal if one
+    is given. Returns task, file, error message (None on success) and run
+    time in seconds."""
+    task, fname, journal, attempt, kwargs = args
+    if journal:
+        pupil_journal.record(journal, task, fname, 'running', attempt=attempt, pid=os.getpid())
+    start = time.time()
+    try:
+        module = pupil_tasks.get_task_module(task)
+        module.proc_subject([fname], **kwargs)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return task, fname, error, time.time() - start
+
+
+def run_subjects(sessions, jobs=1, catalog=None, journal=None, retries=0, backoff=30.,
+                 dataset=None):
+    """Processes sessions, in parallel if jobs > 1. Sessions that fail are
+    retried up to retries times, waiting backoff seconds before the first
+    retry and doubling the wait for each further one. Status of each session
+    is appended to journal (see pupil_journal.py) and, if a catalog is given,
+    recorded there. If dataset is given, samples of each session are also
+    written to the per-sample dataset there (see pupil_dataset.py). Returns
+    list of (task, file, error) of sessions that failed every attempt."""
+    tasks = sorted(set(sess['task'] for sess in sessions))
+    # Import task modules before starting workers so they are shared
+    for task in tasks:
+        pupil_tasks.get_task_module(task)
+    todo = [(sess['task'], sess['raw_path']) for sess in sessions]
+    if journal:
+        for task, fname in todo:
+            pupil_journal.record(journal, task, fname, 'pending')
+    pool = Pool(min(jobs, len(todo))) if jobs > 1 and len(todo) > 1 else None
+    failed = []
+    try:
+        for attempt in range(1, retries + 2):
+            if attempt > 1:
+                if not failed:
+                    break
+                wait = backoff * 2 ** (attempt - 2)
+                print('Retrying {0} failed sessions in {1:.0f} s (attempt {2} of {3})'.format(
+                    len(failed), wait, attempt, retries + 1))
+                time.sleep(wait)
+                todo = [(task, fname) for task, fname, _ in failed]
+                failed = []
+            kwargs = {'dataset': dataset} if dataset else {}
+            runs = [(task, fname, journal, attempt, kwargs) for task, fname in todo]
+            if pool is not None:
+                results = pool.imap_unordered(run_subject, runs)
+            else:
+                results = (run_subject(run) for run in runs)
+            for i, (task, fname, error, seconds) in enumerate(results):
+                print('[{0}/{1}] {2} {3} ({4:.1f} s){5}'.format(
+                    i + 1, len(runs), task, os.path.basename(fname), seconds,
+                    ' FAILED' if error else ''))
+                if error:
+                    failed.append((task, fname, error))
+                if journal:
+                    pupil_journal.record(journal, task, fname, 'failed' if error else 'done',
+                                         attempt=attempt, duration=seconds, error=error)
+                if catalog:
+                    pupil_catalog.mark_status(catalog, fname, task, 'failed' if error else 'processed')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    for task, fname, error in failed:
+        print('')
+        print('{0} failed on {1}:'.format(task, fname))
+        print(error)
+    return failed
+
+
+def _load(item):
+    task, fname = item
+    return pupil_tasks.get_task_module(task).load_session(fname)
+
+
+def _process(item, session):
+    return pupil_tasks.get_task_module(item[0]).process_session(session)
+
+
+def _write(item, results, dataset=None):
+    kwargs = {'dataset': dataset} if dataset else {}
+    pupil_tasks.get_task_module(item[0]).write_session(results, **kwargs)
+
+
+def run_pipelined(sessions, jobs=1, prefetch=2, catalog=None, journal=None, retries=0,
+                  backoff=30., dataset=None):
+    """Processes sessions with reading, processing and writing overlapped
+    (see pupil_pipeline.py). Only tasks whose module has load_session,
+    process_session and write_session can be run this way. Failed sessions
+    are retried as in run_subjects. Returns list of (task, file, error) of
+    sessions that failed every attempt."""
+    import matplotlib.pyplot as plt
+    # Figures are drawn in the writer thread
+    plt.switch_backend('agg')
+    items = [(sess['task'], sess['raw_path']) for sess in sessions]
+    if journal:
+        for task, fname in items:
+            pupil_journal.record(journal, task, fname, 'pending')
+    write = functools.partial(_write, dataset=dataset)
+    failed = []
+    for attempt in range(1, retries + 2):
+        if attempt > 1:
+            if not failed:
+                break
+            wait = backoff * 2 ** (attempt - 2)
+            print('Retrying {0} failed sessions in {1:.0f} s (attempt {2} of {3})'.format(
+                len(failed), wait, attempt, retries + 1))
+            time.sleep(wait)
+            items = [(task, fname) for task, fname, _ in failed]
+        done = []
+
+        def load(item):
+            if journal:
+                pupil_journal.record(journal, item[0], item[1], 'running', attempt=attempt,
+                                     pid=os.getpid())
+            return _load(item)
+
+        def on_done(item, error, seconds):
+            task, fname = item
+            done.append(item)
+            print('[{0}/{1}] {2} {3} ({4:.1f} s){5}'.format(
+                len(done), len(items), task, os.path.basename(fname), seconds,
+                ' FAILED' if error else ''))
+            if journal:
+                pupil_journal.record(journal, task, fname, 'failed' if error else 'done',
+                                     attempt=attempt, duration=seconds, error=error)
+            if catalog:
+                pupil_catalog.mark_status(catalog, fname, task, 'failed' if error else 'processed')
+
+        failed, _ = pupil_pipeline.run_pipeline(items, load, _process, write, prefetch=prefetch,
+                                                n_workers=jobs, write_depth=prefetch,
+                                                on_done=on_done)
+        failed = [(task, fname, error) for (task, fname), error in failed]
+    for task, fname, error in failed:
+        print('')
+        print('{0} failed on {1}:'.format(task, fname))
+        print(error)
+    return failed
+
+
+def supports_pipeline(task):
+    module = pupil_tasks.get_task_module(task)
+    return all(hasattr(module, func) for func in ('load_session', 'process_session', 'write_session'))
+
+
+def run_group(datadirs, tasks, jobs=1):
+    """Runs proc_group of each task on each data directory."""
+    failed = []
+    for task in tasks:
+        module = pupil_tasks.get_task_module(task, group=True)
+        kwargs = {'n_jobs': jobs} if pupil_tasks.TASKS[task].get('group_jobs') else {}
+        for datadir in datadirs:
+            print('Running {0} group processing on {1}'.format(task, datadir))
+            try:
+                module.proc_group(datadir, **kwargs)
+            except Exception:
+                failed.append((task, datadir, traceback.format_exc()))
+                print('{0} group processing failed on {1}:'.format(task, datadir))
+                print(failed[-1][2])
+    return failed
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Batch processing of PupAlz pupillometry tasks.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    tasks = sorted(pupil_tasks.TASKS)
+
+    subject = subparsers.add_parser('subject', help='Run subject level processing')
+    subject.add_argument('paths', nargs='+', help='Files, directories or glob patterns')
+    subject.add_argument('--task', action='append', choices=tasks,
+                         help='Task to process (repeatable, default all)')
+    subject.add_argument('--timepoint', action='append', type=int,
+                         help='Timepoint to process (repeatable, default all)')
+    subject.add_argument('--jobs', type=int, default=1, help='Number of worker processes')
+    subject.add_argument('--pending', action='store_true',
+                         help='Only process sessions without up to date output')
+    subject.add_argument('--catalog', help='Catalog database to update (see pupil_catalog.py)')
+    subject.add_argument('--list', action='store_true',
+                         help='List sessions that would be processed and exit')
+    subject.add_argument('--journal', help='Append status of each session to this file')
+    subject.add_argument('--resume', action='store_true',
+                         help='Skip sessions recorded as done in the journal')
+    subject.add_argument('--retries', type=int, default=0,
+                         help='Number of times to retry failed sessions')
+    subject.add_argument('--backoff', type=float, default=30.,
+                         help='Seconds to wait before the first retry, doubled for each further retry')
+    subject.add_argument('--pipeline', action='store_true',
+                         help='Overlap reading and writing of sessions with processing '
+                         '(oddball and stroop; other tasks are run as usual)')
+    subject.add_argument('--prefetch', type=int, default=2,
+                         help='Number of sessions read ahead and outputs queued for writing '
+                         'with --pipeline')
+    subject.add_argument('--dataset',
+                         help='Also write per-sample data to this partitioned dataset '
+                         '(see pupil_dataset.py)')
+
+    group = subparsers.add_parser('group', help='Run group level processing')
+    group.add_argument('datadirs', nargs='+', help='Directories with subject output')
+    group.add_argument('--task', action='append', choices=tasks, required=True,
+                       help='Task to process (repeatable)')
+    group.add_argument('--jobs', type=int, default=1, help='Number of worker processes')
+
+    make = subparsers.add_parser('make', help='Rebuild stale outputs (see pupil_make.py)',
+                                 add_help=False)
+    make.add_argument('make_args', nargs=argparse.REMAINDER)
+
+    watch = subparsers.add_parser('watch', help='Process new sessions as they are uploaded '
+                                  '(see pupil_watch.py)', add_help=False)
+    watch.add_argument('watch_args', nargs=argparse.REMAINDER)
+
+    server = subparsers.add_parser('server', help='Resident worker server (see pupil_server.py)',
+                                   add_help=False)
+    server.add_argument('server_args', nargs=argparse.REMAINDER)
+
+    redcap = subparsers.add_parser('redcap', help='Update REDCap export of all tasks '
+                                   '(see pupil_redcap.py)', add_help=False)
+    redcap.add_argument('redcap_args', nargs=argparse.REMAINDER)
+
+    glm = subparsers.add_parser('glm', help='Refit session GLMs from cached input '
+                                '(see pupil_glm.py)', add_help=False)
+    glm.add_argument('glm_args', nargs=argparse.REMAINDER)
+    return parser
+
+
+# Commands whose arguments are parsed by the module they run
+PASSTHROUGH = {'make': 'pupil_make', 'watch': 'pupil_watch', 'server': 'pupil_server',
+               'redcap': 'pupil_redcap', 'glm': 'pupil_glm'}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # Dispatched before parsing, argparse.REMAINDER does not accept options
+    # as the first remaining argument
+    if argv and argv[0] in PASSTHROUGH:
+        return importlib.import_module(PASSTHROUGH[argv[0]]).main(argv[1:])
+    args = get_parser().parse_args(argv)
+    if args.command == 'group':
+        failed = run_group(args.datadirs, args.task, jobs=args.jobs)
+        return 1 if failed else 0
+    if args.resume and not args.journal:
+        get_parser().error('--resume requires --journal')
+    if args.catalog:
+        pupil_catalog.crawl(args.catalog, [p for p in args.paths if os.path.isdir(p)])
+    sessions = find_sessions(args.paths, tasks=args.task, timepoints=args.timepoint,
+                             pending=args.pending)
+    if args.resume:
+        done = pupil_journal.completed(args.journal)
+        n_found = len(sessions)
+        sessions = [sess for sess in sessions if (sess['task'], sess['raw_path']) not in done]
+        print('Skipping {0} sessions completed in {1}'.format(n_found - len(sessions), args.journal))
+    print('Found {0} sessions to process'.format(len(sessions)))
+    if args.list:
+        for sess in sessions:
+            print('{task}\t{subject}\t{timepoint}\t{raw_path}'.format(**sess))
+        return 0
+    failed = []
+    if args.pipeline:
+        piped = [sess for sess in sessions if supports_pipeline(sess['task'])]
+        sessions_rest = [sess for sess in sessions if not supports_pipeline(sess['task'])]
+        if piped:
+            failed.extend(run_pipelined(piped, jobs=args.jobs, prefetch=args.prefetch,
+                                        catalog=args.catalog, journal=args.journal,
+                                        retries=args.retries, backoff=args.backoff,
+                                        dataset=args.dataset))
+    else:
+        sessions_rest = sessions
+    if sessions_rest:
+        failed.extend(run_subjects(sessions_rest, jobs=args.jobs, catalog=args.catalog,
+                                   journal=args.journal, retries=args.retries,
+                                   backoff=args.backoff, dataset=args.dataset))
+    print('Processed {0} sessions, {1} failed'.format(len(sessions), len(failed)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
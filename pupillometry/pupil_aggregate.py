@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming group averages of peristimulus timecourses (PSTC).
+
+Subject PSTC files are read one at a time and folded into running count, mean
+and sum of squared deviations (M2) for every (Condition, Timepoint) using
+Welford's algorithm, so memory does not grow with the number of subjects.
+Accumulators built from separate sets of files (e.g. in worker processes) are
+combined with the pairwise update of Chan et al. (1979). Given a contrast of
+two conditions, the accumulator also keeps each subject's difference
+timecourse, the input of the cluster permutation test in pupil_stats, so the
+files do not have to be read again and concatenated for it.
+
+Chan, T.F., Golub, G.H. & LeVeque, R.J. (1979). Updating formulae and a
+    pairwise algorithm for computing sample variances. Technical Report
+    STAN-CS-79-773, Stanford University.
+"""
+
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+
+
+class PSTCAccumulator(object):
+    """Running count, mean and M2 of a value for each key (by default
+    Condition and Timepoint). Each call to update adds one observation per key,
+    typically one subject's PSTC. If contrast is a pair of conditions, the
+    difference of their timecourses is kept for each subject (keys must be
+    Condition and Timepoint)."""
+
+    def __init__(self, keys=('Condition', 'Timepoint'), value_col='Dilation', decimals=6,
+                 contrast=None):
+        self.keys = list(keys)
+        self.value_col = value_col
+        self.decimals = decimals
+        self.contrast = contrast
+        self.diffs = []
+        self.stats = pd.DataFrame(columns=['N', 'Mean', 'M2'], dtype=np.float64)
+
+    def _combine(self, other):
+        """Pairwise merge of another stats frame into this one."""
+        if other.empty:
+            return
+        if self.stats.empty:
+            self.stats = other.astype(np.float64)
+            return
+        idx = self.stats.index.union(other.index)
+        a = self.stats.reindex(idx, fill_value=0.)
+        b = other.reindex(idx, fill_value=0.)
+        n = a.N + b.N
+        delta = b.Mean - a.Mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(n > 0, b.N / n, 0.)
+        combined = pd.DataFrame(index=idx)
+        combined['N'] = n
+        combined['Mean'] = a.Mean + delta * frac
+        combined['M2'] = a.M2 + b.M2 + delta**2 * a.N * frac
+        self.stats = combined
+
+    def update(self, pstcdf):
+        """Adds one subject's PSTC (long dataframe with key and value columns).
+        Rows with missing values are skipped. Duplicate keys are averaged."""
+        pstcdf = pstcdf.dropna(subset=[self.value_col])
+        if 'Timepoint' in self.keys:
+            pstcdf = pstcdf.assign(Timepoint=pstcdf.Timepoint.round(self.decimals))
+        means = pstcdf.groupby(self.keys)[self.value_col].mean()
+        obs = pd.DataFrame({'N': 1., 'Mean': means, 'M2': 0.}, index=means.index)
+        self._combine(obs)
+        if self.contrast is not None:
+            conditions = means.index.get_level_values('Condition')
+            cond1, cond2 = self.contrast
+            # Subjects missing a condition are left out of the contrast
+            if (conditions == cond1).any() and (conditions == cond2).any():
+                self.diffs.append(means.xs(cond1, level='Condition') - 
+                                  means.xs(cond2, level='Condition'))
+        return self
+
+    def merge(self, other):
+        """Adds the observations of another accumulator."""
+        self._combine(other.stats)
+        self.diffs.extend(other.diffs)
+        return self
+
+    def contrast_diffs(self):
+        """Returns (subjects x timepoints) array of the contrast differences 
+        and array of timepoints. Subjects missing any timepoint are dropped."""
+        if not self.diffs:
+            return np.empty((0, 0)), np.empty(0)
+        timepoints = self.diffs[0].index
+        for diff in self.diffs[1:]:
+            timepoints = timepoints.union(diff.index)
+        diffs = np.array([diff.reindex(timepoints).values for diff in self.diffs])
+        return diffs[~np.isnan(diffs).any(axis=1)], np.asarray(timepoints, dtype=np.float64)
+
+    def summary(self):
+        """Returns dataframe with N, Mean, SD and SEM for each key."""
+        summarydf = self.stats.copy()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            summarydf['SD'] = np.sqrt(np.where(summarydf.N > 1,
+                                               summarydf.M2 / (summarydf.N - 1), np.nan))
+            summarydf['SEM'] = summarydf.SD / np.sqrt(summarydf.N)
+        summarydf.N = summarydf.N.astype(int)
+        summarydf = summarydf.drop(columns='M2').sort_index()
+        summarydf.index.names = self.keys
+        return summarydf.reset_index()
+
+
+def _accumulate_chunk(args):
+    """Accumulates a list of files. Defined at module level so it can be sent
+    to worker processes."""
+    filelist, reader, kwargs = args
+    acc = PSTCAccumulator(**kwargs)
+    for sub_file in filelist:
+        subdf = reader(sub_file)
+        if subdf is not None:
+            acc.update(subdf)
+    return acc
+
+
+def accumulate_pstc(filelist, reader, n_jobs=1, **kwargs):
+    """Streams subject PSTC files into a PSTCAccumulator. Reader is a function
+    taking a filename and returning that subject's PSTC dataframe, or None to
+    exclude the subject. It must be defined at module level (or be a
+    functools.partial of one) when n_jobs > 1, in which case files are split
+    across processes and the partial accumulators merged. Keyword arguments
+    are passed to PSTCAccumulator."""
+    filelist = list(filelist)
+    if n_jobs > 1 and len(filelist) > 1:
+        chunks = [(filelist[i::n_jobs], reader, kwargs) for i in range(min(n_jobs, len(filelist)))]
+        pool = Pool(len(chunks))
+        try:
+            partials = pool.map(_accumulate_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        partials = [_accumulate_chunk((filelist, reader, kwargs))]
+    acc = partials[0]
+    for partial in partials[1:]:
+        acc.merge(partial)
+    return acc
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite catalog of raw and processed pupil sessions.
+
+The crawler walks data directories once and records one row per (raw file,
+task) with the subject, timepoint and oddball session parsed from the path,
+the expected processed output and the processing status:
+    - unprocessed: output does not exist
+    - processed: output exists and is newer than the raw file
+    - stale: output exists but is older than the raw file
+    - failed: set by batch runs with mark_status, cleared when the raw file
+      or output changes
+Later crawls only parse files that are new or whose modification time
+changed; files that no longer exist are removed. Tasks and file name
+patterns are defined in pupil_tasks.py.
+
+Batch runs and group scripts can then query the catalog, e.g. all
+unprocessed Stroop sessions at timepoint 2:
+    pending = pupil_catalog.query(db, task='stroop', timepoint=2,
+                                  status=['unprocessed', 'stale'])
+"""
+
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+import re
+import time
+import sqlite3
+from glob import glob
+import pandas as pd
+import pupil_tasks
+
+COLUMNS = ['raw_path', 'task', 'subject', 'timepoint', 'session', 'raw_mtime',
+           'output_path', 'output_mtime', 'status', 'updated']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    raw_path TEXT NOT NULL,
+    task TEXT NOT NULL,
+    subject TEXT,
+    timepoint INTEGER,
+    session TEXT,
+    raw_mtime REAL,
+    output_path TEXT,
+    output_mtime REAL,
+    status TEXT,
+    updated REAL,
+    PRIMARY KEY (raw_path, task)
+);
+CREATE INDEX IF NOT EXISTS sessions_task_tp ON sessions (task, timepoint, status);
+CREATE INDEX IF NOT EXISTS sessions_subject ON sessions (subject);
+"""
+
+
+def connect(db_path):
+    """Opens (and creates if needed) the catalog database."""
+    con = sqlite3.connect(db_path)
+    con.executescript(SCHEMA)
+    return con
+
+
+def file_mtime(path):
+    """Modification time of path, None if it does not exist."""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def get_status(raw_mtime, output_mtime):
+    """Processing status from modification times of raw file and output."""
+    if output_mtime is None:
+        return 'unprocessed'
+    elif output_mtime < raw_mtime:
+        return 'stale'
+    else:
+        return 'processed'
+
+
+def parse_session(raw_path, task, match):
+    """Metadata of one raw file for task. Timepoint comes from the Timepoint
+    folder in the path. Oddball session is coded A/B as in
+    oddball_proc_group.get_oddball_session, defaulting to A."""
+    tp = re.search(r'Timepoint (\d+)', raw_path, re.IGNORECASE)
+    timepoint = int(tp.group(1)) if tp else None
+    session = None
+    if task == 'oddball':
+        session = (match.group('session') or 'A').replace('1','A').replace('2','B')
+    output_path = pupil_tasks.output_path(task, raw_path)
+    return {'raw_path': raw_path, 'task': task, 'subject': match.group('subid'),
+            'timepoint': timepoint, 'session': session, 'output_path': output_path}
+
+
+def iter_files(datadirs):
+    """Yields absolute paths of all files below datadirs."""
+    for datadir in datadirs:
+        for root, dirs, files in os.walk(os.path.abspath(datadir)):
+            dirs.sort()
+            for fname in sorted(files):
+                yield os.path.join(root, fname)
+
+
+def expand_paths(paths):
+    """Expands directories (recursively) and glob patterns to list of files."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(iter_files([path]))
+        elif any(char in path for char in '*?['):
+            for fname in sorted(glob(path, recursive=True)):
+                if os.path.isdir(fname):
+                    files.extend(iter_files([fname]))
+                else:
+                    files.append(os.path.abspath(fname))
+        elif os.path.exists(path):
+            files.append(os.path.abspath(path))
+        else:
+            print('Skipping {}: file not found'.format(path))
+    return files
+
+
+def crawl(db_path, datadirs, verbose=True):
+    """Adds new sessions and updates changed sessions found in datadirs.
+    Rows of files under datadirs that no longer exist are removed. Returns
+    counts of added, updated, unchanged and removed rows."""
+    if isinstance(datadirs, str):
+        datadirs = [datadirs]
+    con = connect(db_path)
+    now = time.time()
+    known = {}
+    for row in con.execute('SELECT raw_path, task, raw_mtime, output_path, output_mtime, status '
+                           'FROM sessions'):
+        known[(row[0], row[1])] = row[2:]
+    counts = {'added': 0, 'updated': 0, 'unchanged': 0, 'removed': 0}
+    seen = set()
+    inserts, updates = [], []
+    for raw_path in iter_files(datadirs):
+        matches = pupil_tasks.match_tasks(raw_path)
+        if not matches:
+            continue
+        raw_mtime = file_mtime(raw_path)
+        for task, match in matches:
+            key = (raw_path, task)
+            seen.add(key)
+            if key in known and known[key][0] == raw_mtime:
+                # Raw file unchanged, only the output needs checking
+                _, output_path, output_mtime, status = known[key]
+                new_output_mtime = file_mtime(output_path)
+                if new_output_mtime == output_mtime:
+                    counts['unchanged'] += 1
+                    continue
+                updates.append((new_output_mtime, get_status(raw_mtime, new_output_mtime),
+                                now, raw_path, task))
+                counts['updated'] += 1
+                continue
+            meta = parse_session(raw_path, task, match)
+            meta['raw_mtime'] = raw_mtime
+            meta['output_mtime'] = file_mtime(meta['output_path'])
+            meta['status'] = get_status(raw_mtime, meta['output_mtime'])
+            meta['updated'] = now
+            inserts.append(tuple(meta[col] for col in COLUMNS))
+            counts['updated' if key in known else 'added'] += 1
+    roots = tuple(os.path.join(os.path.abspath(d), '') for d in datadirs)
+    removed = [key for key in known if key not in seen and key[0].startswith(roots)]
+    counts['removed'] = len(removed)
+    with con:
+        con.executemany('INSERT OR REPLACE INTO sessions ({0}) VALUES ({1})'.format(
+            ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))), inserts)
+        con.executemany('UPDATE sessions SET output_mtime=?, status=?, updated=? '
+                        'WHERE raw_path=? AND task=?', updates)
+        con.executemany('DELETE FROM sessions WHERE raw_path=? AND task=?', removed)
+    con.close()
+    if verbose:
+        print('Catalog {0}: {added} added, {updated} updated, {unchanged} unchanged, '
+              '{removed} removed'.format(db_path, **counts))
+    return counts
+
+
+def _in_clause(col, values, where, params):
+    """Adds condition that col equals value (or is in list of values)."""
+    if values is None:
+        return
+    if isinstance(values, (list, tuple, set)):
+        values = list(values)
+        where.append('{0} IN ({1})'.format(col, ', '.join('?' * len(values))))
+        params.extend(values)
+    else:
+        where.append('{0} = ?'.format(col))
+        params.append(values)
+
+
+def query(db_path, task=None, subject=None, timepoint=None, session=None, status=None):
+    """Returns dataframe of catalog rows matching all given filters. Each
+    filter may be a single value or a list of values."""
+    where, params = [], []
+    for col, values in (('task', task), ('subject', subject), ('timepoint', timepoint),
+                        ('session', session), ('status', status)):
+        _in_clause(col, values, where, params)
+    sql = 'SELECT {0} FROM sessions'.format(', '.join(COLUMNS))
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY task, timepoint, subject, session'
+    con = connect(db_path)
+    try:
+        return pd.read_sql_query(sql, con, params=params)
+    finally:
+        con.close()
+
+
+def pending_files(db_path, task, timepoint=None):
+    """Raw files of task that are unprocessed, stale or failed."""
+    df = query(db_path, task=task, timepoint=timepoint,
+               status=['unprocessed', 'stale', 'failed'])
+    return df.raw_path.tolist()
+
+
+def mark_status(db_path, raw_path, task, status):
+    """Records status (e.g. 'failed') of a session after a batch run. A
+    processed status also refreshes the output modification time."""
+    con = connect(db_path)
+    with con:
+        output_path = con.execute('SELECT output_path FROM sessions WHERE raw_path=? AND task=?',
+                                  (raw_path, task)).fetchone()
+        output_mtime = file_mtime(output_path[0]) if output_path else None
+        con.execute('UPDATE sessions SET status=?, output_mtime=?, updated=? '
+                    'WHERE raw_path=? AND task=?',
+                    (status, output_mtime, time.time(), raw_path, task))
+    con.close()
+
+
+def summarize(db_path):
+    """Number of sessions by task, timepoint and status."""
+    df = query(db_path)
+    if df.empty:
+        return df
+    return df.pivot_table(index=['task', 'timepoint'], columns='status', values='raw_path',
+                          aggfunc='count', fill_value=0)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('USAGE: {} <catalog file> <data directory> [<data directory> ...]'.format(
+            os.path.basename(sys.argv[0])))
+        print("""Crawls data directories for raw pupil files of all tasks listed in
+              pupil_tasks.py and records subject, timepoint, session, processed
+              output and processing status in an SQLite catalog. Only new or
+              changed files are parsed on later runs. Prints number of sessions
+              by task, timepoint and status.""")
+    else:
+        db_path = sys.argv[1]
+        crawl(db_path, sys.argv[2:])
+        print(summarize(db_path))
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Partitioned dataset of per-sample (30 Hz) pupil data, so cohort analyses do
+not need to concatenate all sessions in memory.
+
+Subject scripts called with dataset=<root> (pupalz.py subject --dataset)
+write the cleaned samples of each session to
+    <root>/task=<task>/timepoint=<timepoint>/subject=<subject>/<part>.parquet
+with hive style directory names. Parquet needs pyarrow; without it each
+partition is written as <part>.csv.gz instead and read the same way.
+Sample columns are those of SAMPLE_COLUMNS that the task has, with
+DiameterPupilLRFilt and BlinksLR renamed to Diameter and BlinkPct as in the
+processed outputs, and times converted to float seconds. Oddball and Stroop
+samples belong to the trial of the last onset before them, with Baseline and
+Dilation of the z-scored pupil as in their epochs.
+
+Group functions select partitions (task, timepoint, subject) from directory
+names and read one session at a time, or with pyarrow scan the selected
+files in record batches with row filters such as BLINK_FILTER pushed down to
+the parquet reader, so memory is bounded by a session or a batch rather than
+the cohort.
+Filters are lists of (column, op, value) with op one of OPS, all of which
+must hold.
+
+    pupil_dataset.py means <root> --task digitspan --by Load [--out means.csv]
+    pupil_dataset.py pstc <root> --task fluency --by Condition [--out pstc.csv]
+"""
+
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+import argparse
+import operator
+import numpy as np
+import pandas as pd
+import pupil_utils
+import pupil_aggregate
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    HAVE_PYARROW = True
+except ImportError:
+    HAVE_PYARROW = False
+
+PARTITION_KEYS = ['task', 'timepoint', 'subject']
+SAMPLE_COLUMNS = ['Trial', 'TrialId', 'Load', 'Condition', 'Phase', 'CurrentObject', 'Timestamp',
+                  'DiameterPupilLRFilt', 'BlinksLR', 'Baseline', 'Dilation']
+RENAME = {'DiameterPupilLRFilt': 'Diameter', 'BlinksLR': 'BlinkPct'}
+# Samples with 50% or more blinks are excluded, as in the group scripts
+BLINK_FILTER = [('BlinkPct', '<', .5)]
+OPS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+       '==': operator.eq, '!=': operator.ne}
+
+
+def partition_dir(root, task, timepoint, subject):
+    return os.path.join(root, 'task={0}'.format(task), 'timepoint={0}'.format(timepoint),
+                        'subject={0}'.format(subject))
+
+
+def write_samples(dfresamp, root, task, subject, timepoint, part='samples'):
+    """Writes samples of one session to its partition of the dataset at root,
+    replacing any earlier version. Part names the file within the partition,
+    e.g. the oddball session. Returns path of the written file."""
+    # Index levels that are also columns, e.g. Trial of clean_trials
+    repeated = [name for name in dfresamp.index.names if name in dfresamp.columns]
+    if repeated and len(repeated) < dfresamp.index.nlevels:
+        dfresamp = dfresamp.reset_index(level=repeated, drop=True)
+    df = dfresamp.reset_index().rename(columns={'index': 'Timestamp'})
+    df = df[[col for col in SAMPLE_COLUMNS if col in df.columns]].rename(columns=RENAME)
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = (df[col] - pd.Timestamp(0)) / pd.Timedelta(seconds=1)
+        elif pd.api.types.is_object_dtype(df[col]):
+            df[col] = df[col].astype(str)
+    outdir = partition_dir(root, task, timepoint, subject)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    if HAVE_PYARROW:
+        outfile = os.path.join(outdir, part + '.parquet')
+        with pupil_utils.atomic_write(outfile, 'wb') as f:
+            pq.write_table(pa.Table.from_pandas(df, preserve_index=False), f)
+    else:
+        outfile = os.path.join(outdir, part + '.csv.gz')
+        with pupil_utils.atomic_write(outfile, 'wb') as f:
+            df.to_csv(f, index=False, compression='gzip')
+    return outfile
+
+
+def _as_list(values):
+    if values is None:
+        return None
+    if not isinstance(values, (list, tuple, set)):
+        values = [values]
+    return [str(v) for v in values]
+
+
+def list_partitions(root, task=None, timepoint=None, subject=None):
+    """Returns list of (keys, file) of all partition files matching the given
+    task, timepoint and subject (single values or lists). Directories of
+    other partitions are not entered."""
+    wanted = dict(zip(PARTITION_KEYS, [_as_list(v) for v in (task, timepoint, subject)]))
+    found = [({}, root)]
+    for key in PARTITION_KEYS:
+        prefix = key + '='
+        level = []
+        for keys, path in found:
+            if not os.path.isdir(path):
+                continue
+            for name in sorted(os.listdir(path)):
+                value = name[len(prefix):]
+                if name.startswith(prefix) and (wanted[key] is None or value in wanted[key]):
+                    level.append((dict(keys, **{key: value}), os.path.join(path, name)))
+        found = level
+    partitions = []
+    for keys, path in found:
+        for fname in sorted(os.listdir(path)):
+            if fname.endswith(('.parquet', '.csv.gz')) and not fname.startswith('.'):
+                partitions.append((keys, os.path.join(path, fname)))
+    return partitions
+
+
+def apply_filters(df, filters):
+    """Rows of df for which all filters hold."""
+    if not filters:
+        return df
+    mask = np.ones(len(df), dtype=bool)
+    for col, op, value in filters:
+        mask &= OPS[op](df[col], value).values
+    return df[mask]
+
+
+def _expression(filters):
+    """Pyarrow filter expression requiring all filters."""
+    expr = None
+    for col, op, value in filters or []:
+        term = OPS[op](ds.field(col), value)
+        expr = term if expr is None else expr & term
+    return expr
+
+
+def read_partition(fname, columns=None, filters=None):
+    """Reads one partition file. With parquet, filters are applied while
+    reading and row groups that cannot match are skipped."""
+    if fname.endswith('.parquet'):
+        df = pq.read_table(fname, columns=columns, filters=filters or None).to_pandas()
+    else:
+        usecols = None
+        if columns is not None:
+            usecols = list(columns) + [c for c, _, _ in filters or [] if c not in columns]
+        df = apply_filters(pd.read_csv(fname, usecols=usecols), filters)
+        if columns is not None:
+            df = df[list(columns)]
+    return df.reset_index(drop=True)
+
+
+def iter_sessions(root, columns=None, filters=None, task=None, timepoint=None, subject=None):
+    """Yields (keys, dataframe) of each partition file matching task,
+    timepoint and subject, with rows filtered. Keys are task, timepoint and
+    subject of the partition."""
+    for keys, fname in list_partitions(root, task, timepoint, subject):
+        yield keys, read_partition(fname, columns, filters)
+
+
+def iter_batches(root, columns=None, filters=None, task=None, timepoint=None, subject=None,
+                 batch_size=262144):
+    """Yields dataframes of at most batch_size filtered rows with partition
+    keys as columns. Partitions are selected from directory names. Parquet
+    files are scanned as one dataset with the row filters pushed down to the
+    reader, files written without pyarrow are read one session at a time."""
+    partitions = list_partitions(root, task, timepoint, subject)
+    files = [fname for _, fname in partitions if fname.endswith('.parquet')]
+    # Sessions written without pyarrow are read one at a time
+    for keys, fname in partitions:
+        if fname.endswith('.parquet'):
+            continue
+        df = read_partition(fname, columns, filters)
+        for key in PARTITION_KEYS:
+            df[key] = keys[key]
+        yield df
+    if not files:
+        return
+    partitioning = ds.partitioning(pa.schema([(key, pa.string()) for key in PARTITION_KEYS]),
+                                   flavor='hive')
+    dataset = ds.dataset(files, format='parquet', partitioning=partitioning,
+                         partition_base_dir=root)
+    if columns is not None:
+        columns = list(columns) + [key for key in PARTITION_KEYS if key not in columns]
+    scanner = dataset.scanner(columns=columns, filter=_expression(filters), batch_size=batch_size)
+    for batch in scanner.to_batches():
+        if batch.num_rows:
+            yield batch.to_pandas()
+
+
+def condition_means(root, by, value_cols=('Dilation', 'Baseline', 'Diameter', 'BlinkPct'),
+                    filters=BLINK_FILTER, per_subject=True, **partitions):
+    """Means of value_cols within levels of by (and task, timepoint and
+    subject if per_subject) over all matching samples, with number of
+    samples in N. Sums and counts are accumulated batch by batch."""
+    by = list(by) if isinstance(by, (list, tuple)) else [by]
+    keys = PARTITION_KEYS + by if per_subject else ['task', 'timepoint'] + by
+    value_cols = list(value_cols)
+    sums, counts = None, None
+    for batch in iter_batches(root, columns=by + value_cols, filters=filters, **partitions):
+        grouped = batch.groupby(keys)[value_cols]
+        batch_sums, batch_counts = grouped.sum(), grouped.count()
+        if sums is None:
+            sums, counts = batch_sums, batch_counts
+        else:
+            sums = sums.add(batch_sums, fill_value=0)
+            counts = counts.add(batch_counts, fill_value=0)
+    if sums is None:
+        return pd.DataFrame(columns=keys + value_cols + ['N'])
+    means = sums / counts.replace(0, np.nan)
+    means['N'] = counts.max(axis=1).astype(int)
+    return means.reset_index()
+
+
+def pstc(root, by='Condition', time_col='Timestamp', value_col='Dilation', filters=BLINK_FILTER,
+         decimals=3, **partitions):
+    """Group peristimulus timecourse: each session's mean of value_col at
+    each time (rounded to decimals) within levels of by, averaged over
+    sessions with pupil_aggregate.PSTCAccumulator. Returns N, Mean, SD and
+    SEM for each timepoint, level and dataset timepoint."""
+    by = list(by) if isinstance(by, (list, tuple)) else [by]
+    acc = pupil_aggregate.PSTCAccumulator(keys=['timepoint'] + by + ['Time'], value_col=value_col)
+    for keys, df in iter_sessions(root, columns=by + [time_col, value_col], filters=filters,
+                                  **partitions):
+        df['Time'] = df[time_col].round(decimals)
+        df['timepoint'] = keys['timepoint']
+        acc.update(df)
+    return acc.summary()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Group summaries of the per-sample dataset.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    for name, helptext in (('means', 'Condition means per subject'),
+                           ('pstc', 'Group peristimulus timecourse')):
+        sub = subparsers.add_parser(name, help=helptext)
+        sub.add_argument('root', help='Dataset directory')
+        sub.add_argument('--task', required=True)
+        sub.add_argument('--timepoint', action='append', help='Timepoint (repeatable, default all)')
+        sub.add_argument('--by', action='append', required=True, help='Condition column (repeatable)')
+        sub.add_argument('--all-samples', action='store_true',
+                         help='Keep samples with 50%% or more blinks')
+        sub.add_argument('--out', help='Output csv (default print)')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    filters = None if args.all_samples else BLINK_FILTER
+    func = condition_means if args.command == 'means' else pstc
+    result = func(args.root, by=args.by, filters=filters, task=args.task, timepoint=args.timepoint)
+    if args.out:
+        pupil_utils.to_csv_atomic(result, args.out, index=False)
+    else:
+        print(result.to_string(index=False))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
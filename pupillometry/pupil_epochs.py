@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Functions to cut pupil timeseries into trial epochs and summarize them. Epochs
+are held in a single (trials x samples) array padded with nan, so trial level
+metrics are computed for all trials at once rather than one trial at a time:
+    - DilationMean, DilationMax, DilationSD, ConstrictionMax over the epoch
+    - PeakLatency: time of maximum dilation after onset
+    - HalfPeakLatency: first time after onset dilation reaches half of peak
+    - AUC: area under the dilation curve after onset
+    - Mean dilation within user-defined time windows
+"""
+
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import pandas as pd
+
+
+def epoch_times(tpre, tpost, samp_rate):
+    """Time (sec) of each sample in an epoch relative to onset. Matches the
+    index used for peristimulus timecourse dataframes."""
+    postidx = np.arange(0, tpost + .0001, 1/samp_rate)
+    preidx = np.arange(0, -1*(tpre + 0.0001), -1/samp_rate)
+    return np.sort(np.unique(np.append(postidx, preidx)))
+
+
+def _take(signal, idx):
+    """Index signal with a 2-d array of indices, nan where index is out of range."""
+    valid = (idx >= 0) & (idx < len(signal))
+    return np.where(valid, signal[np.clip(idx, 0, len(signal) - 1)], np.nan)
+
+
+def _nanmean(x, axis=-1):
+    """Mean ignoring nan. Returns nan without warning when all values are nan."""
+    count = np.sum(~np.isnan(x), axis=axis)
+    total = np.nansum(x, axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan)
+
+
+def match_onsets(index, trials, time_col='Timestamp', trial_col='TrialId'):
+    """Sample index of the onset (time_col) of each trial in index, the index 
+    of the session timeseries. Trials whose onset is not a sample of the 
+    session are dropped and reported. Returns remaining trials and their 
+    onset indices."""
+    onset_idx = index.get_indexer(trials[time_col])
+    missing = onset_idx < 0
+    if missing.any():
+        print('{0} trials have no sample at their onset and were skipped: {1}'.format(
+                missing.sum(), list(trials.loc[missing, trial_col])))
+    return trials[~missing], onset_idx[~missing]
+
+
+def get_epochs(signal, onset_idx, tpre, tpost, samp_rate):
+    """Given pupil dilations for the entire session and the sample index of
+    each trial onset, returns array of baselined epochs with shape
+    (trials, samples) and the time of each sample relative to onset. Baseline
+    is the mean of the tpre seconds prior to onset. Samples falling outside
+    the session are nan."""
+    signal = np.asarray(signal, dtype=np.float64)
+    onset_idx = np.asarray(onset_idx, dtype=np.int64)[:, np.newaxis]
+    times = epoch_times(tpre, tpost, samp_rate)
+    n_pre = int(np.sum(times < 0))
+    n_post = len(times) - n_pre - 1
+    epochs = _take(signal, onset_idx + np.arange(-n_pre, n_post + 1))
+    baseline = onset_baselines(signal, onset_idx[:, 0], tpre, samp_rate)
+    epochs = epochs - baseline[:, np.newaxis]
+    return epochs, times
+
+
+def onset_baselines(signal, onset_idx, tpre, samp_rate):
+    """Mean of signal in the tpre seconds prior to each onset."""
+    signal = np.asarray(signal, dtype=np.float64)
+    onset_idx = np.asarray(onset_idx, dtype=np.int64)[:, np.newaxis]
+    n_baseline = int(np.ceil(tpre*samp_rate - 1e-6))
+    return _nanmean(_take(signal, onset_idx + np.arange(-n_baseline, 0)))
+
+
+def trial_samples(signal, trials, tpre, samp_rate, columns=('TrialId', 'Condition'),
+                  time_col='Timestamp'):
+    """Trial columns of every sample of signal, the session timeseries. A
+    sample belongs to the last trial whose onset (time_col) is at or before
+    it; samples before the first onset and trials whose onset is not a sample
+    are left out. Baseline is the mean of the tpre seconds prior to the
+    trial's onset, as in get_epochs, and Dilation is signal minus Baseline.
+    Returns dataframe with the index of signal."""
+    onset_idx = signal.index.get_indexer(trials[time_col])
+    order = np.argsort(onset_idx, kind='mergesort')
+    order = order[onset_idx[order] >= 0]
+    trials, onset_idx = trials.iloc[order], onset_idx[order]
+    trial_idx = np.searchsorted(onset_idx, np.arange(len(signal)), side='right') - 1
+    in_trial = trial_idx >= 0
+    trial_idx = np.clip(trial_idx, 0, None)
+    samples = pd.DataFrame(np.nan, index=signal.index, columns=list(columns) + ['Baseline'])
+    if len(trials):
+        for col in columns:
+            values = pd.Series(trials[col].values[trial_idx], index=signal.index)
+            samples[col] = values.where(in_trial)
+        baseline = onset_baselines(signal.values, onset_idx, tpre, samp_rate)
+        samples['Baseline'] = np.where(in_trial, baseline[trial_idx], np.nan)
+    samples['Dilation'] = signal.values - samples['Baseline'].values
+    return samples
+
+
+def epochs_from_bounds(signal, starts, stops):
+    """Cuts signal into variable length trials given start (inclusive) and stop
+    (exclusive) sample indices. Returns array with shape (trials, longest
+    trial), padded with nan at the end of shorter trials."""
+    signal = np.asarray(signal, dtype=np.float64)
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.asarray(stops, dtype=np.int64)
+    lengths = stops - starts
+    offsets = np.arange(lengths.max() if len(lengths) else 0)
+    idx = starts[:, np.newaxis] + offsets
+    epochs = _take(signal, idx)
+    epochs[offsets >= lengths[:, np.newaxis]] = np.nan
+    return epochs
+
+
+def window_name(window):
+    """Column name for the mean dilation in a window given in seconds."""
+    return 'DilationMean_{0:d}_{1:d}ms'.format(int(round(window[0]*1000)),
+                                                int(round(window[1]*1000)))
+
+
+def epoch_metrics(epochs, times, windows=()):
+    """Calculates trial level metrics from epochs with shape (trials, samples)
+    and the time of each sample relative to onset. Nan samples (e.g. blinks,
+    end of session) are ignored. DilationMean, DilationMax, DilationSD and
+    ConstrictionMax are computed over the whole epoch. PeakLatency,
+    HalfPeakLatency and AUC use samples at or after onset. Windows is a list
+    of (start, stop) times in seconds; mean dilation is calculated for samples
+    within each window (inclusive). Returns dataframe with one row per trial."""
+    epochs = np.atleast_2d(np.asarray(epochs, dtype=np.float64))
+    times = np.asarray(times, dtype=np.float64)
+    valid = ~np.isnan(epochs)
+    count = valid.sum(axis=1)
+    has_data = count > 0
+    metrics = pd.DataFrame(index=np.arange(epochs.shape[0]))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        metrics['DilationMean'] = _nanmean(epochs)
+        metrics['DilationMax'] = np.where(has_data, np.fmax.reduce(epochs, axis=1), np.nan)
+        sqdev = np.where(valid, epochs - metrics['DilationMean'].values[:, np.newaxis], 0.)
+        metrics['DilationSD'] = np.where(count > 1, np.sqrt((sqdev**2).sum(axis=1) / (count - 1)), np.nan)
+        metrics['ConstrictionMax'] = np.where(has_data, np.fmin.reduce(epochs, axis=1), np.nan)
+        # Metrics of the response after onset
+        post = epochs[:, times >= 0]
+        post_times = times[times >= 0]
+        post_valid = ~np.isnan(post)
+        post_has_data = post_valid.any(axis=1)
+        peak_idx = np.argmax(np.where(post_valid, post, -np.inf), axis=1)
+        peak = post[np.arange(post.shape[0]), peak_idx]
+        metrics['PeakLatency'] = np.where(post_has_data, post_times[peak_idx], np.nan)
+        reached = post >= (peak / 2.)[:, np.newaxis]
+        half_idx = np.argmax(reached, axis=1)
+        metrics['HalfPeakLatency'] = np.where(post_has_data & (peak > 0), post_times[half_idx], np.nan)
+        # Trapezoid rule using only intervals where both samples are present
+        dt = np.diff(post_times)
+        segments = (post[:, 1:] + post[:, :-1]) / 2. * dt
+        metrics['AUC'] = np.where(post_has_data, np.nansum(segments, axis=1), np.nan)
+        for window in windows:
+            in_window = (times >= window[0] - 1e-9) & (times <= window[1] + 1e-9)
+            metrics[window_name(window)] = _nanmean(epochs[:, in_window])
+    return metrics
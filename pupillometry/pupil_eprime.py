@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Reads E-Prime exports (E-DataAid tab delimited text, saved with a .csv
+extension) and aligns their trials to the trials of the gaze data.
+
+Exports may be UTF-16 (the E-DataAid default), UTF-8 or a single byte
+encoding, and the header may follow a line holding the file name. Both are
+found from the first few kilobytes, and only the columns that are needed are
+parsed. The parsed frame is cached with its dtypes in the processed data
+folder of the export (<export>.pkl, see pupil_utils.proc_outfile_path) and
+reused as long as the export keeps its size and modification time and the
+same columns are requested.
+
+Trials are aligned on time: the offset between the E-Prime clock and the
+gaze clock is the difference between onsets shared by most trials, and each
+gaze trial is then matched to the nearest shifted E-Prime onset with
+pd.merge_asof, so a trial missing from either recording does not shift the
+others. If the export has no onset times, trials are matched on TrialId.
+"""
+
+from __future__ import division, print_function, absolute_import
+import os
+import re
+import codecs
+import numpy as np
+import pandas as pd
+import pupil_utils
+try:
+    # for Python2
+    import cPickle as pickle
+except ImportError:
+    # for Python3
+    import pickle
+
+HEADER_COLUMNS = ['ExperimentName', 'Subject', 'Session']
+# Columns read from Stroop exports; patterns are regular expressions
+STROOP_COLUMNS = ['Subject', 'Session', 'TrialList.Sample', 'Congruency', 'Stimulus.OnsetTime']
+STROOP_PATTERNS = [r'^Stimulus.*RT$']
+BOMS = [(codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'),
+        (codecs.BOM_UTF16_BE, 'utf-16')]
+
+
+def sniff_encoding(head):
+    """Encoding of a text file from its first bytes: byte order mark, else
+    UTF-16 if every other byte is null, else UTF-8 if the bytes decode, else
+    cp1252."""
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return encoding
+    even, odd = head[0::2], head[1::2]
+    if odd and odd.count(b'\x00') > .9 * len(odd):
+        return 'utf-16-le'
+    if even and even.count(b'\x00') > .9 * len(even):
+        return 'utf-16-be'
+    try:
+        # A multibyte character may be cut at the end of head
+        head[:-4].decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'cp1252'
+
+
+def sniff_header(fname, nbytes=8192, sep='\t'):
+    """Encoding, number of lines before the header and column names of an
+    E-Prime export. The header is the first line starting with the
+    HEADER_COLUMNS."""
+    with open(fname, 'rb') as f:
+        head = f.read(nbytes)
+    encoding = sniff_encoding(head)
+    lines = head.decode(encoding, 'ignore').lstrip(u'\ufeff').splitlines()
+    # The last line may be cut
+    for i, line in enumerate(lines[:-1]):
+        columns = [col.strip('"') for col in line.split(sep)]
+        if columns[:len(HEADER_COLUMNS)] == HEADER_COLUMNS:
+            return encoding, i, columns
+    raise IOError('Could not find E-Prime header in {0}'.format(fname))
+
+
+def select_columns(header, columns=(), patterns=()):
+    """Columns of header that are listed in columns or match one of patterns,
+    in header order."""
+    return [col for col in header
+            if col in columns or any(re.search(pattern, col) for pattern in patterns)]
+
+
+def cache_path(fname):
+    """Cache file of an export, kept with the processed data rather than
+    in the raw data folder."""
+    return pupil_utils.proc_outfile_path(fname, '.pkl')
+
+
+def _load_cache(fname, key):
+    """Cached frame of fname if it was written for the same export and
+    columns, else None."""
+    cachefile = cache_path(fname)
+    if not os.path.exists(cachefile):
+        return None
+    try:
+        with open(cachefile, 'rb') as f:
+            cached = pickle.load(f)
+    except Exception:
+        return None
+    if cached.get('key') != key:
+        return None
+    return cached['df']
+
+
+def _save_cache(fname, key, df):
+    try:
+        cachefile = pupil_utils.get_proc_outfile(fname, '.pkl')
+        with pupil_utils.atomic_write(cachefile, 'wb') as f:
+            pickle.dump({'key': key, 'df': df}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except (IOError, OSError) as err:
+        # E.g. a read-only processed folder, the export is parsed again next time
+        print('Could not cache {0}: {1}'.format(fname, err))
+
+
+def read_eprime(fname, columns=STROOP_COLUMNS, patterns=STROOP_PATTERNS, cache=True):
+    """Reads the listed columns and those matching patterns from an E-Prime
+    export. Columns that the export does not have are left out. With cache,
+    the parsed frame is stored with the processed data of the export and read
+    from there while the export is unchanged."""
+    stat = os.stat(fname)
+    key = (stat.st_size, stat.st_mtime, tuple(columns), tuple(patterns))
+    if cache:
+        df = _load_cache(fname, key)
+        if df is not None:
+            return df
+    encoding, skiprows, header = sniff_header(fname)
+    usecols = select_columns(header, columns, patterns)
+    df = pd.read_csv(fname, sep='\t', encoding=encoding, skiprows=skiprows, usecols=usecols)
+    df = df[usecols]
+    if cache:
+        _save_cache(fname, key, df)
+    return df
+
+
+def estimate_offset(gaze_onsets, eprime_onsets, tolerance=.25):
+    """Offset (sec) to add to E-Prime onsets to put them on the gaze clock.
+    Every pair of gaze and E-Prime onsets gives a candidate offset; the true
+    offset is shared by the pairs of all trials present in both, so it is
+    the median of the largest group of candidates within tolerance. Returns
+    offset and number of trials in that group."""
+    gaze_onsets = np.asarray(gaze_onsets, dtype=np.float64)
+    eprime_onsets = np.asarray(eprime_onsets, dtype=np.float64)
+    diffs = np.sort((gaze_onsets[:, np.newaxis] - eprime_onsets[np.newaxis, :]).ravel())
+    if len(diffs) == 0:
+        return np.nan, 0
+    counts = np.searchsorted(diffs, diffs + tolerance, side='right') - np.arange(len(diffs))
+    best = np.argmax(counts)
+    return float(np.median(diffs[best:best + counts[best]])), int(counts[best])
+
+
+def align_trials(gaze_onsets, eprime, onset_col='Stimulus.OnsetTime', trial_col='TrialList.Sample',
+                 tolerance=.25, min_matched=.5):
+    """Rows of eprime matched to each gaze trial. Gaze_onsets is a series of
+    onset times (sec) indexed by TrialId; E-Prime onsets are in msec. Trials
+    are matched on time with merge_asof (see estimate_offset); without
+    onset_col, or if fewer than min_matched of the trials line up, they are
+    matched on TrialId = trial_col. Returns eprime columns indexed by
+    TrialId, with nan for gaze trials without a match."""
+    if onset_col in eprime.columns:
+        eprime_onsets = eprime[onset_col].astype(np.float64) / 1000.
+        offset, n_matched = estimate_offset(gaze_onsets.dropna().values,
+                                            eprime_onsets.dropna().values, tolerance)
+        n_trials = min(gaze_onsets.notnull().sum(), eprime_onsets.notnull().sum())
+        if n_matched >= min_matched * n_trials and n_matched > 0:
+            gaze = pd.DataFrame({'TrialId': gaze_onsets.index.values,
+                                 'Onset': gaze_onsets.values.astype(np.float64)})
+            gaze = gaze.dropna(subset=['Onset']).sort_values('Onset')
+            shifted = eprime.assign(Onset=eprime_onsets + offset).dropna(subset=['Onset'])
+            shifted = shifted.sort_values('Onset')
+            aligned = pd.merge_asof(gaze, shifted, on='Onset', direction='nearest',
+                                    tolerance=tolerance)
+            n_found = aligned[onset_col].notnull().sum()
+            if n_found < len(gaze) or n_found < len(shifted):
+                print('Matched {0} of {1} gaze and {2} E-Prime trials on onset time'.format(
+                        n_found, len(gaze), len(shifted)))
+            aligned = aligned.set_index('TrialId').drop(columns='Onset')
+            return aligned.reindex(gaze_onsets.index)
+        print('E-Prime onsets do not line up with gaze onsets, matching trials on TrialId')
+    if len(eprime) != len(gaze_onsets):
+        print('Number of trials in pupil data ({0}) and eprime data ({1}) do not match'.format(
+                len(gaze_onsets), len(eprime)))
+    aligned = eprime.set_index(eprime[trial_col].values)
+    aligned.index.name = 'TrialId'
+    return aligned.reindex(gaze_onsets.index)
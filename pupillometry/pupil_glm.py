@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Refits the session GLM of oddball and stroop for all subjects at once from
+the GLM input cached by the subject scripts
+(<session>-<subject>_GLMinput.npz: cleaned signal, blinks, sample times,
+exact onsets of each condition, the model of the subject GLM and the irf
+parameters of sessions processed with fit_subject_irf), so a new contrast set
+or nuisance model does not require reprocessing raw data.
+
+Designs are built as in ts_glm of the subject scripts: intercept, canonical
+pupil irf regressors of each condition (event_design_precise) and blinks,
+optionally followed by the temporal derivative of blinks. Sessions whose
+subject GLM was fit with another model (glm_model 'fir') are skipped with a
+warning. Irf kernels are memoized by pupil_utils, so sessions with the same
+irf share them. Sessions with the same number of samples are stacked into one
+(sessions x samples x regressors) array, prewhitened for AR(1) noise and fit
+together by batched normal equations. By default this is the model of ts_glm,
+nistats ARModel(X, rho=1.): the first sample is kept and every later sample
+is differenced with the one before it. With rho=None (--estimate-rho) rho is
+instead estimated for each session as the lag-1 autocorrelation of its OLS
+residuals, as in pupil_utils.fit_ar1, so results differ from the subject
+GLM. The contrasts declared for the task in pupil_tasks.TASKS are compiled
+against the design columns and evaluated for all sessions of a batch at once.
+
+Output is a tidy table with one row per session and contrast: Subject,
+Session (and OddballSession), Contrast, Beta, SE, T, pval, DOF and Rho.
+
+    pupil_glm.py <data directory> [...] --task oddball [--blink-deriv] [--out glm.csv]
+"""
+
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+import argparse
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from scipy import stats
+import pupil_utils
+import pupil_tasks
+
+TASKS = {
+    'oddball': {
+        'conditions': ['Target', 'Standard'],
+        'kernel_end_sec': 2.5,
+        'irf': {'s1': 50000., 'n1': 10.1, 'tmax': 0.930},
+        'keys': ['Subject', 'Session', 'OddballSession'],
+        },
+    'stroop': {
+        'conditions': ['Incongruent', 'Congruent', 'Neutral'],
+        'kernel_end_sec': 3.,
+        'irf': {'s1': 1000., 'n1': 10.1, 'tmax': 1.30},
+        'keys': ['Subject', 'Session'],
+        },
+    }
+KEY_FIELDS = {'Subject': 'subject', 'Session': 'session', 'OddballSession': 'oddball_session'}
+
+
+def load_inputs(datadirs, task, suffix='_GLMinput.npz'):
+    """Loads GLM input of all sessions of task found (recursively) in
+    datadirs. Sessions whose subject GLM was not canonical (e.g. glm_model
+    'fir') are skipped with a warning. Returns list of dictionaries, one per
+    session."""
+    conditions = TASKS[task]['conditions']
+    sub_files = []
+    for datadir in datadirs:
+        for dirpath, _, filenames in os.walk(datadir):
+            sub_files.extend(os.path.join(dirpath, f) for f in filenames if f.endswith(suffix))
+    inputs = []
+    for sub_file in sorted(sub_files):
+        with np.load(sub_file) as npz:
+            # Files of the other task have other conditions
+            if list(npz['conditions']) != conditions:
+                continue
+            # Older files have no glm_model and were all fit with the canonical irf
+            glm_model = str(npz['glm_model']) if 'glm_model' in npz.files else 'canonical'
+            if glm_model != 'canonical':
+                print('Skipping {0}: session GLM was fit with the {1} model, refits use '
+                      'the canonical irf'.format(sub_file, glm_model))
+                continue
+            inputs.append(dict((key, npz[key]) for key in npz.files))
+            inputs[-1]['fname'] = sub_file
+    return inputs
+
+
+def design_columns(task, blink_deriv=False):
+    """Names of the columns of designs built by build_design."""
+    columns = ['Intercept'] + TASKS[task]['conditions'] + ['Blinks']
+    return columns + ['BlinkDeriv'] if blink_deriv else columns
+
+
+def build_design(glm_input, task, blink_deriv=False, upsample_rate=1000.):
+    """Design of one session: intercept, event regressors of each condition,
+    blinks and, if blink_deriv, the temporal derivative of blinks. The irf
+    parameters fit to the session are used if it has them."""
+    spec = TASKS[task]
+    irf = dict(spec['irf'])
+    irf.update((k, float(glm_input['irf_' + k])) for k in ('n1', 'tmax') if 'irf_' + k in glm_input)
+    onsets = [glm_input['onsets_' + cond] for cond in spec['conditions']]
+    event_regs, outside = pupil_utils.event_design_precise(onsets, glm_input['times'],
+                                                           kernel_end_sec=spec['kernel_end_sec'],
+                                                           upsample_rate=upsample_rate, **irf)
+    pupil_utils.print_outside_onsets(outside, spec['conditions'])
+    blinks = glm_input['blinks']
+    columns = [np.ones_like(blinks), event_regs, blinks]
+    if blink_deriv:
+        columns.append(np.gradient(blinks))
+    return np.column_stack(columns)
+
+
+def contrast_matrix(task, blink_deriv=False):
+    """Contrast names and matrix (contrasts x regressors) of the contrasts
+    declared for task in pupil_tasks."""
+    return pupil_utils.compile_contrasts(pupil_tasks.TASKS[task]['contrasts'],
+                                         design_columns(task, blink_deriv))
+
+
+def _batch_normal_lstsq(X, Y):
+    """Least squares fit of each session of stacked designs X (sessions x
+    samples x regressors) and data Y (sessions x samples) through the normal
+    equations, as pupil_utils._normal_lstsq."""
+    XtX = np.einsum('bni,bnj->bij', X, X)
+    XtX_inv = np.linalg.pinv(XtX, hermitian=True)
+    beta = np.einsum('bij,bj->bi', XtX_inv, np.einsum('bni,bn->bi', X, Y))
+    rank = np.linalg.matrix_rank(XtX, hermitian=True)
+    return beta, XtX_inv, rank
+
+
+def _batch_ar1_whiten(X, Y, rho):
+    """Prewhitens each session for AR(1) noise with its own rho as nistats
+    ARModel does: x[t] - rho*x[t-1], with the first sample unchanged."""
+    Xw = X.copy()
+    Yw = Y.copy()
+    Xw[:, 1:] -= rho[:, np.newaxis, np.newaxis] * X[:, :-1]
+    Yw[:, 1:] -= rho[:, np.newaxis] * Y[:, :-1]
+    return Xw, Yw
+
+
+def batch_fit_ar1(X, Y, rho=1.):
+    """AR(1) fit of stacked sessions. With the default rho this is the fit
+    of ARModel(X, rho=1.) in ts_glm for every session. If rho is None it is
+    estimated for each session as the lag-1 autocorrelation of its OLS
+    residuals. Returns dict with beta (sessions x regressors), cov (sessions
+    x regressors x regressors), dof, rho and sigma2 (one per session)."""
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    if rho is None:
+        beta, _, _ = _batch_normal_lstsq(X, Y)
+        resid = Y - np.einsum('bni,bi->bn', X, beta)
+        rho = np.sum(resid[:, 1:] * resid[:, :-1], axis=1) / np.sum(resid * resid, axis=1)
+    else:
+        rho = np.full(X.shape[0], float(rho))
+    Xw, Yw = _batch_ar1_whiten(X, Y, rho)
+    beta, XtX_inv, rank = _batch_normal_lstsq(Xw, Yw)
+    resid = Yw - np.einsum('bni,bi->bn', Xw, beta)
+    dof = X.shape[1] - rank
+    sigma2 = np.sum(resid * resid, axis=1) / dof
+    return {'beta': beta, 'cov': sigma2[:, np.newaxis, np.newaxis] * XtX_inv, 'dof': dof,
+            'rho': rho, 'sigma2': sigma2}
+
+
+def batch_contrasts(fit, C):
+    """Effect, standard error, t and two-sided p of each contrast (rows of C)
+    for each session of a fit returned by batch_fit_ar1, as (sessions x
+    contrasts) arrays."""
+    effect = fit['beta'].dot(C.T)
+    se = np.sqrt(np.einsum('ki,bij,kj->bk', C, fit['cov'], C))
+    t = effect / se
+    return effect, se, t, 2 * stats.t.sf(np.abs(t), fit['dof'][:, np.newaxis])
+
+
+def length_batches(inputs, batch_size=32):
+    """Lists of positions of inputs with the same number of samples, at most
+    batch_size per list."""
+    by_length = {}
+    for i, glm_input in enumerate(inputs):
+        by_length.setdefault(len(glm_input['signal']), []).append(i)
+    batches = []
+    for length in sorted(by_length):
+        idx = by_length[length]
+        batches.extend(idx[start:start + batch_size] for start in range(0, len(idx), batch_size))
+    return batches
+
+
+def group_glm(inputs, task, blink_deriv=False, rho=1., batch_size=32):
+    """Fits the GLM of every session in inputs (from load_inputs) in batches
+    of sessions with equal length. Rho is as in batch_fit_ar1. Returns tidy dataframe with one row per
+    session and contrast."""
+    keys = TASKS[task]['keys']
+    names, C = contrast_matrix(task, blink_deriv)
+    results = []
+    for batch in length_batches(inputs, batch_size):
+        X = np.stack([build_design(inputs[i], task, blink_deriv) for i in batch])
+        Y = np.stack([inputs[i]['signal'] for i in batch])
+        fit = batch_fit_ar1(X, Y, rho=rho)
+        effect, se, t, pval = batch_contrasts(fit, C)
+        for b, i in enumerate(batch):
+            resultdf = pd.DataFrame({'Contrast': names, 'Beta': effect[b], 'SE': se[b],
+                                     'T': t[b], 'pval': pval[b], 'DOF': fit['dof'][b],
+                                     'Rho': fit['rho'][b]})
+            for key in keys:
+                resultdf[key] = str(inputs[i][KEY_FIELDS[key]])
+            results.append(resultdf)
+    columns = keys + ['Contrast', 'Beta', 'SE', 'T', 'pval', 'DOF', 'Rho']
+    if not results:
+        return pd.DataFrame(columns=columns)
+    glmdf = pd.concat(results, ignore_index=True)[columns]
+    return glmdf.sort_values(keys, kind='mergesort').reset_index(drop=True)
+
+
+def proc_group(datadirs, task, blink_deriv=False, rho=1., batch_size=32, outfile=None):
+    """Refits the GLM of all sessions of task in datadirs and writes the
+    results to outfile (default <task>_group_GLM_<date>.csv in the first data
+    directory)."""
+    inputs = load_inputs(datadirs, task)
+    print('Fitting GLM of {0} {1} sessions'.format(len(inputs), task))
+    glmdf = group_glm(inputs, task, blink_deriv=blink_deriv, rho=rho, batch_size=batch_size)
+    if outfile is None:
+        tstamp = datetime.now().strftime("%Y%m%d")
+        outfile = os.path.join(datadirs[0], task + '_group_GLM_' + tstamp + '.csv')
+    print('Writing GLM results to {0}'.format(outfile))
+    pupil_utils.to_csv_atomic(glmdf, outfile, index=False)
+    return glmdf
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Refit session GLMs of all subjects from '
+                                     'cached GLM input.')
+    parser.add_argument('datadirs', nargs='+', help='Directories of processed data (recursive)')
+    parser.add_argument('--task', required=True, choices=sorted(TASKS))
+    parser.add_argument('--blink-deriv', action='store_true',
+                        help='Add temporal derivative of blinks to the nuisance regressors')
+    parser.add_argument('--rho', type=float, default=1.,
+                        help='Fixed AR(1) coefficient (default 1, as in the subject GLM)')
+    parser.add_argument('--estimate-rho', action='store_true',
+                        help='Estimate the AR(1) coefficient of each session from its '
+                        'OLS residuals instead')
+    parser.add_argument('--batch-size', type=int, default=32,
+                        help='Maximum number of sessions fit together')
+    parser.add_argument('--out', help='Output csv (default dated file in first directory)')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    rho = None if args.estimate_rho else args.rho
+    proc_group(args.datadirs, args.task, blink_deriv=args.blink_deriv, rho=rho,
+               batch_size=args.batch_size, outfile=args.out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Run journal for batch processing. Each change in the status of a session is
+appended as one JSON line:
+    {"task": ..., "file": ..., "status": "pending"|"running"|"done"|"failed",
+     "attempt": 1, "time": <unix time>, "duration": <sec>, "error": <traceback>}
+Lines are flushed and synced to disk as they are written, so the journal
+survives a crash of the batch run. The last line for a session gives its
+current status; a session left as running was interrupted.
+"""
+
+from __future__ import division, print_function, absolute_import
+import os
+import json
+import time
+
+
+def record(journal, task, fname, status, **fields):
+    """Appends a status line for (task, fname) to the journal."""
+    entry = {'task': task, 'file': fname, 'status': status, 'time': time.time()}
+    entry.update(fields)
+    with open(journal, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_journal(journal):
+    """Returns dictionary mapping (task, file) to its last journal entry, with
+    the number of attempts started so far. Lines that cannot be parsed (e.g.
+    cut off by a crash) are skipped."""
+    entries = {}
+    if not os.path.exists(journal):
+        return entries
+    with open(journal, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            key = (entry['task'], entry['file'])
+            attempts = entries[key]['attempts'] if key in entries else 0
+            if entry['status'] == 'running':
+                attempts += 1
+            entry['attempts'] = attempts
+            entries[key] = entry
+    return entries
+
+
+def completed(journal):
+    """Set of (task, file) recorded as done."""
+    return set(key for key, entry in read_journal(journal).items() if entry['status'] == 'done')
+
+
+def summarize(journal):
+    """Number of sessions in each status."""
+    counts = {}
+    for entry in read_journal(journal).values():
+        counts[entry['status']] = counts.get(entry['status'], 0) + 1
+    return counts
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Make-style scheduler for the processing chain of every task:
+    setup (oddball only): raw gazedata -> *_recoded.gazedata
+    subject: input gazedata -> subject outputs (e.g. _SessionData.csv)
+    group: all subject outputs in a directory -> dated group outputs
+
+A target is rebuilt only if it is stale: an output is missing, or an input is
+newer than the oldest output. With use_hash, inputs are compared by content
+(SHA-1) with the hashes recorded at the last successful build instead, so
+touched or copied but unchanged files do not trigger a rebuild. Hashes are
+stored in a JSON state file and are only recomputed for files whose size or
+modification time changed. The first run with use_hash rebuilds every target,
+since no hashes have been recorded yet.
+
+Setup and subject targets run in a pool of worker processes. A group target
+runs in the main process (so it can start its own worker pool) once all
+subject targets it depends on are finished, and is skipped if any of them
+failed.
+"""
+
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import traceback
+import importlib
+from glob import glob
+from multiprocessing import Pool
+import pupil_tasks
+import pupil_catalog
+try:
+    # for Python2
+    import Queue as queue
+except ImportError:
+    # for Python3
+    import queue
+
+
+class Target(object):
+    """One build step. Action is (module, function, args, kwargs) so it can be
+    sent to worker processes. Outputs of group targets are dated, so they are
+    given as glob patterns and the newest match is used."""
+
+    def __init__(self, name, inputs, outputs, action, deps=(), local=False, output_globs=()):
+        self.name = name
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.output_globs = list(output_globs)
+        self.action = action
+        self.deps = list(deps)
+        self.local = local
+
+    def current_outputs(self):
+        """Output files, None in place of outputs that do not exist."""
+        outputs = [out if os.path.exists(out) else None for out in self.outputs]
+        for pattern in self.output_globs:
+            matches = glob(pattern)
+            outputs.append(max(matches, key=os.path.getmtime) if matches else None)
+        return outputs
+
+
+def build_graph(paths, tasks=None, timepoints=None, group=True, group_jobs=1):
+    """Builds targets for all input files of tasks found in paths (files,
+    directories or globs). Group scripts that support it get n_jobs=group_jobs.
+    Returns list of targets in dependency order."""
+    setup_targets, subject_targets, group_inputs = [], {}, {}
+    for fname in pupil_catalog.expand_paths(paths):
+        matches = [(task, match, fname, None) for task, match in pupil_tasks.match_tasks(fname)]
+        for task, match in pupil_tasks.match_setup(fname):
+            if tasks and task not in tasks:
+                continue
+            recoded = pupil_tasks.setup_output_path(task, fname, match)
+            setup = Target('setup:{0}:{1}'.format(task, fname), [fname], [recoded],
+                           (pupil_tasks.TASKS[task]['setup_module'], 'setup_subject', ([fname],), {}))
+            setup_targets.append(setup)
+            matches.extend((t, m, recoded, setup.name) for t, m in pupil_tasks.match_tasks(recoded)
+                           if t == task)
+        for task, match, infile, setup_name in matches:
+            if tasks and task not in tasks:
+                continue
+            name = 'subject:{0}:{1}'.format(task, infile)
+            if name in subject_targets:
+                # Recoded file found on disk before its setup target
+                if setup_name and not subject_targets[name].deps:
+                    subject_targets[name].deps.append(setup_name)
+                continue
+            meta = pupil_catalog.parse_session(infile, task, match)
+            if timepoints and meta['timepoint'] not in timepoints:
+                continue
+            spec = pupil_tasks.TASKS[task]
+            subject_targets[name] = Target(name, pupil_tasks.input_files(task, infile),
+                                           [meta['output_path']],
+                                           (spec['module'], 'proc_subject', ([infile],), {}),
+                                           deps=[setup_name] if setup_name else [])
+            datadir = os.path.dirname(meta['output_path'])
+            group_inputs.setdefault((task, datadir), []).append(name)
+    targets = setup_targets + list(subject_targets.values())
+    used_setups = set(dep for target in subject_targets.values() for dep in target.deps)
+    targets = [t for t in targets if not t.name.startswith('setup:') or t.name in used_setups]
+    if group:
+        for (task, datadir), names in sorted(group_inputs.items()):
+            spec = pupil_tasks.TASKS[task]
+            kwargs = {'n_jobs': group_jobs} if spec.get('group_jobs') else {}
+            inputs = [subject_targets[name].outputs[0] for name in names]
+            targets.append(Target('group:{0}:{1}'.format(task, datadir), inputs, [],
+                                  (spec['group_module'], 'proc_group', (datadir,), kwargs),
+                                  deps=names, local=True,
+                                  output_globs=[os.path.join(datadir, spec['group_output'])]))
+    return targets
+
+
+def file_hash(path, hashes):
+    """SHA-1 of file contents. hashes caches [size, mtime, sha1] by path and
+    is updated when the file changed."""
+    stat = os.stat(path)
+    cached = hashes.get(path)
+    if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+        return cached[2]
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    hashes[path] = [stat.st_size, stat.st_mtime, sha1.hexdigest()]
+    return hashes[path][2]
+
+
+def load_state(state_file):
+    if state_file and os.path.exists(state_file):
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    return {'hashes': {}, 'targets': {}}
+
+
+def save_state(state, state_file):
+    """Writes state to a temporary file first so a crash cannot corrupt it."""
+    if not state_file:
+        return
+    tmpfile = state_file + '.tmp'
+    with open(tmpfile, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmpfile, state_file)
+
+
+def is_stale(target, state, use_hash=False):
+    """Returns reason the target needs to be rebuilt, None if up to date."""
+    outputs = target.current_outputs()
+    if any(out is None for out in outputs):
+        return 'missing output'
+    missing = [inp for inp in target.inputs if not os.path.exists(inp)]
+    if missing:
+        return 'missing input {0}'.format(missing[0])
+    if use_hash:
+        recorded = state['targets'].get(target.name, {})
+        for inp in target.inputs:
+            if recorded.get(inp) != file_hash(inp, state['hashes']):
+                return 'changed input {0}'.format(inp)
+        return None
+    oldest = min(os.path.getmtime(out) for out in outputs)
+    for inp in target.inputs:
+        if os.path.getmtime(inp) > oldest:
+            return 'newer input {0}'.format(inp)
+    return None
+
+
+def run_action(name, action):
+    """Runs action of target name. Defined at module level so it can be sent
+    to worker processes. Returns name, error message (None on success) and
+    run time in seconds."""
+    module, function, args, kwargs = action
+    start = time.time()
+    try:
+        getattr(importlib.import_module(module), function)(*args, **kwargs)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return name, error, time.time() - start
+
+
+def make(targets, jobs=1, use_hash=False, state_file=None, dry_run=False):
+    """Builds stale targets in dependency order. Returns dictionary of status
+    of each target: built, uptodate, failed, or blocked (an upstream target
+    failed). In a dry run stale targets are reported as built and nothing is
+    run."""
+    state = load_state(state_file)
+    by_name = dict((target.name, target) for target in targets)
+    status = {}
+    pending = list(targets)
+    running = set()
+    results = queue.Queue()
+    pool = Pool(jobs) if jobs > 1 else None
+
+    def finish(result):
+        name, error, seconds = result
+        target = by_name[name]
+        running.discard(name)
+        if error:
+            status[name] = 'failed'
+            print('FAILED {0} ({1:.1f} s)'.format(name, seconds))
+            print(error)
+        else:
+            status[name] = 'built'
+            print('Built {0} ({1:.1f} s)'.format(name, seconds))
+            if use_hash:
+                state['targets'][name] = dict((inp, file_hash(inp, state['hashes']))
+                                              for inp in target.inputs if os.path.exists(inp))
+
+    try:
+        while pending or running:
+            progressed = False
+            for target in list(pending):
+                dep_status = [status.get(dep) for dep in target.deps]
+                if any(s is None for s in dep_status):
+                    continue
+                pending.remove(target)
+                progressed = True
+                if any(s in ('failed', 'blocked') for s in dep_status):
+                    status[target.name] = 'blocked'
+                    print('Skipping {0}: upstream target failed'.format(target.name))
+                    continue
+                reason = is_stale(target, state, use_hash)
+                if dry_run and reason is None and 'built' in dep_status:
+                    reason = 'upstream target rebuilt'
+                if reason is None:
+                    status[target.name] = 'uptodate'
+                    continue
+                print('Building {0} ({1})'.format(target.name, reason))
+                if dry_run:
+                    status[target.name] = 'built'
+                elif pool is not None and not target.local:
+                    running.add(target.name)
+                    pool.apply_async(run_action, (target.name, target.action), callback=results.put)
+                else:
+                    running.add(target.name)
+                    finish(run_action(target.name, target.action))
+            if running:
+                finish(results.get())
+            elif not progressed:
+                break
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if not dry_run:
+            save_state(state, state_file)
+    counts = dict((s, list(status.values()).count(s)) for s in ('built', 'uptodate', 'failed', 'blocked'))
+    print('{built} built, {uptodate} up to date, {failed} failed, {blocked} blocked'.format(**counts))
+    return status
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Rebuild stale pupillometry outputs.')
+    parser.add_argument('paths', nargs='+', help='Files, directories or glob patterns')
+    parser.add_argument('--task', action='append', choices=sorted(pupil_tasks.TASKS),
+                        help='Task to build (repeatable, default all)')
+    parser.add_argument('--timepoint', action='append', type=int,
+                        help='Timepoint to build (repeatable, default all)')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--hash', action='store_true',
+                        help='Compare input contents instead of modification times')
+    parser.add_argument('--state', help='State file for input hashes '
+                        '(default .pupil_make.json in the first path)')
+    parser.add_argument('--no-group', action='store_true', help='Only build subject targets')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Print targets that would be built without running them')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    state_file = args.state
+    if args.hash and state_file is None:
+        first = args.paths[0] if os.path.isdir(args.paths[0]) else os.getcwd()
+        state_file = os.path.join(first, '.pupil_make.json')
+    targets = build_graph(args.paths, tasks=args.task, timepoints=args.timepoint,
+                          group=not args.no_group, group_jobs=args.jobs)
+    status = make(targets, jobs=args.jobs, use_hash=args.hash, state_file=state_file,
+                  dry_run=args.dry_run)
+    return 1 if 'failed' in status.values() else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
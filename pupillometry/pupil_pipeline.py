@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Pipelined processing of sessions in three stages so file I/O overlaps with
+computation:
+    read: a reader thread loads the next sessions ahead of time
+    process: sessions are processed in the main thread, or in n_workers
+        worker processes
+    write: a writer thread saves the outputs of finished sessions
+Stages are connected by bounded queues, so at most prefetch loaded
+sessions, n_workers sessions being processed and write_depth finished
+sessions are held in memory at once. Errors in any stage are recorded for
+that session and do not stop the pipeline.
+
+Task scripts that support this mode split proc_subject into load_session,
+process_session and write_session (see oddball_proc_subject.py). The writer
+thread makes matplotlib figures, so a non-interactive backend (e.g. Agg)
+should be used.
+"""
+
+from __future__ import division, print_function, absolute_import
+import sys
+import time
+import functools
+import threading
+import traceback
+from multiprocessing import Pool
+try:
+    # for Python2
+    import Queue as queue
+except ImportError:
+    # for Python3
+    import queue
+
+_DONE = object()
+
+
+class StageStats(object):
+    """Number of items, busy time and time spent waiting on other stages."""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.busy = 0.
+        self.wait = 0.
+
+    def report(self, wall):
+        rate = self.count / wall if wall > 0 else 0.
+        per_item = self.busy / self.count if self.count else 0.
+        util = 100. * self.busy / wall if wall > 0 else 0.
+        return '{0:<8s} {1:5d} sessions  {2:7.2f} s/session  {3:6.2f} sessions/s  ' \
+               '{4:5.1f}% busy  {5:7.1f} s waiting'.format(self.name, self.count, per_item,
+                                                          rate, util, self.wait)
+
+
+def _timed_call(func, item, data):
+    """Calls func(item, data). Defined at module level so it can be sent to
+    worker processes. Returns item, result, error message and run time."""
+    start = time.time()
+    try:
+        return item, func(item, data), None, time.time() - start
+    except Exception:
+        return item, None, traceback.format_exc(), time.time() - start
+
+
+def run_pipeline(items, load, process, write, prefetch=2, n_workers=1, write_depth=2,
+                 on_done=None, verbose=True):
+    """Runs load(item), process(item, data) and write(item, result) for every
+    item with the three stages overlapping. process must be defined at module
+    level when n_workers > 1. on_done(item, error, seconds) is called in the
+    main thread when an item is written or fails. Returns list of (item,
+    error) of failed items and dictionary of StageStats."""
+    stats = dict((name, StageStats(name)) for name in ('read', 'process', 'write'))
+    read_q = queue.Queue(maxsize=max(prefetch, 1))
+    write_q = queue.Queue(maxsize=max(write_depth, 1))
+    done_q = queue.Queue()
+    starts = {}
+
+    def reader():
+        for item in items:
+            start = time.time()
+            starts[item] = start
+            try:
+                data, error = load(item), None
+            except Exception:
+                data, error = None, traceback.format_exc()
+            stats['read'].busy += time.time() - start
+            stats['read'].count += 1
+            start = time.time()
+            read_q.put((item, data, error))
+            stats['read'].wait += time.time() - start
+        read_q.put(_DONE)
+
+    def writer():
+        while True:
+            start = time.time()
+            entry = write_q.get()
+            stats['write'].wait += time.time() - start
+            if entry is _DONE:
+                break
+            item, result = entry
+            start = time.time()
+            try:
+                write(item, result)
+                error = None
+            except Exception:
+                error = traceback.format_exc()
+            stats['write'].busy += time.time() - start
+            stats['write'].count += 1
+            done_q.put((item, error))
+
+    failed = []
+
+    def finish_ready(block=False):
+        while True:
+            try:
+                item, error = done_q.get(block=block)
+            except queue.Empty:
+                return
+            block = False
+            if error:
+                failed.append((item, error))
+            if on_done is not None:
+                on_done(item, error, time.time() - starts.get(item, time.time()))
+
+    wall_start = time.time()
+    # Workers are forked before the threads start, so they do not inherit
+    # locks held by the reader or writer
+    pool = Pool(n_workers) if n_workers > 1 else None
+    in_flight = threading.BoundedSemaphore(max(n_workers, 1))
+    read_thread = threading.Thread(target=reader, name='pupil-reader')
+    write_thread = threading.Thread(target=writer, name='pupil-writer')
+    read_thread.daemon = write_thread.daemon = True
+    read_thread.start()
+    write_thread.start()
+
+    def to_writer(output):
+        item, result, error, seconds = output
+        stats['process'].busy += seconds
+        stats['process'].count += 1
+        if error:
+            done_q.put((item, error))
+        else:
+            write_q.put((item, result))
+        # Only start another session once this one is handed to the writer
+        in_flight.release()
+
+    def worker_failed(item, exc):
+        # Failures outside process, e.g. a result that cannot be sent back
+        stats['process'].count += 1
+        done_q.put((item, ''.join(traceback.format_exception_only(type(exc), exc))))
+        in_flight.release()
+
+    try:
+        while True:
+            start = time.time()
+            entry = read_q.get()
+            stats['process'].wait += time.time() - start
+            if entry is _DONE:
+                break
+            item, data, error = entry
+            if error:
+                done_q.put((item, error))
+                continue
+            in_flight.acquire()
+            if pool is not None:
+                kwargs = {}
+                if sys.version_info[0] > 2:
+                    kwargs['error_callback'] = functools.partial(worker_failed, item)
+                pool.apply_async(_timed_call, (process, item, data), callback=to_writer, **kwargs)
+            else:
+                to_writer(_timed_call(process, item, data))
+            del data, entry
+            finish_ready()
+        if pool is not None:
+            pool.close()
+            pool.join()
+            pool = None
+    finally:
+        if pool is not None:
+            pool.terminate()
+        write_q.put(_DONE)
+        write_thread.join()
+    finish_ready()
+    wall = time.time() - wall_start
+    if verbose:
+        print('Pipeline finished {0} sessions in {1:.1f} s'.format(stats['write'].count + len(failed), wall))
+        for name in ('read', 'process', 'write'):
+            print('  ' + stats[name].report(wall))
+    return failed, stats
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Export of processed pupil data of all tasks to a single REDCap import file.
+
+The processed output of each task is reduced to one row per subject,
+timepoint and condition level and spread into wide columns named
+<value>_<task>_<level>[_<level>], e.g. dilation_fluency_cat_1_15. How this is
+done for each task is declared in SPECS:
+    pattern: regular expression matched against output file basenames
+    name: task name used in column names
+    levels: list of (column, [(value, label), ...]). Rows with values that
+        are not listed are dropped. Labels are joined in this order.
+    values: columns exported for every combination of levels
+    reduce: 'mean' drops rows with BlinkPct of .50 or more, averages the rest
+        within levels and counts them in ntrials; None uses rows as they are;
+        otherwise 'module.function' returning one row per level of a
+        subject's dataframe
+
+The export holds one row (record) per subject and timepoint with the columns
+of all tasks. Output files are read in parallel. A manifest next to the
+export records size and modification time of every file read, so later runs
+only read new or changed files and update the records they belong to.
+Records whose values changed are also written to a dated *_changes_*.csv
+file, which can be imported into REDCap instead of the whole export.
+
+    pupil_redcap.py [--jobs 4] [--full] --out pupil_redcap.csv <data directory> ...
+"""
+
+from __future__ import division, print_function, absolute_import
+import os
+import re
+import sys
+import json
+import argparse
+import importlib
+import itertools
+import traceback
+from datetime import datetime
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+import pupil_utils
+import pupil_catalog
+
+KEYS = ['subject', 'timepoint']
+
+FLUENCY_QUARTILES = [('00:00:15', '1_15'), ('00:00:30', '15_30'),
+                     ('00:00:45', '30_45'), ('00:01:00', '45_60')]
+
+SPECS = [
+    {'name': 'fluency',
+     'pattern': r'^Fluency.*_ProcessedPupil_Quartiles\.csv$',
+     'levels': [('Condition', [('Category', 'cat'), ('Letter', 'let')]),
+                ('Timestamp', FLUENCY_QUARTILES)],
+     'values': ['Session', 'Dilation', 'Baseline', 'Diameter', 'BlinkPct', 'ntrials'],
+     'reduce': 'mean'},
+    {'name': 'hvlt_encoding',
+     'pattern': r'^HVLT-Encoding.*_ProcessedPupil_Quartiles\.csv$',
+     'levels': [('Timestamp', [('00:00:06', '1_6'), ('00:00:12', '6_12'),
+                               ('00:00:18', '12_18'), ('00:00:24', '18_24')])],
+     'values': ['Session', 'Baseline', 'Diameter', 'Dilation', 'BlinkPct', 'ntrials'],
+     'reduce': 'mean'},
+    {'name': 'hvlt_recall',
+     'pattern': r'^HVLT-Recall.*_ProcessedPupil_Quartiles\.csv$',
+     'levels': [('Timestamp', FLUENCY_QUARTILES)],
+     'values': ['Session', 'Baseline', 'Diameter', 'Dilation', 'BlinkPct'],
+     'reduce': None},
+    {'name': 'hvlt_recognition',
+     'pattern': r'^HVLT-Recognition.*_ProcessedPupil\.csv$',
+     'levels': [('Condition', [('old', 'old'), ('new', 'new')])],
+     'values': ['Session', 'Dilation', 'Baseline', 'Diameter', 'BlinkPct', 'Duration', 'ntrials'],
+     'reduce': 'mean'},
+    {'name': 'digitspan',
+     'pattern': r'^DigitSpan.*_ProcessedPupil\.csv$',
+     'levels': [('Load', [(load, str(load)) for load in range(3, 10)])],
+     'values': ['Session', 'Baseline', 'Diameter', 'Dilation', 'BlinkPct', 'ntrials',
+                'MaxTime', 'MaxDilation'],
+     'reduce': 'digitspan_proc_group.summarize_loads'},
+    ]
+
+_COMPILED = [re.compile(spec['pattern'], re.IGNORECASE) for spec in SPECS]
+
+
+def get_spec(name):
+    """Spec of task name."""
+    for spec in SPECS:
+        if spec['name'] == name:
+            return spec
+    raise Exception('No REDCap spec for task {0}'.format(name))
+
+
+def match_spec(fname):
+    """Name of the spec whose pattern matches the basename of fname, None if
+    there is none."""
+    fname_base = os.path.basename(fname)
+    for spec, pattern in zip(SPECS, _COMPILED):
+        if pattern.search(fname_base):
+            return spec['name']
+    return None
+
+
+def column_names(spec):
+    """Wide column names of spec in export order: values within each
+    combination of levels."""
+    labels = [[label for _, label in levels] for _, levels in spec['levels']]
+    return ['_'.join([value, spec['name']] + list(combo)).lower()
+            for combo in itertools.product(*labels) for value in spec['values']]
+
+
+def reduce_levels(dflong, spec):
+    """Reduces one or more subjects' processed data to one row per level as
+    declared by the reduce entry of spec."""
+    keys = ['Subject'] + [col for col, _ in spec['levels']]
+    if spec['reduce'] == 'mean':
+        # Filter out trials with >50% blinks
+        dflong = dflong[dflong.BlinkPct < .50]
+        cols = [c for c in spec['values'] if c in dflong.columns and c not in keys]
+        grouped = dflong.groupby(keys)
+        dfgrp = grouped[cols].mean()
+        dfgrp['ntrials'] = grouped.size()
+        return dfgrp.reset_index()
+    elif spec['reduce']:
+        module, func = spec['reduce'].rsplit('.', 1)
+        return getattr(importlib.import_module(module), func)(dflong)
+    return dflong
+
+
+def pivot_wide(dflong, spec, index=('Subject',)):
+    """Spreads reduced long data into the wide columns of spec with one row
+    per index. Index and column names are lower case."""
+    dflong = dflong.copy()
+    labels = []
+    for col, levels in spec['levels']:
+        labels.append(dflong[col].map(dict(levels)))
+    keep = np.logical_and.reduce([lab.notnull().values for lab in labels])
+    dflong = dflong[keep]
+    dflong['Level'] = ['_'.join(combo) for combo in zip(*[lab[keep] for lab in labels])]
+    dfwide = dflong.pivot(index=list(index), columns='Level', values=spec['values'])
+    dfwide.columns = ['_'.join([str(col[0]), spec['name'], str(col[1])]).lower()
+                      for col in dfwide.columns.values]
+    dfwide = dfwide.reindex(column_names(spec), axis=1)
+    dfwide = dfwide.reset_index()
+    dfwide.columns = dfwide.columns.str.lower()
+    return dfwide
+
+
+def read_output(args):
+    """Reads one processed output file and returns its path, (subject,
+    timepoint) record, wide values and error message (None on success).
+    Defined at module level so it can be sent to worker processes."""
+    fname, name = args
+    try:
+        spec = get_spec(name)
+        subdf = pd.read_csv(fname, dtype={'Subject': str})
+        unique_subid = subdf.Subject.unique()
+        if len(unique_subid) != 1:
+            raise Exception('Found multiple subject IDs in file {0}: {1}'.format(fname, unique_subid))
+        if 'Session' in subdf.columns and subdf.Session.nunique() == 1:
+            timepoint = str(subdf.Session.iat[0])
+        else:
+            timepoint = pupil_utils.get_tpfolder(fname)
+        dfwide = pivot_wide(reduce_levels(subdf, spec), spec)
+        values = dfwide.drop(columns='subject').iloc[0].to_dict() if len(dfwide) else {}
+        return fname, (str(unique_subid[0]), timepoint), values, None
+    except Exception:
+        return fname, None, None, traceback.format_exc()
+
+
+def scan(datadirs):
+    """Dictionary of output files below datadirs to their spec name and
+    (size, modification time)."""
+    files = {}
+    for fname in pupil_catalog.iter_files(datadirs):
+        name = match_spec(fname)
+        if name:
+            stat = os.stat(fname)
+            files[fname] = (name, [stat.st_size, stat.st_mtime])
+    return files
+
+
+def read_outputs(jobs, n_jobs=1):
+    """Reads list of (file, spec name) in n_jobs processes."""
+    if n_jobs > 1 and len(jobs) > 1:
+        pool = Pool(min(n_jobs, len(jobs)))
+        try:
+            return pool.map(read_output, jobs, chunksize=max(1, len(jobs) // (4 * n_jobs)))
+        finally:
+            pool.close()
+            pool.join()
+    return [read_output(job) for job in jobs]
+
+
+def all_columns():
+    return KEYS + [col for spec in SPECS for col in column_names(spec)]
+
+
+def as_float(df):
+    """Converts columns holding only numbers to float, so values are written
+    the same way whether they were read from the export or from output files."""
+    columns = {}
+    for col in df.columns:
+        try:
+            columns[col] = df[col].astype(np.float64)
+        except (ValueError, TypeError):
+            columns[col] = df[col]
+    # Built at once, replacing columns one by one fragments wide exports
+    return pd.DataFrame(columns, index=df.index, columns=df.columns)
+
+
+def match_dtypes(df, like):
+    """Casts columns of df to the type of the same column in like where the
+    values allow it, so combining the two keeps the types of like."""
+    columns = {}
+    for col in df.columns:
+        columns[col] = df[col]
+        if col in like.columns and df[col].dtype != like[col].dtype:
+            try:
+                columns[col] = df[col].astype(like[col].dtype)
+            except (ValueError, TypeError):
+                pass
+    return pd.DataFrame(columns, index=df.index, columns=df.columns)
+
+
+def load_export(outfile):
+    """Existing export indexed by record, empty if there is none."""
+    if not os.path.exists(outfile):
+        return pd.DataFrame(columns=all_columns()).set_index(KEYS)
+    export = pd.read_csv(outfile, dtype={'subject': str, 'timepoint': str},
+                         float_precision='round_trip')
+    return as_float(export.reindex(all_columns(), axis=1).set_index(KEYS))
+
+
+def manifest_path(outfile):
+    return os.path.splitext(outfile)[0] + '_manifest.json'
+
+
+def load_manifest(outfile):
+    """Files read into the export, with their spec name, signature and record."""
+    if not os.path.exists(manifest_path(outfile)):
+        return {}
+    with open(manifest_path(outfile)) as f:
+        return json.load(f)
+
+
+def update_export(datadirs, outfile, n_jobs=1, full=False, verbose=True):
+    """Reads output files below datadirs that are new or changed since the
+    last export (all files if full) and updates their records in outfile.
+    Records of files that no longer exist are cleared. Returns dataframe of
+    records whose values changed, which is also written next to outfile."""
+    if isinstance(datadirs, str):
+        datadirs = [datadirs]
+    datadirs = [os.path.abspath(d) for d in datadirs]
+    outfile = os.path.abspath(outfile)
+    manifest = {} if full else load_manifest(outfile)
+    previous = load_export(outfile)
+    export = previous.iloc[:0].copy() if full else previous.copy()
+    files = scan(datadirs)
+    changed = sorted(fname for fname, (name, signature) in files.items()
+                     if fname not in manifest or manifest[fname]['signature'] != signature)
+    roots = tuple(os.path.join(d, '') for d in datadirs)
+    removed = [fname for fname in manifest if fname not in files and fname.startswith(roots)]
+    # Clear values of files that changed or no longer exist
+    for fname in removed + [f for f in changed if f in manifest]:
+        record = tuple(manifest[fname]['record'])
+        if record in export.index:
+            export.loc[record, column_names(get_spec(manifest[fname]['spec']))] = np.nan
+        del manifest[fname]
+    results = read_outputs([(fname, files[fname][0]) for fname in changed], n_jobs)
+    written = {}
+    updates = {}
+    failed = 0
+    for fname, record, values, error in results:
+        if error:
+            print('Could not read {0}:\n{1}'.format(fname, error))
+            failed += 1
+            continue
+        name, signature = files[fname]
+        if (record, name) in written:
+            print('Found multiple {0} files for subject {1} timepoint {2}, using {3}'.format(
+                name, record[0], record[1], fname))
+        written[(record, name)] = fname
+        updates.setdefault(record, {}).update(values)
+        manifest[fname] = {'spec': name, 'signature': signature, 'record': list(record)}
+    if updates:
+        # New values are combined with the export at once rather than row by row
+        index = pd.MultiIndex.from_tuples(list(updates), names=KEYS)
+        new = pd.DataFrame(list(updates.values()), index=index, columns=export.columns)
+        export = match_dtypes(new, export).combine_first(export)
+    # Records left without any values are dropped
+    export = as_float(export.dropna(how='all').sort_index())
+    changes = changed_records(previous, export)
+    pupil_utils.to_csv_atomic(export.reset_index(), outfile, index=False)
+    pupil_utils.write_json_atomic(manifest, manifest_path(outfile))
+    if len(changes):
+        date = datetime.today().strftime('%Y-%m-%d')
+        changes_outfile = '{0}_changes_{1}.csv'.format(os.path.splitext(outfile)[0], date)
+        pupil_utils.to_csv_atomic(changes.reset_index(), changes_outfile, index=False)
+    if verbose:
+        print('REDCap export {0}: {1} files read, {2} failed, {3} removed, {4} records changed'.format(
+            outfile, len(changed), failed, len(removed), len(changes)))
+    return changes
+
+
+def changed_records(previous, export):
+    """Records of export that are new or whose values differ from previous."""
+    old = previous.reindex(export.index)
+    same = (old == export) | (old.isnull() & export.isnull())
+    return export[~same.all(axis=1)]
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Export processed pupil data of all tasks '
+                                     'to one REDCap import file.')
+    parser.add_argument('datadirs', nargs='+', help='Directories of processed data (recursive)')
+    parser.add_argument('--out', required=True, help='Export file to create or update')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--full', action='store_true',
+                        help='Read all files instead of only new or changed ones')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    update_export(args.datadirs, args.out, n_jobs=args.jobs, full=args.full)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Reliability of subject level oddball measures estimated by resampling trials
+within subject. Takes epochs saved by oddball_proc_subject.py
+(<session>-<subject>_Epochs.npz) as input.
+
+Measures are calculated the same way as in oddball_proc_group.py:
+    - Target/Standard DilationMax and DilationSD (median over trials)
+    - DIFF and CNR1-4 (see oddball_proc_group.calc_cnr)
+    - Target/Standard/Contrast t-values. The session GLM cannot be refit for
+      every resample, so these are t-values of single trial IRF amplitudes
+      (projection of each epoch onto the canonical pupil IRF).
+
+Three resampling schemes are used:
+    - OddEven: odd vs. even trials of each condition
+    - RandomSplit: random halves of each condition
+    - Bootstrap: trials drawn with replacement within each condition
+Split-half correlations across subjects are Spearman-Brown corrected.
+Bootstrap reliability is 1 minus the ratio of mean within-subject bootstrap
+variance to between-subject variance. All resamples for a subject are drawn
+as one array of trial indices and all measures are computed from it at once.
+"""
+
+from __future__ import division, print_function, absolute_import
+import os
+import warnings
+from glob import glob
+import numpy as np
+import pandas as pd
+import pupil_utils
+
+MEASURES = ['Target_DilationMax', 'Standard_DilationMax', 'Target_DilationSD',
+            'Standard_DilationSD', 'DIFF', 'CNR1', 'CNR2', 'CNR3', 'CNR4',
+            'Target_t', 'Standard_t', 'Contrast_t']
+
+
+def load_epochs(datadir, suffix='_Epochs.npz'):
+    """Loads all epoch files in datadir. Returns list of dictionaries with
+    subject, session, oddball_session, epochs, times, and condition."""
+    sublist = []
+    for sub_file in sorted(glob(os.path.join(datadir, '*' + suffix))):
+        with np.load(sub_file) as npz:
+            sublist.append({key: npz[key] for key in npz.files})
+    return sublist
+
+
+def trial_values(epochs, times, s1=50000., n1=10.1, tmax=0.930):
+    """Per trial values that subject measures are based on. Returns array with
+    shape (trials, 3): max dilation, SD of dilation, and IRF amplitude (least
+    squares projection of the post-onset epoch onto the pupil IRF)."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        dilmax = np.nanmax(epochs, axis=1)
+        dilsd = np.nanstd(epochs, axis=1, ddof=1)
+    post = epochs[:, times >= 0]
+    kernel = pupil_utils.pupil_irf(times[times >= 0], s1=s1, n1=n1, tmax=tmax)
+    valid = ~np.isnan(post)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        amp = np.nansum(post * kernel, axis=1) / np.sum(valid * kernel**2, axis=1)
+    return np.column_stack((dilmax, dilsd, amp))
+
+
+def _nanmedian(x):
+    """Median over axis 1 ignoring nan. Sorting puts nan last, so the median
+    is read from the sorted array at positions set by the count of values.
+    Much faster than np.nanmedian on many small rows."""
+    xsorted = np.sort(x, axis=1)
+    n = np.sum(~np.isnan(x), axis=1, keepdims=True)
+    lo = np.take_along_axis(xsorted, np.clip((n - 1) // 2, 0, None), axis=1)
+    hi = np.take_along_axis(xsorted, np.clip(n // 2, 0, None), axis=1)
+    return np.where(n > 0, (lo + hi) / 2., np.nan)[:, 0]
+
+
+def _measures(target, standard):
+    """Subject measures from resampled trial values of each condition. Inputs
+    have shape (resamples, trials, 3) and may contain nan for trials not in a
+    resample. Returns array of shape (resamples, len(MEASURES))."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        tmed = _nanmedian(target[:, :, :2])
+        smed = _nanmedian(standard[:, :, :2])
+        tamp = target[:, :, 2]
+        samp = standard[:, :, 2]
+        nt = np.sum(~np.isnan(tamp), axis=1)
+        ns = np.sum(~np.isnan(samp), axis=1)
+        tmean, smean = np.nanmean(tamp, axis=1), np.nanmean(samp, axis=1)
+        tvar, svar = np.nanvar(tamp, axis=1, ddof=1), np.nanvar(samp, axis=1, ddof=1)
+        out = np.column_stack((
+            tmed[:, 0], smed[:, 0], tmed[:, 1], smed[:, 1],
+            tmed[:, 0] - smed[:, 0],
+            tmed[:, 0] / smed[:, 1],
+            (tmed[:, 0] - smed[:, 0]) / smed[:, 1],
+            tmed[:, 1] / smed[:, 1],
+            (tmed[:, 0] - smed[:, 0]) / smed[:, 0],
+            tmean / np.sqrt(tvar / nt),
+            smean / np.sqrt(svar / ns),
+            (tmean - smean) / np.sqrt(tvar / nt + svar / ns)))
+    return out
+
+
+def _gather(values, idx):
+    """Values of trials at idx (resamples, trials). Negative idx gives nan."""
+    out = values[np.clip(idx, 0, None)]
+    out[idx < 0] = np.nan
+    return out
+
+
+def split_indices(n_trials, n_splits, rng, method):
+    """Trial indices of two halves for each split. Returns two arrays of shape
+    (n_splits, ceil(n_trials/2)), the second padded with -1 if n_trials is odd."""
+    half = int(np.ceil(n_trials / 2.))
+    if method == 'oddeven':
+        order = np.concatenate((np.arange(0, n_trials, 2), np.arange(1, n_trials, 2)))
+        order = order[np.newaxis, :]
+    else:
+        order = np.argsort(rng.random_sample((n_splits, n_trials)), axis=1)
+    half2 = -np.ones((order.shape[0], half), dtype=np.int64)
+    half2[:, :n_trials - half] = order[:, half:]
+    return order[:, :half], half2
+
+
+def subject_resamples(values, conditions, n_resamples=1000, seed=None):
+    """Subject measures under each resampling scheme. Returns dictionary of
+    arrays: 'Full' (len(MEASURES),), 'OddEven' (2, 1, M), 'RandomSplit'
+    (2, n_resamples, M) and 'Bootstrap' (n_resamples, M)."""
+    rng = np.random.RandomState(seed)
+    conds = [values[conditions == cond] for cond in ('Target', 'Standard')]
+    # A condition without trials gives nan measures rather than an empty index
+    conds = [cvals if len(cvals) else np.full((1, values.shape[1]), np.nan) for cvals in conds]
+    result = {'Full': _measures(conds[0][np.newaxis], conds[1][np.newaxis])[0]}
+    for method, n_splits in (('OddEven', 1), ('RandomSplit', n_resamples)):
+        halves = [split_indices(len(cvals), n_splits, rng, method.lower()) for cvals in conds]
+        result[method] = np.stack([_measures(_gather(conds[0], halves[0][h]),
+                                             _gather(conds[1], halves[1][h]))
+                                   for h in (0, 1)])
+    boot = [_gather(cvals, rng.randint(0, len(cvals), size=(n_resamples, len(cvals))))
+            for cvals in conds]
+    result['Bootstrap'] = _measures(boot[0], boot[1])
+    return result
+
+
+def _split_half_r(half1, half2):
+    """Correlation across subjects (axis 0) ignoring subjects with nan."""
+    valid = ~np.isnan(half1) & ~np.isnan(half2)
+    n = valid.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        a = np.where(valid, half1, 0.)
+        b = np.where(valid, half2, 0.)
+        a = np.where(valid, a - a.sum(axis=0) / n, 0.)
+        b = np.where(valid, b - b.sum(axis=0) / n, 0.)
+        r = (a * b).sum(axis=0) / np.sqrt((a**2).sum(axis=0) * (b**2).sum(axis=0))
+    return r
+
+
+def spearman_brown(r):
+    """Reliability of full length measure from split-half correlation."""
+    return 2 * r / (1 + r)
+
+
+def calc_reliability(sublist, n_resamples=1000, seed=None):
+    """Calculates reliability of all MEASURES from list of subject epochs as
+    returned by load_epochs. Returns dataframe with one row per measure."""
+    rng = np.random.RandomState(seed)
+    results = []
+    for sub in sublist:
+        values = trial_values(sub['epochs'], sub['times'])
+        results.append(subject_resamples(values, sub['condition'], n_resamples,
+                                         seed=rng.randint(0, 2**31 - 1)))
+    full = np.stack([res['Full'] for res in results])
+    reldf = pd.DataFrame(index=pd.Index(MEASURES, name='Measure'))
+    reldf['N'] = np.sum(~np.isnan(full), axis=0)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        for method in ('OddEven', 'RandomSplit'):
+            halves = np.stack([res[method] for res in results], axis=1)
+            sb = spearman_brown(_split_half_r(halves[0], halves[1]))
+            reldf[method] = np.nanmean(sb, axis=0)
+        reldf['RandomSplit_CI_low'] = np.nanpercentile(sb, 2.5, axis=0)
+        reldf['RandomSplit_CI_high'] = np.nanpercentile(sb, 97.5, axis=0)
+        boot = np.stack([res['Bootstrap'] for res in results])
+        within = np.nanmean(np.nanvar(boot, axis=1, ddof=1), axis=0)
+        between = np.nanvar(full, axis=0, ddof=1)
+        reldf['Bootstrap'] = 1. - within / between
+    return reldf.reset_index()
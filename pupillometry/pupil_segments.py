@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Functions to find trial and phase boundaries from the CurrentObject column
+of raw gazedata. CurrentObject is coded as integers once, runs of the same
+object are found with np.diff, and segments are built from the runs by a
+table of rules for each task, so boundaries are found for all trials at once
+without grouping or copying the sample data.
+
+A rule is (phase, start_pattern, stop_pattern). Each run whose object
+matches start_pattern (regular expression) begins a segment of that phase.
+If stop_pattern is None the segment is the run itself, otherwise it ends with
+the first run matching stop_pattern that ends after the segment starts.
+Segments are returned as a dataframe with one row per segment:
+    Trial: trial number (starting at 1)
+    Phase: phase named in the rule
+    Object: object of the first run of the segment
+    Start, Stop: row positions of the first sample and one past the last
+    sample, so df.iloc[Start:Stop] holds the samples of the segment
+"""
+
+from __future__ import division, print_function, absolute_import
+import re
+import numpy as np
+import pandas as pd
+
+
+def encode_objects(objects):
+    """Integer code of each sample and array of object names. Missing objects
+    are coded as -1."""
+    objects = pd.Series(objects)
+    if isinstance(objects.dtype, pd.CategoricalDtype):
+        return objects.cat.codes.values, np.asarray(objects.cat.categories, dtype=object)
+    codes, names = pd.factorize(objects)
+    return codes, np.asarray(names, dtype=object)
+
+
+def find_runs(codes, by=None):
+    """Start (inclusive) and stop (exclusive) positions and code of each run
+    of equal codes. If by is given, runs are also split where by changes."""
+    codes = np.asarray(codes)
+    if len(codes) == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, codes
+    changed = np.diff(codes) != 0
+    if by is not None:
+        by = np.asarray(by)
+        changed |= by[1:] != by[:-1]
+    bounds = np.flatnonzero(changed) + 1
+    starts = np.concatenate(([0], bounds))
+    stops = np.concatenate((bounds, [len(codes)]))
+    return starts, stops, codes[starts]
+
+
+def match_runs(run_codes, names, pattern):
+    """Boolean array of runs whose object matches pattern. Patterns are only
+    tested once per object name, not once per run."""
+    matches = np.array([bool(re.search(pattern, str(name))) for name in names] + [False])
+    # Missing objects (code -1) index the trailing False
+    return matches[run_codes]
+
+
+def segment(objects, rules, trials='sequence', by=None):
+    """Applies rules to the runs of objects. With trials='sequence', the n-th
+    segment of each phase belongs to trial n. With trials='block', trials are
+    blocks of samples separated by missing objects and each segment belongs
+    to the block it starts in. Segments are sorted by Start."""
+    codes, names = encode_objects(objects)
+    starts, stops, run_codes = find_runs(codes, by=by)
+    segments = []
+    for phase, start_pattern, stop_pattern in rules:
+        is_start = match_runs(run_codes, names, start_pattern)
+        seg_starts = starts[is_start]
+        seg_objects = run_codes[is_start]
+        if stop_pattern is None:
+            seg_stops = stops[is_start]
+        else:
+            stop_runs = stops[match_runs(run_codes, names, stop_pattern)]
+            following = np.searchsorted(stop_runs, seg_starts, side='right')
+            # Segments still open at the end of the recording are dropped
+            complete = following < len(stop_runs)
+            seg_starts, seg_objects = seg_starts[complete], seg_objects[complete]
+            seg_stops = stop_runs[following[complete]]
+        if trials == 'block':
+            blocks = get_blocks(codes)[0]
+            trial = np.searchsorted(blocks, seg_starts, side='right')
+        else:
+            trial = np.arange(1, len(seg_starts) + 1)
+        segments.append(pd.DataFrame({'Trial': trial, 'Phase': phase,
+                                      'Object': names[seg_objects],
+                                      'Start': seg_starts, 'Stop': seg_stops}))
+    segments = pd.concat(segments, ignore_index=True)
+    segments = segments.sort_values('Start', kind='mergesort').reset_index(drop=True)
+    return segments[['Trial','Phase','Object','Start','Stop']]
+
+
+def get_blocks(codes):
+    """Start and stop positions of blocks of samples with an object, i.e.
+    separated by missing objects (code -1)."""
+    has_object = np.asarray(codes) >= 0
+    starts, stops, values = find_runs(has_object)
+    return starts[values], stops[values]
+
+
+def last_stops(objects, pattern):
+    """Names of objects matching pattern, in order of first appearance, and
+    one past the position of the last sample of each."""
+    codes, names = encode_objects(objects)
+    starts, stops, run_codes = find_runs(codes)
+    is_match = match_runs(run_codes, names, pattern)
+    matched = pd.Series(stops[is_match]).groupby(run_codes[is_match], sort=False).max()
+    return names[matched.index.values], matched.values
+
+
+def split_at_time(times, starts, stops, seconds):
+    """Position splitting each segment into the samples up to seconds after
+    its first sample and the rest. Times are TETTime (msec), increasing."""
+    times = np.asarray(times, dtype=np.float64)
+    split = np.searchsorted(times, times[starts] + seconds * 1000., side='right')
+    return np.clip(split, starts, stops)
+
+
+def segment_index(starts, stops):
+    """Positions of all samples in the given segments, in order."""
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(stops, dtype=np.int64) - starts
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + offsets
+
+
+def segment_means(values, starts, stops):
+    """Mean of values within each segment ignoring nan, computed from running
+    sums. Nan for segments without valid values."""
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    sums = np.concatenate(([0.], np.cumsum(np.where(valid, values, 0.))))
+    counts = np.concatenate(([0], np.cumsum(valid)))
+    total = sums[stops] - sums[starts]
+    count = counts[stops] - counts[starts]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan)
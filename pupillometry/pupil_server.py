@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Resident worker server so processing requests do not pay the start-up cost
+of importing pandas, scipy, matplotlib, seaborn, nitime and nistats.
+
+The server starts a pool of worker processes once. Each worker imports all
+task modules and builds the default filter designs and pupil irf kernels
+(pupil_utils.warm_caches), which then stay cached for every later job.
+Requests are read from a Unix socket, or a TCP port on localhost where Unix
+sockets are not available. Each connection sends one JSON request on a
+single line and receives JSON lines with the status of its jobs until all
+of them are finished:
+
+    request: {"task": "stroop", "files": ["/data/.../Stroop-101.xlsx"],
+              "step": "subject", "params": {"glm_model": "fir"}}
+    replies: {"job": 1, "file": ..., "status": "queued"}
+             {"job": 1, "file": ..., "status": "running", "pid": 1234}
+             {"job": 1, "file": ..., "status": "done", "duration": 4.2,
+              "outputs": [...]}   (or "status": "failed", "error": ...)
+
+Step is setup, subject (default) or group; for group, files are data
+directories and params are passed to proc_group. Other requests are
+{"cmd": "ping"}, which returns the number of workers and running jobs, and
+{"cmd": "shutdown"}.
+
+    pupil_server.py serve --socket /tmp/pupil.sock --jobs 4
+    pupil_server.py submit --socket /tmp/pupil.sock --task stroop <file> ...
+"""
+
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+import json
+import stat
+import time
+import socket
+import argparse
+import threading
+import traceback
+import multiprocessing
+import pupil_tasks
+try:
+    # for Python2
+    import Queue as queue
+    import SocketServer as socketserver
+except ImportError:
+    # for Python3
+    import queue
+    import socketserver
+
+STEPS = ('setup', 'subject', 'group')
+
+# Status queue of the server, set in each worker process
+_EVENTS = None
+
+
+def init_worker(tasks, events):
+    """Imports task modules and warms caches once in each worker process."""
+    global _EVENTS
+    _EVENTS = events
+    import matplotlib
+    matplotlib.use('agg')
+    import pupil_utils
+    for task in tasks:
+        for kwargs in ({}, {'group': True}, {'setup': True}):
+            if 'setup' in kwargs and 'setup_module' not in pupil_tasks.TASKS[task]:
+                continue
+            try:
+                pupil_tasks.get_task_module(task, **kwargs)
+            except Exception as err:
+                # Reported again when a job of this task is run
+                print('Could not import module of {0}: {1}'.format(task, err))
+    pupil_utils.warm_caches()
+
+
+def new_outputs(outdirs, start, prefixes=('',)):
+    """Files in outdirs whose name starts with one of prefixes written since
+    start."""
+    outputs = []
+    for outdir in set(outdirs):
+        if not os.path.isdir(outdir):
+            continue
+        for fname in os.listdir(outdir):
+            outfile = os.path.join(outdir, fname)
+            if (fname.startswith(tuple(prefixes)) and os.path.isfile(outfile)
+                    and os.path.getmtime(outfile) >= start):
+                outputs.append(outfile)
+    return sorted(outputs)
+
+
+def run_job(job_id, step, task, path, params):
+    """Runs one step of task on path in a worker process. Defined at module
+    level so it can be sent to worker processes. Returns final status."""
+    if _EVENTS is not None:
+        _EVENTS.put({'job': job_id, 'file': path, 'status': 'running', 'pid': os.getpid()})
+    start = time.time()
+    status = {'job': job_id, 'file': path}
+    try:
+        if step == 'setup':
+            pupil_tasks.get_task_module(task, setup=True).setup_subject([path], **params)
+            recoded = pupil_tasks.setup_output_path(task, path, pupil_tasks.match_setup(path)[0][1])
+            outdirs, prefixes = [os.path.dirname(recoded)], [os.path.basename(recoded)]
+        elif step == 'group':
+            pupil_tasks.get_task_module(task, group=True).proc_group(path, **params)
+            outdirs, prefixes = [path], ['']
+        else:
+            pupil_tasks.get_task_module(task).proc_subject([path], **params)
+            # Outputs are named after the input file, renamed for some tasks
+            output = pupil_tasks.output_path(task, path)
+            outdirs = [os.path.dirname(path), os.path.dirname(output)]
+            prefixes = [os.path.splitext(os.path.basename(path))[0],
+                        os.path.basename(output)[:-len(pupil_tasks.TASKS[task]['output'])]]
+        status['status'] = 'done'
+        # File times may be truncated to whole seconds
+        status['outputs'] = new_outputs(outdirs, int(start), prefixes)
+    except Exception:
+        status['status'] = 'failed'
+        status['error'] = traceback.format_exc()
+    status['duration'] = round(time.time() - start, 3)
+    return status
+
+
+class PupilServer(object):
+    """Pool of warm workers and the routing of job status to connections."""
+
+    def __init__(self, jobs=1, tasks=None):
+        self.tasks = tasks or sorted(pupil_tasks.TASKS)
+        self.events = multiprocessing.Queue()
+        self.pool = multiprocessing.Pool(jobs, initializer=init_worker,
+                                         initargs=(self.tasks, self.events))
+        self.jobs = jobs
+        self.next_id = 1
+        self.listeners = {}
+        self.lock = threading.Lock()
+        self.router = threading.Thread(target=self.route, name='pupil-router')
+        self.router.daemon = True
+        self.router.start()
+
+    def route(self):
+        """Forwards status events to the connection that submitted the job."""
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            with self.lock:
+                listener = self.listeners.get(event['job'])
+                if event['status'] in ('done', 'failed'):
+                    self.listeners.pop(event['job'], None)
+            if listener is not None:
+                listener.put(event)
+
+    def submit(self, step, task, path, params, listener):
+        """Queues one job. Status events are put on listener."""
+        with self.lock:
+            job_id = self.next_id
+            self.next_id += 1
+            self.listeners[job_id] = listener
+        listener.put({'job': job_id, 'file': path, 'status': 'queued'})
+        self.pool.apply_async(run_job, (job_id, step, task, path, params),
+                              callback=self.events.put)
+        return job_id
+
+    def running(self):
+        with self.lock:
+            return len(self.listeners)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.events.put(None)
+
+
+def check_request(request):
+    """Returns error message for an invalid job request, None if valid."""
+    if request.get('task') not in pupil_tasks.TASKS:
+        return 'Unknown task {0}'.format(request.get('task'))
+    if request.get('step', 'subject') not in STEPS:
+        return 'Unknown step {0}'.format(request.get('step'))
+    if request.get('step') == 'setup' and 'setup_module' not in pupil_tasks.TASKS[request['task']]:
+        return 'Task {0} has no setup step'.format(request['task'])
+    if not isinstance(request.get('files'), list) or not request['files']:
+        return 'No files given'
+    if not isinstance(request.get('params', {}), dict):
+        return 'Params must be an object'
+    return None
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def send(self, message):
+        self.wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def handle(self):
+        server = self.server.pupil
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError:
+            self.send({'status': 'error', 'error': 'Request is not valid JSON'})
+            return
+        if request.get('cmd') == 'ping':
+            self.send({'status': 'ok', 'pid': os.getpid(), 'workers': server.jobs,
+                       'running': server.running()})
+            return
+        if request.get('cmd') == 'shutdown':
+            self.send({'status': 'ok'})
+            threading.Thread(target=self.server.shutdown).start()
+            return
+        error = check_request(request)
+        if error:
+            self.send({'status': 'error', 'error': error})
+            return
+        listener = queue.Queue()
+        n_jobs = 0
+        for path in request['files']:
+            server.submit(request.get('step', 'subject'), request['task'], path,
+                          request.get('params', {}), listener)
+            n_jobs += 1
+        finished = 0
+        while finished < n_jobs:
+            event = listener.get()
+            if event['status'] in ('done', 'failed'):
+                finished += 1
+            try:
+                self.send(event)
+            except socket.error:
+                # Client went away, jobs still run to completion
+                return
+
+
+def get_socket_server(address, handler):
+    """Threaded Unix socket server if address is a path, localhost TCP server
+    if it is a port number."""
+    if isinstance(address, int):
+        class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+        return Server(('127.0.0.1', address), handler)
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+    remove_stale_socket(address)
+    return Server(address, handler)
+
+
+def remove_stale_socket(address):
+    """Removes a socket left at address by a server that is no longer running.
+    Raises an error if address is another kind of file or a server still
+    accepts connections on it."""
+    try:
+        mode = os.lstat(address).st_mode
+    except OSError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise IOError('{0} exists and is not a socket'.format(address))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+    except socket.error:
+        os.remove(address)
+        return
+    finally:
+        sock.close()
+    raise IOError('A server is already running on {0}'.format(address))
+
+
+def serve(address, jobs=1, tasks=None):
+    """Runs the server until a shutdown request or Ctrl-C."""
+    socket_server = get_socket_server(address, RequestHandler)
+    socket_server.pupil = PupilServer(jobs, tasks)
+    print('Serving {0} workers on {1}'.format(jobs, address))
+    try:
+        socket_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        socket_server.server_close()
+        socket_server.pupil.close()
+        if not isinstance(address, int) and os.path.exists(address):
+            os.remove(address)
+
+
+def request(address, message, timeout=None):
+    """Sends one request to the server and yields its replies."""
+    if isinstance(address, int):
+        sock = socket.create_connection(('127.0.0.1', address), timeout=timeout)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(address)
+    try:
+        sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        reader = sock.makefile('rb')
+        for line in reader:
+            yield json.loads(line.decode('utf-8'))
+    finally:
+        sock.close()
+
+
+def submit(address, task, files, step='subject', params=None):
+    """Submits files of task to the server and yields status replies."""
+    message = {'task': task, 'files': [os.path.abspath(f) for f in files], 'step': step,
+               'params': params or {}}
+    return request(address, message)
+
+
+def parse_address(args):
+    return args.port if args.port else args.socket
+
+
+def parse_params(items):
+    """Converts key=value strings to params, values parsed as JSON if possible."""
+    params = {}
+    for item in items or []:
+        key, _, value = item.partition('=')
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+    return params
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Resident pupillometry worker server.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    for name, helptext in (('serve', 'Start the server'), ('submit', 'Submit files'),
+                           ('ping', 'Check the server'), ('shutdown', 'Stop the server')):
+        sub = subparsers.add_parser(name, help=helptext)
+        address = sub.add_mutually_exclusive_group(required=True)
+        address.add_argument('--socket', help='Unix socket path')
+        address.add_argument('--port', type=int, help='TCP port on localhost')
+        if name == 'serve':
+            sub.add_argument('--jobs', type=int, default=1, help='Number of worker processes')
+            sub.add_argument('--task', action='append', choices=sorted(pupil_tasks.TASKS),
+                             help='Task modules to load (repeatable, default all)')
+        elif name == 'submit':
+            sub.add_argument('files', nargs='+', help='Input files (data directories for group)')
+            sub.add_argument('--task', required=True, choices=sorted(pupil_tasks.TASKS))
+            sub.add_argument('--step', default='subject', choices=STEPS)
+            sub.add_argument('--param', action='append',
+                             help='Keyword argument of the processing function as key=value '
+                             '(repeatable), e.g. glm_model=fir')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    address = parse_address(args)
+    if args.command == 'serve':
+        serve(address, jobs=args.jobs, tasks=args.task)
+        return 0
+    if args.command == 'submit':
+        replies = submit(address, args.task, args.files, args.step, parse_params(args.param))
+    else:
+        replies = request(address, {'cmd': args.command})
+    failed = False
+    for reply in replies:
+        print(json.dumps(reply))
+        failed = failed or reply['status'] in ('failed', 'error')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
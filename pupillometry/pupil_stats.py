@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Group level statistics on peristimulus timecourses (PSTC).
+
+Subject PSTCs are arranged as a (subjects x conditions x timepoints) array.
+Differences between two conditions are tested at every timepoint with a
+cluster-based sign-flip permutation test (Maris & Oostenveld, 2007).
+Permutations are run in batches: a (permutations x subjects) matrix of random
+signs multiplied by the (subjects x timepoints) difference matrix gives the
+mean difference under every permutation at once. Large cohorts or many
+permutations can be split across processes with n_jobs.
+
+Second level models of session GLM results (pupil_glm.py) weight each
+session's beta by the inverse of its variance. Fixed effects and random
+effects (DerSimonian & Laird, 1986, in its meta-regression form) are fit
+with covariates such as Session (timepoint) and OddballSession. All
+contrasts are fit at once as stacked (contrasts x terms x terms) systems,
+and standard errors robust to repeated sessions of a subject are given with
+the model based ones.
+
+Maris, E. & Oostenveld, R. (2007). Nonparametric statistical testing of EEG-
+    and MEG-data. Journal of Neuroscience Methods, 164(1), 177-190.
+DerSimonian, R. & Laird, N. (1986). Meta-analysis in clinical trials.
+    Controlled Clinical Trials, 7(3), 177-188.
+"""
+
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+from scipy import stats
+
+
+def pstc_array(pstcdf, conditions, id_cols=('Subject','Session'), value_col='Dilation'):
+    """Converts long PSTC dataframe to array with shape (subjects, conditions,
+    timepoints). Subjects missing any condition or timepoint are dropped.
+    Returns the array, dataframe of subject identifiers for each row, and
+    array of timepoints."""
+    id_cols = list(id_cols)
+    pstcdf = pstcdf[pstcdf.Condition.isin(conditions)]
+    wide = pstcdf.pivot_table(index=id_cols, columns=['Condition','Timepoint'],
+                              values=value_col)
+    timepoints = np.sort(pstcdf.Timepoint.unique())
+    cols = pd.MultiIndex.from_product([list(conditions), timepoints])
+    wide = wide.reindex(columns=cols).dropna(how='any')
+    data = wide.values.reshape(len(wide), len(conditions), len(timepoints))
+    subjects = wide.index.to_frame(index=False)
+    return data, subjects, timepoints
+
+
+def paired_t(diff):
+    """One sample t-statistic of (subjects x timepoints) differences."""
+    n = diff.shape[0]
+    mean = diff.mean(axis=0)
+    sd = diff.std(axis=0, ddof=1)
+    return mean / (sd / np.sqrt(n))
+
+
+def _perm_t(signs, diff, sumsq):
+    """T-statistics for a batch of sign flips. Flipping signs does not change
+    the sum of squares, so only the mean needs a matrix multiply."""
+    n = diff.shape[0]
+    mean = signs.dot(diff) / n
+    var = (sumsq - n * mean**2) / (n - 1)
+    return mean / np.sqrt(var / n)
+
+
+def _label_clusters(mask):
+    """Labels runs of True along the last axis of a 2-d boolean array. Returns
+    array of labels (0 where mask is False, labels unique across rows) and the
+    row of each label."""
+    starts = mask.copy()
+    starts[:, 1:] &= ~mask[:, :-1]
+    labels = np.cumsum(starts.ravel()).reshape(mask.shape) * mask
+    rows = np.nonzero(starts)[0]
+    return labels, rows
+
+
+def cluster_masses(tvals, threshold):
+    """Finds clusters of adjacent timepoints with t above threshold (positive
+    clusters) or below -threshold (negative clusters) in each row of tvals.
+    Returns labels and summed t of positive and negative clusters, and rows
+    each cluster belongs to."""
+    tvals = np.atleast_2d(tvals)
+    results = []
+    for mask in (tvals > threshold, tvals < -threshold):
+        labels, rows = _label_clusters(mask)
+        masses = np.bincount(labels.ravel(), weights=tvals.ravel(), minlength=len(rows)+1)[1:]
+        results.append((labels, masses, rows))
+    return results
+
+
+def max_cluster_mass(tvals, threshold):
+    """Largest absolute cluster mass in each row of tvals (0 if no clusters)."""
+    tvals = np.atleast_2d(tvals)
+    maxmass = np.zeros(tvals.shape[0])
+    for labels, masses, rows in cluster_masses(tvals, threshold):
+        np.maximum.at(maxmass, rows, np.abs(masses))
+    return maxmass
+
+
+def _null_distribution(args):
+    """Max cluster mass for a chunk of permutations. Defined at module level
+    so it can be sent to worker processes."""
+    diff, threshold, n_perm, seed = args
+    rng = np.random.RandomState(seed)
+    sumsq = (diff**2).sum(axis=0)
+    signs = rng.choice([-1., 1.], size=(n_perm, diff.shape[0]))
+    return max_cluster_mass(_perm_t(signs, diff, sumsq), threshold)
+
+
+def cluster_permutation_test(diff, timepoints, n_perm=5000, threshold=None, alpha=0.05,
+                             chunk_size=1000, n_jobs=1, seed=None):
+    """Cluster-based sign-flip permutation test on (subjects x timepoints)
+    differences between two conditions. Threshold is the t value that defines
+    clusters, by default the two-tailed critical t at alpha. Permutations are
+    run in chunks of chunk_size; with n_jobs > 1 chunks are split across
+    processes. Returns dataframe with start, stop, summed t (Mass) and
+    p-value of each observed cluster, and the observed t at each timepoint."""
+    diff = np.asarray(diff, dtype=np.float64)
+    n_subs = diff.shape[0]
+    if threshold is None:
+        threshold = stats.t.ppf(1 - alpha/2., n_subs - 1)
+    tobs = paired_t(diff)
+    seeds = np.random.RandomState(seed).randint(0, 2**31 - 1, size=int(np.ceil(n_perm/chunk_size)))
+    chunks = [(diff, threshold, min(chunk_size, n_perm - i*chunk_size), s) for i, s in enumerate(seeds)]
+    if n_jobs > 1:
+        pool = Pool(n_jobs)
+        try:
+            null = pool.map(_null_distribution, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        null = [_null_distribution(chunk) for chunk in chunks]
+    null = np.concatenate(null)
+    clusterlist = []
+    for sign, (labels, masses, _) in zip(['positive','negative'], cluster_masses(tobs, threshold)):
+        labels = labels.ravel()
+        for i, mass in enumerate(masses):
+            idx = np.flatnonzero(labels==i+1)
+            pval = (np.sum(null >= np.abs(mass)) + 1.) / (len(null) + 1.)
+            clusterlist.append({'Start':timepoints[idx[0]], 'Stop':timepoints[idx[-1]],
+                                'Direction':sign, 'Mass':mass, 'pval':pval})
+    clusterdf = pd.DataFrame(clusterlist, columns=['Start','Stop','Direction','Mass','pval'])
+    clusterdf = clusterdf.sort_values('Start').reset_index(drop=True)
+    return clusterdf, tobs
+
+
+def cluster_test_pstc(pstcdf, cond1, cond2, id_cols=('Subject','Session'), **kwargs):
+    """Tests where PSTCs of cond1 and cond2 differ over time. Takes long PSTC
+    dataframe as created by group scripts. Keyword arguments are passed to
+    cluster_permutation_test. Returns dataframe of clusters with the
+    contrast and number of subjects."""
+    data, subjects, timepoints = pstc_array(pstcdf, [cond1, cond2], id_cols=id_cols)
+    return cluster_test_diff(data[:,0,:] - data[:,1,:], timepoints, cond1 + '-' + cond2, **kwargs)
+
+
+def cluster_test_diff(diff, timepoints, contrast, **kwargs):
+    """Tests where (subjects x timepoints) differences of a contrast, e.g. 
+    from pupil_aggregate.PSTCAccumulator.contrast_diffs, differ from 0 over 
+    time. Keyword arguments are passed to cluster_permutation_test. Returns 
+    dataframe of clusters with the contrast and number of subjects."""
+    clusterdf, _ = cluster_permutation_test(diff, timepoints, **kwargs)
+    clusterdf.insert(0, 'Contrast', contrast)
+    clusterdf['N'] = diff.shape[0]
+    return clusterdf
+
+
+def covariate_design(df, covariates=()):
+    """Design of intercept and dummy coded covariates (first sorted level is
+    the reference). Covariates with a single level are left out. Returns
+    array with shape (rows, terms) and term names."""
+    columns = [np.ones(len(df))]
+    terms = ['Intercept']
+    for cov in covariates:
+        values = df[cov].astype(str)
+        for level in sorted(values.unique())[1:]:
+            columns.append((values == level).values.astype(np.float64))
+            terms.append('{0}[{1}]'.format(cov, level))
+    return np.column_stack(columns), terms
+
+
+def _weighted_fit(Y, W, Z):
+    """Weighted least squares of each column of Y (rows x contrasts) on Z
+    with weights W (rows x contrasts). Returns estimates (contrasts x terms),
+    inverse of Z'WZ (contrasts x terms x terms) and residuals."""
+    ZtWZ = np.einsum('ni,nk,nj->kij', Z, W, Z)
+    ZtWZ_inv = np.linalg.pinv(ZtWZ, hermitian=True)
+    est = np.einsum('kij,kj->ki', ZtWZ_inv, np.einsum('ni,nk->ki', Z, W * Y))
+    resid = Y - Z.dot(est.T)
+    return est, ZtWZ_inv, resid
+
+
+def _robust_cov(ZtWZ_inv, Z, W, resid, groups):
+    """Sandwich covariance of estimates with residuals clustered within
+    groups (e.g. sessions of one subject)."""
+    codes, uniques = pd.factorize(pd.Series(groups), sort=True)
+    scores = np.zeros((len(uniques), W.shape[1], Z.shape[1]))
+    np.add.at(scores, codes, Z[:, np.newaxis, :] * (W * resid)[:, :, np.newaxis])
+    meat = np.einsum('gki,gkj->kij', scores, scores)
+    return np.einsum('kij,kjl,klm->kim', ZtWZ_inv, meat, ZtWZ_inv)
+
+
+def meta_regression(Y, V, Z, groups=None):
+    """Fixed and DerSimonian-Laird random effects meta-regression of session
+    estimates Y on design Z, with sampling variances V. Y and V have shape
+    (sessions, contrasts); missing estimates (nan) get weight 0. If groups
+    is given, cluster robust covariances are added. Returns dict with one
+    dict per model ('fixed', 'random') holding est, cov and robust_cov
+    (contrasts x terms [x terms]), and per contrast tau2, Q, I2 and N."""
+    Y = np.asarray(Y, dtype=np.float64)
+    V = np.asarray(V, dtype=np.float64)
+    Z = np.asarray(Z, dtype=np.float64)
+    valid = ~(np.isnan(Y) | np.isnan(V)) & (V > 0)
+    Y = np.where(valid, Y, 0.)
+    with np.errstate(divide='ignore'):
+        W = np.where(valid, 1. / V, 0.)
+    n = valid.sum(axis=0)
+    # Terms estimable from the valid rows of each contrast
+    rank = np.linalg.matrix_rank(np.einsum('ni,nk,nj->kij', Z, valid.astype(np.float64), Z),
+                                 hermitian=True)
+    est, ZtWZ_inv, resid = _weighted_fit(Y, W, Z)
+    Q = np.sum(W * resid**2, axis=0)
+    # tr(W) - tr((Z'WZ)^-1 Z'W^2Z)
+    ZtW2Z = np.einsum('ni,nk,nj->kij', Z, W**2, Z)
+    denom = W.sum(axis=0) - np.einsum('kij,kji->k', ZtWZ_inv, ZtW2Z)
+    dof = n - rank
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tau2 = np.maximum(0., np.where(denom > 0, (Q - dof) / denom, 0.))
+        I2 = np.where(Q > 0, np.maximum(0., (Q - dof) / Q), 0.)
+    results = {'tau2': tau2, 'Q': Q, 'I2': I2, 'N': n}
+    fixed = {'est': est, 'cov': ZtWZ_inv}
+    W_re = np.where(valid, 1. / (V + tau2), 0.)
+    est_re, ZtWZ_inv_re, resid_re = _weighted_fit(Y, W_re, Z)
+    random = {'est': est_re, 'cov': ZtWZ_inv_re}
+    if groups is not None:
+        fixed['robust_cov'] = _robust_cov(ZtWZ_inv, Z, W, resid, groups)
+        random['robust_cov'] = _robust_cov(ZtWZ_inv_re, Z, W_re, resid_re, groups)
+    results['fixed'] = fixed
+    results['random'] = random
+    return results
+
+
+def second_level(glmdf, covariates=('Session',), subject_col='Subject'):
+    """Fixed and random effects group model of every contrast in a tidy
+    table of session GLM results (pupil_glm.group_glm: one row per session
+    and contrast with Beta and SE). Covariates are columns of glmdf, dummy
+    coded. Standard errors robust to repeated sessions of a subject are
+    given as RobustSE. Returns dataframe with one row per contrast, model
+    and term."""
+    keys = [col for col in glmdf.columns if col not in
+            ('Contrast', 'Beta', 'SE', 'T', 'pval', 'DOF', 'Rho')]
+    contrasts = list(pd.unique(glmdf.Contrast))
+    betas = glmdf.pivot_table(index=keys, columns='Contrast', values='Beta', dropna=False)
+    ses = glmdf.pivot_table(index=keys, columns='Contrast', values='SE', dropna=False)
+    betas, ses = betas.reindex(columns=contrasts), ses.reindex(index=betas.index, columns=contrasts)
+    sessions = betas.index.to_frame(index=False)
+    Z, terms = covariate_design(sessions, covariates)
+    fit = meta_regression(betas.values, ses.values**2, Z, groups=sessions[subject_col].values)
+    resultlist = []
+    for model in ('fixed', 'random'):
+        est = fit[model]['est']
+        se = np.sqrt(np.diagonal(fit[model]['cov'], axis1=1, axis2=2))
+        robust_se = np.sqrt(np.diagonal(fit[model]['robust_cov'], axis1=1, axis2=2))
+        for k, contrast in enumerate(contrasts):
+            resultlist.append(pd.DataFrame({'Contrast': contrast, 'Model': model, 'Term': terms,
+                                            'Estimate': est[k], 'SE': se[k],
+                                            'RobustSE': robust_se[k]}))
+            for stat in ('tau2', 'Q', 'I2', 'N'):
+                resultlist[-1][stat] = fit[stat][k]
+    resultdf = pd.concat(resultlist, ignore_index=True)
+    resultdf['Z'] = resultdf.Estimate / resultdf.SE
+    resultdf['pval'] = 2 * stats.norm.sf(np.abs(resultdf.Z))
+    resultdf = resultdf.rename(columns={'tau2': 'Tau2'})
+    return resultdf[['Contrast', 'Model', 'Term', 'Estimate', 'SE', 'Z', 'pval', 'RobustSE',
+                     'Tau2', 'Q', 'I2', 'N']]
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of pupillometry tasks. For each task lists the pattern of input
+file names, the script that processes a subject and the output file whose
+presence marks the session as processed. Used by pupil_catalog.py to find
+and classify sessions.
+
+Patterns are matched against the file basename (case insensitive) and must
+define a 'subid' group. An optional 'session' group holds the oddball session
+number. HVLT delay files hold both recall and recognition, so they are
+matched by both tasks. Tasks with group_jobs accept n_jobs in proc_group.
+Group_output is a glob of the dated file each group script writes to its data
+directory. Oddball raw files are first recoded by a setup step (setup_pattern,
+setup_module), which writes the input of the subject step. Eprime lists how
+to find the E-Prime export read together with the gaze data: (gaze folder
+name, E-Prime folder name, suffix replacing the extension). Contrasts and
+f_tests of tasks with a session GLM are (name, contrast) and (name, list of
+contrasts), written as weighted sums of conditions (see
+pupil_utils.parse_contrast); contrast names are the keys of the GLM results.
+"""
+
+from __future__ import division, print_function, absolute_import
+import os
+import re
+import importlib
+
+GAZE_EXT = r'\.(gazedata|csv|xlsx)$'
+SUBID = r'[-_](?P<subid>\d{3}(?:-\d{2})?)'
+# Files written by the processing scripts, never treated as input
+OUTPUT_PATTERN = re.compile(r'_(SessionData|PSTCdata|FIRdata|ProcessedPupil\w*|AllTrials'
+                            r'|GLMresults|GLMinput|BlinkPct|Epochs|PupilPlot|PSTCplot)\.\w+$', re.IGNORECASE)
+
+TASKS = {
+    'oddball': {
+        'pattern': r'^Oddball' + SUBID + r'(?:[-_]Session(?P<session>[12AB]))?.*_recoded\.gazedata$',
+        'setup_pattern': r'^(?!.*_recoded)Oddball' + SUBID + r'(?:.*Session(?P<session>[12AB]))?.*' + GAZE_EXT,
+        'setup_module': 'oddball_setup_subject',
+        'contrasts': [('Target_Beta', 'Target'), ('Standard_Beta', 'Standard'),
+                      ('ContrastT', 'Target - Standard')],
+        'f_tests': [('Task_F', ['Target', 'Standard'])],
+        'module': 'oddball_proc_subject',
+        'group_module': 'oddball_proc_group',
+        'group_jobs': True,
+        'output': '_SessionData.csv',
+        'group_output': 'oddball_group_data_*.csv',
+        'outdir': 'same',
+        },
+    'stroop': {
+        'pattern': r'^Stroop' + SUBID + r'(?!.*-edat).*' + GAZE_EXT,
+        'module': 'stroop_proc_subject',
+        'eprime': ('Gaze data', 'Edat', '-edat.csv'),
+        'contrasts': [('Incon_t', 'Incongruent'), ('Con_t', 'Congruent'), ('Neut_t', 'Neutral'),
+                      ('InconNeut_t', 'Incongruent - Neutral'),
+                      ('ConNeut_t', 'Congruent - Neutral'),
+                      ('InconCon_t', 'Incongruent - Congruent')],
+        'f_tests': [('Task_F', ['Incongruent', 'Congruent', 'Neutral']),
+                    ('Condition_F', ['Incongruent - Neutral', 'Congruent - Neutral'])],
+        'group_module': 'stroop_proc_group',
+        'group_jobs': True,
+        'output': '_SessionData.csv',
+        'group_output': 'stroop_group_data_*.csv',
+        'outdir': 'proc',
+        },
+    'hvlt_encoding': {
+        'pattern': r'^HVLT-Encoding' + SUBID + r'.*' + GAZE_EXT,
+        'module': 'hvlt_encoding_proc_subject',
+        'group_module': 'hvlt_encoding_quartileSummary',
+        'output': '_ProcessedPupil.csv',
+        'group_output': 'HVLT-Encoding_Quartiles_group_*.csv',
+        'outdir': 'proc',
+        },
+    'hvlt_recall': {
+        'pattern': r'^HVLT-Delay' + SUBID + r'.*' + GAZE_EXT,
+        'module': 'hvlt_recall_proc_subject',
+        'group_module': 'hvlt_recall_quartileSummary',
+        'output': '_ProcessedPupil.csv',
+        'group_output': 'HVLT-Recall_Quartiles_group_*.csv',
+        'outdir': 'proc',
+        'rename': ('-Delay', '-Recall'),
+        },
+    'hvlt_recognition': {
+        'pattern': r'^HVLT-Delay' + SUBID + r'.*' + GAZE_EXT,
+        'module': 'hvlt_recognition_proc_subject',
+        'group_module': 'hvlt_recognition_proc_group',
+        'output': '_ProcessedPupil.csv',
+        'group_output': 'HVLT-Recognition_group_AllTrials_*.csv',
+        'outdir': 'proc',
+        'rename': ('-Delay', '-Recognition'),
+        },
+    'digitspan': {
+        'pattern': r'^DigitSpan' + SUBID + r'.*' + GAZE_EXT,
+        'module': 'digitspan_proc_subject',
+        'group_module': 'digitspan_proc_group',
+        'output': '_ProcessedPupil.csv',
+        'group_output': 'digitspan_group_long_*.csv',
+        'outdir': 'proc',
+        },
+    'fluency': {
+        'pattern': r'^Fluency' + SUBID + r'.*' + GAZE_EXT,
+        'module': 'fluency_proc_subject',
+        'group_module': 'fluency_quartileSummary',
+        'output': '_ProcessedPupil.csv',
+        'group_output': 'fluency_Quartiles_group_*.csv',
+        'outdir': 'proc',
+        },
+    }
+
+_COMPILED = dict((task, re.compile(spec['pattern'], re.IGNORECASE)) for task, spec in TASKS.items())
+
+
+def match_tasks(fname):
+    """Returns list of (task, match) for every task whose pattern matches the
+    basename of fname."""
+    fname_base = os.path.basename(fname)
+    matches = []
+    if OUTPUT_PATTERN.search(fname_base):
+        return matches
+    for task in sorted(TASKS):
+        match = _COMPILED[task].search(fname_base)
+        if match:
+            matches.append((task, match))
+    return matches
+
+
+def output_path(task, infile):
+    """Path of the output that marks infile as processed for task. Does not
+    create any directories."""
+    # Imported here so clients that only need the registry (e.g. pupil_server
+    # submit) do not load pandas and matplotlib
+    import pupil_utils
+    spec = TASKS[task]
+    if spec['outdir'] == 'proc':
+        outfile = pupil_utils.proc_outfile_path(infile, spec['output'])
+    else:
+        outdir = os.path.dirname(infile)
+        fname = os.path.splitext(os.path.basename(infile))[0] + spec['output']
+        outfile = os.path.join(outdir, fname)
+    if 'rename' in spec:
+        outfile = outfile.replace(*spec['rename'])
+    return outfile
+
+
+def eprime_path(task, infile):
+    """Path of the E-Prime file read with infile, None if task has none. The
+    last folder of the path named like the gaze folder is replaced by the
+    E-Prime folder."""
+    if 'eprime' not in TASKS[task]:
+        return None
+    gazedir, edatdir, suffix = TASKS[task]['eprime']
+    pupildir, pupilfile = os.path.split(infile)
+    parts = pupildir.split(os.sep)
+    if gazedir in parts:
+        parts[len(parts) - 1 - parts[::-1].index(gazedir)] = edatdir
+    return os.path.join(os.sep.join(parts), os.path.splitext(pupilfile)[0] + suffix)
+
+
+def input_files(task, infile):
+    """All files read when processing infile for task."""
+    eprime = eprime_path(task, infile)
+    return [infile, eprime] if eprime else [infile]
+
+
+def setup_output_path(task, infile, match):
+    """Path of the file written by the setup step of task for raw infile.
+    Mirrors oddball_setup_subject.rename_gaze_file."""
+    import pupil_utils
+    session = (match.group('session') or 'A').replace('1','A').replace('2','B')
+    procdir = os.path.dirname(pupil_utils.proc_outfile_path(infile, ''))
+    fname = ''.join(['Oddball-', match.group('subid'), '-Session', session, '_recoded.gazedata'])
+    return os.path.join(procdir, fname)
+
+
+def match_setup(fname):
+    """Returns list of (task, match) for every task whose setup step takes
+    fname as input."""
+    fname_base = os.path.basename(fname)
+    matches = []
+    if OUTPUT_PATTERN.search(fname_base):
+        return matches
+    for task in sorted(TASKS):
+        if 'setup_pattern' in TASKS[task]:
+            match = re.search(TASKS[task]['setup_pattern'], fname_base, re.IGNORECASE)
+            if match:
+                matches.append((task, match))
+    return matches
+
+
+def get_task_module(task, group=False, setup=False):
+    """Imports and returns the subject (or group, or setup) processing module
+    of task."""
+    key = 'group_module' if group else 'setup_module' if setup else 'module'
+    return importlib.import_module(TASKS[task][key])
@@ -1,6 +1,8 @@
 from __future__ import division, print_function, absolute_import
 import os
 import re
+import json
+from contextlib import contextmanager
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -8,6 +10,8 @@ import seaborn as sns
 from scipy.signal import butter, filtfilt
 # import matlab_wrapper
 from scipy.signal import fftconvolve
+from scipy import sparse
+from scipy import stats
 from nistats.regression import ARModel, OLSModel
 
 
@@ -36,6 +40,36 @@ def get_subid(sub_col, fname):
     else:
         raise Exception('Subject ID in file {0} does not match filename: {1}'.format(unique_subid, fname))   
     
+def _filedialog():
+    """Imports tkinter only when a dialog is opened, so scripts given files as
+    arguments run without a display. Returns the filedialog module and a
+    hidden root window."""
+    try:
+        # for Python2
+        import Tkinter as tkinter
+        import tkFileDialog as filedialog
+    except ImportError:
+        # for Python3
+        import tkinter
+        from tkinter import filedialog
+    root = tkinter.Tk()
+    root.withdraw()
+    return filedialog, root
+
+
+def ask_filenames(title, filetypes=None):
+    """Opens a dialog to choose files to process. Returns list of files."""
+    filedialog, root = _filedialog()
+    kwargs = {'filetypes': filetypes} if filetypes else {}
+    return list(filedialog.askopenfilenames(parent=root, title=title, **kwargs))
+
+
+def ask_directory(title):
+    """Opens a dialog to choose a directory. Returns its path."""
+    filedialog, root = _filedialog()
+    return filedialog.askdirectory(parent=root, title=title)
+
+
 def get_tpfolder(fname):
     """Given a file path of input file, extract timepoint based on Timepoint folder."""
     try:
@@ -67,17 +101,24 @@ def zscore(x):
     return (x - x.mean()) / x.std()
 
 
-def get_proc_outfile(infile, suffix):
-    """Take infile to derive outdir. Changes path from raw to proc
-    and adds suffix to basename."""
+def proc_outfile_path(infile, suffix):
+    """Path of processed output for infile, as returned by get_proc_outfile,
+    without creating the output directory."""
     outdir = os.path.dirname(infile)
     outdir = re.sub('Raw Pupil Data', 'Processed Pupil Data', outdir, flags=re.IGNORECASE)
     outdir = re.sub("(Gaze|Edat) data/","", outdir, flags=re.IGNORECASE)
+    fname = os.path.splitext(os.path.basename(infile))[0] + suffix
+    return os.path.join(outdir, fname)
+
+
+def get_proc_outfile(infile, suffix):
+    """Take infile to derive outdir. Changes path from raw to proc
+    and adds suffix to basename."""
+    outfile = proc_outfile_path(infile, suffix)
+    outdir = os.path.dirname(outfile)
     if not os.path.exists(outdir):
         'Output directory does not exist, creating now: "{0}"'.format(outdir)
         os.makedirs(outdir)
-    fname = os.path.splitext(os.path.basename(infile))[0] + suffix
-    outfile = os.path.join(outdir, fname)
     return outfile
     
 
@@ -90,6 +131,44 @@ def get_outfile(infile, suffix):
     outfile = os.path.join(outdir, fname)
     return outfile
 
+@contextmanager
+def atomic_write(outfile, mode='w', **kwargs):
+    """Opens a temporary file next to outfile for writing and renames it to
+    outfile when the block completes. A crash while writing leaves any
+    previous outfile in place rather than a partially written file."""
+    outdir, fname = os.path.split(outfile)
+    tmpfile = os.path.join(outdir, '.{0}.{1}.tmp'.format(fname, os.getpid()))
+    try:
+        with open(tmpfile, mode, **kwargs) as f:
+            yield f
+        os.replace(tmpfile, outfile)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+
+def to_csv_atomic(df, outfile, **kwargs):
+    """Writes dataframe to csv with atomic_write. Keyword arguments are passed
+    to DataFrame.to_csv."""
+    with atomic_write(outfile, 'w', newline='') as f:
+        df.to_csv(f, **kwargs)
+
+
+def write_json_atomic(obj, outfile):
+    """Writes object as json with atomic_write."""
+    with atomic_write(outfile, 'w') as f:
+        json.dump(obj, f)
+
+
+def savefig_atomic(fig, outfile, **kwargs):
+    """Saves matplotlib figure with atomic_write. Format is taken from the
+    outfile extension."""
+    fmt = os.path.splitext(outfile)[1].lstrip('.') or None
+    with atomic_write(outfile, 'wb') as f:
+        fig.savefig(f, format=fmt, **kwargs)
+
+
 def get_iqr(x):
     try:
         q75, q25 = np.percentile(x.dropna(), [75 ,25])
@@ -117,9 +196,10 @@ def get_blinks(diameter, validity, pupilthresh_hi=5., pupilthresh_lo=1., gradien
     return blinks
 
 
-def deblink(dfraw, **kwargs):
-    """ Set dilation of all blink trials to nan."""
-    df = dfraw.copy()
+def deblink(dfraw, inplace=False, **kwargs):
+    """ Set dilation of all blink trials to nan. If inplace, dfraw itself is 
+    cleaned and returned instead of a copy of the whole frame."""
+    df = dfraw if inplace else dfraw.copy()
     df.loc[df.DiameterPupilLeftEye<0, 'DiameterPupilLeftEye'] = np.nan
     df.loc[df.DiameterPupilRightEye<0, 'DiameterPupilRightEye'] = np.nan
     df['BlinksLeft'] = get_blinks(df.DiameterPupilLeftEye, df.ValidityLeftEye, **kwargs)
@@ -130,14 +210,21 @@ def deblink(dfraw, **kwargs):
     return df
 
 
+# Filter coefficients depend only on the filter parameters, so they are
+# designed once per process and reused.
+_FILTER_DESIGNS = {}
+
+
 def butter_bandpass(lowcut, highcut, fs, order):
     """Takes the low and high frequencies, sampling rate, and order. Normalizes
-    critical frequencies by the nyquist frequency."""
-    nyq = 0.5 * fs
-    low = lowcut / nyq
-    high = highcut / nyq
-    b, a = butter(order, [low, high], btype='band')
-    return b, a
+    critical frequencies by the nyquist frequency. Coefficients are memoized."""
+    key = ('band', float(lowcut), float(highcut), float(fs), int(order))
+    if key not in _FILTER_DESIGNS:
+        nyq = 0.5 * fs
+        low = lowcut / nyq
+        high = highcut / nyq
+        _FILTER_DESIGNS[key] = butter(order, [low, high], btype='band')
+    return _FILTER_DESIGNS[key]
 
 
 def butter_bandpass_filter(signal, lowcut=0.01, highcut=4., fs=30., order=3):
@@ -151,11 +238,23 @@ def butter_bandpass_filter(signal, lowcut=0.01, highcut=4., fs=30., order=3):
 
 def butter_lowpass(highcut, fs, order):
     """Takes the high frequencies, sampling rate, and order. Normalizes
-    critical frequencies by the nyquist frequency."""
-    nyq = 0.5 * fs
-    high = highcut / nyq
-    b, a = butter(order, high, btype='low')
-    return b, a
+    critical frequencies by the nyquist frequency. Coefficients are memoized."""
+    key = ('low', float(highcut), float(fs), int(order))
+    if key not in _FILTER_DESIGNS:
+        nyq = 0.5 * fs
+        high = highcut / nyq
+        _FILTER_DESIGNS[key] = butter(order, high, btype='low')
+    return _FILTER_DESIGNS[key]
+
+
+def warm_caches():
+    """Designs the default filters and builds the default pupil irf kernels
+    (at the signal rate and the rate used by event_design_precise), e.g. when
+    a long running worker starts."""
+    butter_bandpass(0.01, 4., 30., 3)
+    butter_lowpass(4., 30., 3)
+    get_irf_kernels(30., 2.5)
+    get_irf_kernels(1000., 2.5)
 
 
 def butter_lowpass_filter(signal, highcut=4., fs=30., order=3):
@@ -208,8 +307,9 @@ def resamp_filt_data(df, bin_length='33ms', filt_type='band', string_cols=None):
     df['Time'] = (df.TETTime - df.TETTime.iloc[0]) / 1000.
     df['Timestamp'] = pd.to_datetime(df.Time, unit='s')
     df = df.set_index('Timestamp')
-    dfresamp = df.resample(bin_length, closed='right', label='right').mean()
-    dfresamp['Subject'] = df.Subject[0]
+    # Only numeric columns are averaged, string columns are merged below
+    dfresamp = df.select_dtypes(include=[np.number]).resample(bin_length, closed='right', label='right').mean()
+    dfresamp['Subject'] = df.Subject.iloc[0]
     nearestcols = ['Subject','Session','TrialId','CRESP','ACC','RT',
                    'BlinksLeft','BlinksRight','BlinksLR'] 
     dfresamp[nearestcols] = dfresamp[nearestcols].interpolate('nearest')
@@ -233,10 +333,142 @@ def resamp_filt_data(df, bin_length='33ms', filt_type='band', string_cols=None):
     return dfresamp
 
 
+NEAREST_COLUMNS = ['Subject','Session','TrialId','CRESP','ACC','RT',
+                   'BlinksLeft','BlinksRight','BlinksLR']
+
+
+def _rolling_mean(values, window=5):
+    """Centered rolling mean of an array, nan unless all samples of the 
+    window are valid, as Series.rolling(window, center=True).mean()."""
+    n = len(values)
+    out = np.full(n, np.nan)
+    if n < window:
+        return out
+    valid = ~np.isnan(values)
+    csum = np.zeros(n + 1)
+    np.cumsum(np.where(valid, values, 0.), out=csum[1:])
+    ccount = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(valid, out=ccount[1:])
+    start = (window - 1) // 2
+    full = (ccount[window:] - ccount[:-window]) == window
+    out[start:start + n - window + 1] = np.where(full, (csum[window:] - csum[:-window]) / window, 
+                                                 np.nan)
+    return out
+
+
+def _bin_means(values, pos, n_bins):
+    """Mean of the valid values in each bin, nan for bins without any."""
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    sums = np.bincount(pos, weights=np.where(valid, values, 0.), minlength=n_bins)
+    counts = np.bincount(pos, weights=valid, minlength=n_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def resamp_filt_lean(df, bin_length='33ms', filt_type='band', string_cols=None, keep_cols=()):
+    """Memory lean version of resamp_filt_data for whole sessions. Smoothing, 
+    resampling, interpolation and filtering are done on the arrays of the 
+    left and right pupil only, and nothing is added to df. Returns a slim 
+    frame holding NEAREST_COLUMNS that df has, numeric keep_cols, 
+    DiameterPupilLRResamp, DiameterPupilLRFilt and string_cols, with the same 
+    values and index as those columns of resamp_filt_data. A string column 
+    that is also numeric (e.g. TrialId) is taken from string_cols, as 
+    TrialId_y of resamp_filt_data."""
+    string_cols = list(string_cols or [])
+    # Smoothed left and right pupils are only needed for their mean
+    left = _rolling_mean(df.DiameterPupilLeftEye.values.astype(np.float64))
+    right = _rolling_mean(df.DiameterPupilRightEye.values.astype(np.float64))
+    n_valid = (~np.isnan(left)).astype(np.float64)
+    n_valid += ~np.isnan(right)
+    np.nan_to_num(left, copy=False)
+    np.nan_to_num(right, copy=False)
+    left += right
+    del right
+    with np.errstate(invalid='ignore', divide='ignore'):
+        np.divide(left, n_valid, out=left)
+    lr_smooth = left
+    # Bins closed and labeled on the right, as resample(closed='right', label='right')
+    times = pd.to_datetime((df.TETTime - df.TETTime.iloc[0]) / 1000., unit='s')
+    ns = times.values.astype('datetime64[ns]').astype(np.int64)
+    bin_ns = pd.Timedelta(bin_length).value
+    bins = -(-ns // bin_ns)
+    pos = bins - bins[0]
+    n_bins = int(pos[-1]) + 1
+    index = pd.DatetimeIndex((bins[0] + np.arange(n_bins)) * bin_ns, name='Timestamp')
+    means = {}
+    nearestcols = [col for col in NEAREST_COLUMNS if col != 'Subject']
+    for col in nearestcols + [c for c in keep_cols if c not in NEAREST_COLUMNS]:
+        if col in string_cols or col not in df.columns:
+            continue
+        means[col] = _bin_means(df[col].values, pos, n_bins)
+    dfresamp = pd.DataFrame(means, index=index)
+    dfresamp.insert(0, 'Subject', df.Subject.iloc[0])
+    nearest = [col for col in nearestcols if col in dfresamp.columns]
+    dfresamp[nearest] = dfresamp[nearest].interpolate('nearest')
+    blinkcols = [col for col in ['BlinksLeft','BlinksRight','BlinksLR'] if col in dfresamp.columns]
+    dfresamp[blinkcols] = dfresamp[blinkcols].round()
+    resamp = _bin_means(lr_smooth, pos, n_bins)
+    del lr_smooth
+    valid = ~np.isnan(resamp)
+    if valid.any() and not valid.all():
+        samples = np.arange(n_bins)
+        resamp[~valid] = np.interp(samples[~valid], samples[valid], resamp[valid])
+    dfresamp['DiameterPupilLRResamp'] = resamp
+    if filt_type=='band':
+        dfresamp['DiameterPupilLRFilt'] = butter_bandpass_filter(resamp)
+    elif filt_type=='low':
+        dfresamp['DiameterPupilLRFilt'] = butter_lowpass_filter(resamp)
+    if 'Session' in dfresamp.columns:
+        dfresamp['Session'] = dfresamp['Session'].astype('int')
+    if 'TrialId' in dfresamp.columns:
+        dfresamp['TrialId'] = dfresamp['TrialId'].astype('int')
+    if string_cols:
+        # Value at or before the left edge of each bin, as resample().ffill() 
+        # merged on the labels of the resampled data
+        labels = index.values.astype(np.int64)
+        idx = np.searchsorted(ns, labels, side='right') - 1
+        for col in string_cols:
+            dfresamp[col] = df[col].values[idx]
+        # Labels after the last sample are dropped, as by the inner merge
+        n_keep = np.searchsorted(labels, ns[-1], side='right')
+        if n_keep < n_bins:
+            dfresamp = dfresamp.iloc[:n_keep].copy()
+    return dfresamp
+
+
 def pupil_irf(x, s1=50000., n1=10.1, tmax=0.930):
     return s1 * ((x**n1) * (np.e**((-n1*x)/tmax)))
 
 
+def d_pupil_irf(x, s1=50000., n1=10.1, tmax=0.930):
+    """Analytic temporal derivative of the pupil irf with respect to x."""
+    x = np.asarray(x, dtype=np.float64)
+    return s1 * n1 * (x**(n1-1)) * (np.e**((-n1*x)/tmax)) * (1. - (x/tmax))
+
+
+# Kernels are identical across conditions and subjects for a given set of 
+# parameters, so they are computed once per process and reused.
+_IRF_KERNELS = {}
+
+
+def get_irf_kernels(sampling_rate=30., kernel_end_sec=2.5, s1=50000., n1=10.1, tmax=0.930):
+    """Returns the pupil irf kernel and its temporal derivative sampled at 
+    sampling_rate from 0 to kernel_end_sec. Kernels are memoized per set of 
+    parameters, sampling rate and kernel length. Returned arrays are read-only
+    because they are shared between callers."""
+    key = (float(s1), float(n1), float(tmax), float(sampling_rate), float(kernel_end_sec))
+    if key not in _IRF_KERNELS:
+        kernel_length = kernel_end_sec / (1/sampling_rate)
+        kernel_x = np.linspace(0, kernel_end_sec, int(kernel_length))
+        kernel = pupil_irf(kernel_x, s1=s1, n1=n1, tmax=tmax)
+        dkernel = d_pupil_irf(kernel_x, s1=s1, n1=n1, tmax=tmax)
+        kernel.setflags(write=False)
+        dkernel.setflags(write=False)
+        _IRF_KERNELS[key] = (kernel, dkernel)
+    return _IRF_KERNELS[key]
+
+
 def orthogonalize(y, x):
     """Orthogonalize variable y with respect to variable x. Convert 1-d array
     to 2-d array with shape (n, 1)"""
@@ -249,28 +481,433 @@ def orthogonalize(y, x):
 def convolve_reg(event_ts, kernel):
     return fftconvolve(event_ts, kernel, 'full')[:-(len(kernel)-1)]
 
-    
-def regressor_tempderiv(event_ts, kernel_x, s1=50000., n1=10.1, tmax=0.930):
-    """Takes an array of event onset times and an array of timepoints
-    within each event. First calculates a kernel based on the pupil irf, as 
-    well as the temporal derivative. COnvolves the event onset times with both 
-    to get an event regressor and regressor for the temporal derivative. 
-    Then orthogonalizes the temporal derivative regressor with respect to the 
-    event regressor."""
-    kernel = pupil_irf(kernel_x, s1=s1, n1=n1, tmax=tmax)
-    dkernel = d_pupil_irf(kernel_x,  s1=s1, n1=n1, tmax=tmax)
-    event_reg = convolve_reg(event_ts, kernel)
-    td_reg = convolve_reg(event_ts, dkernel)
-    td_reg_orth = orthogonalize(td_reg, event_reg)
-    return event_reg, td_reg_orth
-
 
-def d_pupil_irf(x, s1=50000., n1=10.1, tmax=0.930):
-    y = pupil_irf(x)
-    dy = np.zeros(y.shape,np.float)
-    dy[0:-1] = np.diff(y)/np.diff(x)
-    dy[-1] = (y[-1] - y[-2])/(x[-1] - x[-2])
-    return dy
+def scatter_kernel(onset_idx, kernel, n_samples):
+    """Equivalent to convolving a binary event vector of length n_samples with 
+    kernel and truncating to n_samples. The kernel is added at each onset index 
+    instead, so cost scales with number of events times kernel length rather
+    than with session length."""
+    onset_idx = np.unique(np.asarray(onset_idx, dtype=np.int64))
+    idx = onset_idx[:, np.newaxis] + np.arange(len(kernel))
+    valid = (idx >= 0) & (idx < n_samples)
+    weights = np.broadcast_to(kernel, idx.shape)[valid]
+    return np.bincount(idx[valid], weights=weights, minlength=n_samples)
+
+
+def event_design(onsets, n_samples, sampling_rate=30., kernel_end_sec=2.5, 
+                 tempderiv=False, s1=50000., n1=10.1, tmax=0.930):
+    """Builds convolved event regressors for all conditions in one call. Onsets 
+    is a list with one array of onset sample indices per condition. Returns an 
+    array of shape (n_samples, n_conditions) with one event regressor per 
+    condition. If tempderiv is True, temporal derivative regressors 
+    orthogonalized with respect to their event regressor are appended in the 
+    same condition order, giving shape (n_samples, 2*n_conditions)."""
+    kernel, dkernel = get_irf_kernels(sampling_rate, kernel_end_sec, s1=s1, n1=n1, tmax=tmax)
+    ncols = len(onsets) * 2 if tempderiv else len(onsets)
+    X = np.zeros((n_samples, ncols))
+    for i, onset_idx in enumerate(onsets):
+        X[:,i] = scatter_kernel(onset_idx, kernel, n_samples)
+        if tempderiv:
+            event_reg = X[:,i]
+            td_reg = scatter_kernel(onset_idx, dkernel, n_samples)
+            denom = np.dot(event_reg, event_reg)
+            if denom > 0:
+                td_reg = td_reg - (np.dot(td_reg, event_reg) / denom) * event_reg
+            X[:,len(onsets)+i] = td_reg
+    return X
+
+
+def get_sample_times(pupilts):
+    """Returns time in seconds of each sample of a resampled series. Time 0 is 
+    the first raw sample, as set in resamp_filt_data."""
+    return np.asarray((pupilts.index - pd.Timestamp(0)).total_seconds(), dtype=np.float64)
+
+
+def get_onset_times(df, trial_col='TrialId', mask=None):
+    """Returns exact onset time in seconds of each trial from raw TETTime, 
+    relative to the first raw sample. If mask is given, onset is the first 
+    sample of each trial where mask is True."""
+    start = df.TETTime.iloc[0]
+    if mask is not None:
+        df = df[mask]
+    onset_times = (df.groupby(trial_col)['TETTime'].first() - start) / 1000.
+    return onset_times
+
+
+def get_onset_samples(onset_times, sample_times, condition='Event'):
+    """Converts onset times (sec) to the index of the resampled sample whose 
+    bin contains the onset. Onsets that are missing or fall outside the bins 
+    of the signal (as in event_design_precise) are dropped and reported with 
+    print_outside_onsets."""
+    onset_times = np.asarray(onset_times, dtype=np.float64)
+    sample_times = np.asarray(sample_times, dtype=np.float64)
+    bin_width = np.median(np.diff(sample_times))
+    is_outside = (np.isnan(onset_times) | (onset_times <= sample_times[0] - bin_width) | 
+                  (onset_times > sample_times[-1]))
+    print_outside_onsets([onset_times[is_outside]], [condition])
+    return np.searchsorted(sample_times, onset_times[~is_outside], side='left')
+
+
+def upsample_bins(sample_times, upsample_rate=1000.):
+    """Grid at upsample_rate under the bins of a resampled signal. Returns 
+    time of grid position 0 (start of the first bin), grid length, and first 
+    and one past last grid position and number of grid positions of each 
+    sample's bin. Sample j covers (t_j - bin width, t_j], as in 
+    resamp_filt_data."""
+    bin_width = np.median(np.diff(sample_times))
+    t0 = sample_times[0] - bin_width
+    # Sample times read back from a datetime index are rounded to ns, so allow 
+    # for that when a bin edge falls on a grid position
+    tol = 1e-3
+    n_hi = int(np.floor((sample_times[-1] - t0) * upsample_rate + tol)) + 1
+    starts = np.floor((sample_times - bin_width - t0) * upsample_rate + tol).astype(np.int64) + 1
+    stops = np.floor((sample_times - t0) * upsample_rate + tol).astype(np.int64) + 1
+    counts = np.maximum(stops - starts, 1)
+    return t0, n_hi, starts, stops, counts
+
+
+def upsample_onsets(onset_times, sample_times, t0, upsample_rate=1000.):
+    """Grid positions (see upsample_bins) of onsets within the signal, and 
+    array of the onsets that are missing or outside it."""
+    onset_times = np.asarray(onset_times, dtype=np.float64)
+    is_outside = np.isnan(onset_times) | (onset_times <= t0) | (onset_times > sample_times[-1])
+    onset_idx = np.round((onset_times[~is_outside] - t0) * upsample_rate).astype(np.int64)
+    return onset_idx, onset_times[is_outside]
+
+
+def precise_lag_matrix(onset_idx, n_lags, starts, stops, counts):
+    """Sparse matrix (samples x n_lags) mapping a kernel sampled on the 
+    upsampled grid to the decimated event regressor of onsets at grid 
+    positions onset_idx, i.e. matrix.dot(kernel) is the regressor 
+    event_design_precise builds with that kernel."""
+    onset_idx = np.unique(np.asarray(onset_idx, dtype=np.int64))
+    pos = (onset_idx[:, np.newaxis] + np.arange(n_lags)).ravel()
+    lags = np.tile(np.arange(n_lags), len(onset_idx))
+    sample = np.searchsorted(stops, pos, side='right')
+    valid = sample < len(stops)
+    valid[valid] = pos[valid] >= starts[sample[valid]]
+    sample, lags = sample[valid], lags[valid]
+    return sparse.csr_matrix((1. / counts[sample], (sample, lags)), shape=(len(stops), n_lags))
+
+
+def event_design_precise(onset_times, sample_times, kernel_end_sec=2.5, upsample_rate=1000.,
+                         tempderiv=False, s1=50000., n1=10.1, tmax=0.930):
+    """Builds convolved event regressors from exact onset times rather than 
+    onsets snapped to the resampled grid. Onset_times is a list with one array 
+    of onset times (sec) per condition, on the same clock as sample_times. 
+    Onsets are placed on a grid at upsample_rate, convolved with a kernel 
+    sampled at that rate, and each regressor is then decimated to the signal 
+    by averaging over the bin of each sample (bins are closed on the right, as 
+    in resamp_filt_data). Kernels at upsample_rate are cached like signal rate 
+    kernels. Returns the design array with the same column layout as 
+    event_design and a list with one array per condition of onsets that fall 
+    outside the signal and were not modeled."""
+    sample_times = np.asarray(sample_times, dtype=np.float64)
+    n_samples = len(sample_times)
+    t0, n_hi, starts, stops, counts = upsample_bins(sample_times, upsample_rate)
+    kernel, dkernel = get_irf_kernels(upsample_rate, kernel_end_sec, s1=s1, n1=n1, tmax=tmax)
+    
+    def decimate(hi_reg):
+        csum = np.concatenate(([0.], np.cumsum(hi_reg)))
+        return (csum[stops] - csum[starts]) / counts
+    
+    ncols = len(onset_times) * 2 if tempderiv else len(onset_times)
+    X = np.zeros((n_samples, ncols))
+    outside = []
+    for i, cond_onsets in enumerate(onset_times):
+        onset_idx, cond_outside = upsample_onsets(cond_onsets, sample_times, t0, upsample_rate)
+        outside.append(cond_outside)
+        X[:,i] = decimate(scatter_kernel(onset_idx, kernel, n_hi))
+        if tempderiv:
+            event_reg = X[:,i]
+            td_reg = decimate(scatter_kernel(onset_idx, dkernel, n_hi))
+            denom = np.dot(event_reg, event_reg)
+            if denom > 0:
+                td_reg = td_reg - (np.dot(td_reg, event_reg) / denom) * event_reg
+            X[:,len(onset_times)+i] = td_reg
+    return X, outside
+
+
+def print_outside_onsets(outside, conditions):
+    """Reports onsets returned by event_design_precise that were not modeled."""
+    for cond, cond_outside in zip(conditions, outside):
+        if len(cond_outside) > 0:
+            print('{0} {1} onsets fall outside the signal and were not modeled: {2}'.format(
+                    len(cond_outside), cond, cond_outside))
+
+
+def fir_design(onsets, n_samples, n_lags, first_lag=0):
+    """Builds a sparse finite impulse response design. Onsets is a list with 
+    one array of onset sample indices per condition. Column i*n_lags + k is 1 
+    at sample first_lag + k after each onset of condition i, so the fitted 
+    betas give a free-form response for each condition. Returns a 
+    scipy.sparse csr matrix of shape (n_samples, n_conditions*n_lags)."""
+    rows = [np.zeros(0, dtype=np.int64)]
+    cols = [np.zeros(0, dtype=np.int64)]
+    lags = np.arange(n_lags)
+    for i, onset_idx in enumerate(onsets):
+        onset_idx = np.unique(np.asarray(onset_idx, dtype=np.int64))
+        idx = onset_idx[:, np.newaxis] + first_lag + lags
+        col = np.broadcast_to(i*n_lags + lags, idx.shape)
+        valid = (idx >= 0) & (idx < n_samples)
+        rows.append(idx[valid])
+        cols.append(col[valid])
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    X = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), 
+                          shape=(n_samples, len(onsets)*n_lags))
+    return X
+
+
+def ar1_whiten(X, y, rho):
+    """Prewhitens design and data for AR(1) noise with coefficient rho. Each 
+    sample becomes x[t] - rho*x[t-1] and the first sample is scaled by 
+    sqrt(1 - rho**2). X may be dense or scipy.sparse. Note nistats ARModel 
+    (used for the canonical design) leaves the first sample unchanged, and 
+    with rho=1 this zeroes it, so FIR and canonical statistics are not 
+    directly comparable."""
+    n = X.shape[0]
+    diag = np.ones(n)
+    diag[0] = np.sqrt(1. - rho**2)
+    W = sparse.diags([diag, -rho*np.ones(n-1)], [0, -1], format='csr')
+    return W.dot(X), W.dot(y)
+
+
+def _normal_lstsq(X, y):
+    """Solves least squares through the normal equations. X'X is small even 
+    when X is a long sparse design, so the pseudo-inverse is cheap and handles 
+    columns that cannot be estimated (e.g. conditions without events)."""
+    XtX = X.T.dot(X)
+    XtX = XtX.toarray() if sparse.issparse(XtX) else np.asarray(XtX)
+    XtX_inv = np.linalg.pinv(XtX, hermitian=True)
+    beta = XtX_inv.dot(X.T.dot(y))
+    rank = np.linalg.matrix_rank(XtX, hermitian=True)
+    return beta, XtX_inv, rank
+
+
+def fit_ar1(X, y, rho=None):
+    """Least squares fit of y on design X (dense or scipy.sparse) with AR(1) 
+    prewhitening. If rho is None it is estimated as the lag-1 autocorrelation 
+    of the OLS residuals. Returns dict with beta, cov (covariance of beta), 
+    dof, rho and sigma2 (residual variance of whitened model)."""
+    y = np.asarray(y, dtype=np.float64).ravel()
+    if rho is None:
+        beta, _, _ = _normal_lstsq(X, y)
+        resid = y - X.dot(beta)
+        rho = np.dot(resid[1:], resid[:-1]) / np.dot(resid, resid)
+    Xw, yw = ar1_whiten(X, y, rho)
+    beta, XtX_inv, rank = _normal_lstsq(Xw, yw)
+    resid = yw - Xw.dot(beta)
+    dof = X.shape[0] - rank
+    sigma2 = np.dot(resid, resid) / dof
+    fit = {'beta':beta, 'cov':sigma2*XtX_inv, 'dof':dof, 'rho':float(rho), 'sigma2':sigma2}
+    return fit
+
+
+def t_contrast(fit, contrast):
+    """T statistic of a contrast vector for a fit returned by fit_ar1."""
+    contrast = np.asarray(contrast, dtype=np.float64)
+    effect = np.dot(contrast, fit['beta'])
+    se = np.sqrt(np.dot(contrast, fit['cov']).dot(contrast))
+    return float(effect / se)
+
+
+_CONTRAST_TERM = re.compile(r'\s*([+-])?\s*(?:(\d*\.?\d+(?:[eE][+-]?\d+)?)\s*\*?\s*)?([A-Za-z_]\w*)\s*')
+
+
+def parse_contrast(spec):
+    """Parses a contrast written as a weighted sum of named columns, e.g. 
+    'Incongruent - Congruent' or '0.5*Target + 0.5*Standard'. Returns list of 
+    (weight, name)."""
+    terms = []
+    pos = 0
+    while pos < len(spec):
+        match = _CONTRAST_TERM.match(spec, pos)
+        if match is None or match.end() == pos or (terms and match.group(1) is None):
+            raise ValueError('Could not parse contrast {0!r} at {1!r}'.format(spec, spec[pos:]))
+        sign = -1. if match.group(1) == '-' else 1.
+        weight = float(match.group(2)) if match.group(2) else 1.
+        terms.append((sign * weight, match.group(3)))
+        pos = match.end()
+    if not terms:
+        raise ValueError('Empty contrast')
+    return terms
+
+
+def compile_contrasts(specs, columns):
+    """Compiles named contrasts into a contrast matrix. Specs is a list of 
+    (name, contrast string). Columns is a list of design column names, or a 
+    dictionary of name to weight vector over the design columns (e.g. the 
+    mean FIR response of a condition). Returns contrast names and matrix 
+    with shape (contrasts, design columns)."""
+    if not isinstance(columns, dict):
+        columns = dict((name, np.eye(len(columns))[i]) for i, name in enumerate(columns))
+    n_cols = len(next(iter(columns.values())))
+    names = []
+    C = np.zeros((len(specs), n_cols))
+    for i, (name, spec) in enumerate(specs):
+        for weight, col in parse_contrast(spec):
+            if col not in columns:
+                raise ValueError('Unknown column {0} in contrast {1}, design has {2}'.format(
+                        col, name, ', '.join(sorted(columns))))
+            C[i] += weight * np.asarray(columns[col], dtype=np.float64)
+        names.append(name)
+    return names, C
+
+
+def t_contrasts(beta, cov, C, dof):
+    """Effect, standard error, t and two-sided p of every contrast (rows of C) 
+    at once."""
+    C = np.atleast_2d(C)
+    effect = C.dot(beta)
+    se = np.sqrt(np.einsum('ki,ij,kj->k', C, cov, C))
+    t = effect / se
+    return effect, se, t, 2 * stats.t.sf(np.abs(t), dof)
+
+
+def f_contrast(beta, cov, C, dof):
+    """F statistic and p of the joint null hypothesis that all contrasts 
+    (rows of C) are 0."""
+    C = np.atleast_2d(C)
+    effect = C.dot(beta)
+    rank = np.linalg.matrix_rank(C)
+    F = float(effect.dot(np.linalg.pinv(C.dot(cov).dot(C.T))).dot(effect) / rank)
+    return F, float(stats.f.sf(F, rank, dof))
+
+
+def contrast_results(beta, cov, dof, columns, contrasts, f_tests=()):
+    """Evaluates named contrasts and F-tests (lists of (name, contrast 
+    strings)) of a fitted model with estimates beta, covariance cov and 
+    residual degrees of freedom dof. Returns dictionary with the t of each 
+    contrast under its name and <name>_effect, <name>_se and <name>_p, and 
+    the F and p of each F-test as <name> and <name>_p."""
+    beta = np.asarray(beta, dtype=np.float64).ravel()
+    cov = np.asarray(cov, dtype=np.float64).reshape(len(beta), len(beta))
+    names, C = compile_contrasts(contrasts, columns)
+    effect, se, t, pval = t_contrasts(beta, cov, C, dof)
+    results = {}
+    for i, name in enumerate(names):
+        results[name] = float(t[i])
+        results[name + '_effect'] = float(effect[i])
+        results[name + '_se'] = float(se[i])
+        results[name + '_p'] = float(pval[i])
+    for name, specs in f_tests:
+        _, Cf = compile_contrasts([(name, spec) for spec in specs], columns)
+        results[name], results[name + '_p'] = f_contrast(beta, cov, Cf, dof)
+    return results
+
+
+def fir_glm(signal, onsets, nuisance, conditions, sampling_rate=30., fir_window=(0., 4.), rho=None):
+    """Fits a finite impulse response GLM estimating a free-form response for 
+    each condition over fir_window (sec, relative to onset). Onsets is a list 
+    with one array of onset sample indices per condition. Design is intercept, 
+    FIR columns for each condition, then nuisance columns, stored as a sparse 
+    matrix and fit with fit_ar1. Returns:
+        1. Fit dictionary from fit_ar1
+        2. Dataframe of FIR estimates (Beta, SE, t) per condition and timepoint
+        3. Dictionary of contrast vectors giving the mean response over the 
+           window for each condition"""
+    first_lag = int(round(fir_window[0] * sampling_rate))
+    last_lag = int(round(fir_window[1] * sampling_rate))
+    n_lags = last_lag - first_lag + 1
+    n_samples = len(signal)
+    fir = fir_design(onsets, n_samples, n_lags, first_lag=first_lag)
+    nuisance = np.atleast_2d(np.asarray(nuisance, dtype=np.float64).T).T
+    X = sparse.hstack([sparse.csr_matrix(np.ones((n_samples, 1))), fir, 
+                       sparse.csr_matrix(nuisance)], format='csr')
+    fit = fit_ar1(X, signal, rho=rho)
+    se = np.sqrt(np.diag(fit['cov']))
+    timepoints = (first_lag + np.arange(n_lags)) / sampling_rate
+    firdf_list = []
+    mean_contrasts = {}
+    for i, cond in enumerate(conditions):
+        cols = 1 + i*n_lags + np.arange(n_lags)
+        firdf_list.append(pd.DataFrame({'Condition':cond, 'Timepoint':timepoints,
+                                        'Beta':fit['beta'][cols], 'SE':se[cols],
+                                        't':fit['beta'][cols] / se[cols]}))
+        contrast = np.zeros(X.shape[1])
+        contrast[cols] = 1. / n_lags
+        mean_contrasts[cond] = contrast
+    firdf = pd.concat(firdf_list, ignore_index=True)
+    return fit, firdf, mean_contrasts
+
+
+def irf_kernel_grid(n1_grid, tmax_grid, sampling_rate=30., kernel_end_sec=2.5, s1=50000.):
+    """Builds pupil irf kernels for every combination of n1 and tmax. Returns 
+    array of candidate parameters with shape (n_candidates, 2), columns n1 and 
+    tmax, and array of kernels with shape (n_candidates, kernel length)."""
+    n1s, tmaxs = np.meshgrid(np.asarray(n1_grid, dtype=np.float64), 
+                             np.asarray(tmax_grid, dtype=np.float64), indexing='ij')
+    params = np.column_stack((n1s.ravel(), tmaxs.ravel()))
+    kernel_length = kernel_end_sec / (1/sampling_rate)
+    kernel_x = np.linspace(0, kernel_end_sec, int(kernel_length))
+    kernels = pupil_irf(kernel_x[np.newaxis,:], s1=s1, n1=params[:,[0]], tmax=params[:,[1]])
+    return params, kernels
+
+
+def fit_irf_grid(signal, onset_times, sample_times, nuisance, kernel_end_sec=2.5, 
+                 upsample_rate=1000., s1=50000., rho=1., n1_grid=None, tmax_grid=None,
+                 chunk_size=64):
+    """Searches a grid of pupil irf shape parameters (n1, tmax) for the kernel 
+    that best fits the signal. Candidates are scored with the model of ts_glm: 
+    design of intercept, one regressor per condition built from exact onset 
+    times as in event_design_precise, and nuisance columns, fit with the AR 
+    whitening of ARModel(X, rho). Onset_times is a list with one array of 
+    onset times (sec) per condition, on the same clock as sample_times; onsets 
+    outside the signal are left out, as in event_design_precise. Default grid 
+    is n1 from 6 to 14 by 0.5 and tmax from 0.5 to 1.8 by 0.05. Kernels of 
+    all candidates are mapped to regressors at once through a sparse lag 
+    matrix per condition, and candidate designs are fit in batches of 
+    chunk_size by normal equations. The candidate with the lowest residual 
+    sum of squares of the whitened model is chosen. Returns dictionary of best 
+    fitting s1, n1, tmax and rss, and the rss of all candidates as an array 
+    with shape (len(n1_grid), len(tmax_grid))."""
+    if n1_grid is None:
+        n1_grid = np.arange(6., 14.01, 0.5)
+    if tmax_grid is None:
+        tmax_grid = np.arange(0.5, 1.801, 0.05)
+    y = np.asarray(signal, dtype=np.float64).ravel()
+    sample_times = np.asarray(sample_times, dtype=np.float64)
+    n_samples = len(y)
+    params, kernels = irf_kernel_grid(n1_grid, tmax_grid, upsample_rate, kernel_end_sec, s1=s1)
+    n_cands, n_lags = kernels.shape
+    t0, _, starts, stops, counts = upsample_bins(sample_times, upsample_rate)
+    lagmats = [precise_lag_matrix(upsample_onsets(cond_onsets, sample_times, t0, upsample_rate)[0], 
+                                  n_lags, starts, stops, counts) 
+               for cond_onsets in onset_times]
+    # Fixed columns shared by every candidate design, whitened as by ts_glm
+    nuisance = np.atleast_2d(np.asarray(nuisance, dtype=np.float64).T).T
+    ar_model = ARModel(np.column_stack((np.ones(n_samples), nuisance)), rho=rho)
+    F = ar_model.wdesign
+    yw = ar_model.whiten(y)
+    n_fixed = F.shape[1]
+    n_cols = n_fixed + len(lagmats)
+    rss = np.empty(n_cands)
+    for first in range(0, n_cands, chunk_size):
+        block = slice(first, min(first + chunk_size, n_cands))
+        # Whitened event regressors of the block, one (n_samples, candidates) array per condition
+        E = [ar_model.whiten(lagmat.dot(kernels[block].T)) for lagmat in lagmats]
+        n_block = E[0].shape[1] if E else block.stop - block.start
+        XtX = np.empty((n_block, n_cols, n_cols))
+        Xty = np.empty((n_block, n_cols))
+        XtX[:, :n_fixed, :n_fixed] = F.T.dot(F)
+        Xty[:, :n_fixed] = F.T.dot(yw)
+        for i, Ei in enumerate(E):
+            FtE = F.T.dot(Ei).T
+            XtX[:, n_fixed+i, :n_fixed] = FtE
+            XtX[:, :n_fixed, n_fixed+i] = FtE
+            Xty[:, n_fixed+i] = Ei.T.dot(yw)
+            for j, Ej in enumerate(E[:i+1]):
+                EtE = np.einsum('nc,nc->c', Ei, Ej)
+                XtX[:, n_fixed+i, n_fixed+j] = EtE
+                XtX[:, n_fixed+j, n_fixed+i] = EtE
+        beta = np.einsum('cij,cj->ci', np.linalg.pinv(XtX, hermitian=True), Xty)
+        rss[block] = np.dot(yw, yw) - np.einsum('ci,ci->c', beta, Xty)
+    best = np.argmin(rss)
+    irf_fit = {'s1':float(s1), 'n1':round(float(params[best,0]), 4), 
+               'tmax':round(float(params[best,1]), 4),
+               'rss':float(rss[best])}
+    return irf_fit, rss.reshape(len(n1_grid), len(tmax_grid))
 
 
 def plot_qc(dfresamp, infile):
@@ -279,8 +916,9 @@ def plot_qc(dfresamp, infile):
     signal = dfresamp.DiameterPupilLRResamp.values
     signal_bp = dfresamp.DiameterPupilLRFilt.values
     blinktimes = dfresamp.BlinksLR.values
+    fig = plt.figure()
     plt.plot(range(len(signal)), signal, sns.xkcd_rgb["pale red"], 
          range(len(signal_bp)), signal_bp+np.nanmean(signal), sns.xkcd_rgb["denim blue"], 
          blinktimes, sns.xkcd_rgb["amber"], lw=1)
-    plt.savefig(outfile)
-    plt.close()
+    savefig_atomic(fig, outfile)
+    plt.close(fig)
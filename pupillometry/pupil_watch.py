@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Watches raw data folders and processes new sessions as they are uploaded.
+
+Folders are polled every interval seconds for input files of the tasks in
+pupil_tasks.py. A file is processed once it has settled: its size and
+modification time have not changed for settle seconds, so files still being
+copied are left alone. Stroop sessions also wait for their E-Prime export.
+Raw oddball files are recoded by the setup step first; the recoded file is
+then picked up by the next poll.
+
+Sessions are run in a pool of worker processes started once, with all task
+modules (pandas, scipy, nistats, ...) imported up front, so no start-up cost
+is paid per file. Sessions with an up to date output are skipped, and a
+failed session is only retried when one of its input files changes.
+Polling is used rather than file system events so network shares work.
+
+    pupil_watch.py [--jobs 4] [--settle 30] [--interval 10] <data directory> ...
+"""
+
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+import time
+import argparse
+import traceback
+from multiprocessing import Pool
+import pupil_tasks
+import pupil_catalog
+import pupil_journal
+try:
+    # for Python2
+    import Queue as queue
+except ImportError:
+    # for Python3
+    import queue
+
+
+def init_worker(tasks):
+    """Imports task modules once in each worker process."""
+    import matplotlib
+    matplotlib.use('agg')
+    for task in tasks:
+        pupil_tasks.get_task_module(task)
+        if 'setup_module' in pupil_tasks.TASKS[task]:
+            pupil_tasks.get_task_module(task, setup=True)
+
+
+def file_signature(fname, stat=None):
+    """Size and modification time of fname."""
+    stat = stat or os.stat(fname)
+    return (stat.st_size, stat.st_mtime)
+
+
+def run_job(args):
+    """Runs the setup or subject step of task on one file. Defined at module
+    level so it can be sent to worker processes. Returns the job, error
+    message (None on success) and run time in seconds."""
+    step, task, fname = args
+    start = time.time()
+    try:
+        if step == 'setup':
+            pupil_tasks.get_task_module(task, setup=True).setup_subject([fname])
+        else:
+            pupil_tasks.get_task_module(task).proc_subject([fname])
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return args, error, time.time() - start
+
+
+class Watcher(object):
+    """Polls datadirs and dispatches settled, unprocessed sessions to a pool."""
+
+    def __init__(self, datadirs, tasks=None, timepoints=None, jobs=1, settle=30.,
+                 catalog=None, journal=None, skip_existing=False):
+        self.datadirs = datadirs
+        self.tasks = tasks or sorted(pupil_tasks.TASKS)
+        self.timepoints = timepoints
+        self.settle = settle
+        self.catalog = catalog
+        self.journal = journal
+        self.files = {}
+        self.signatures = {}
+        self.running = set()
+        self.failed = {}
+        self.ignored = {}
+        self.missing = set()
+        self.results = queue.Queue()
+        self.pool = Pool(jobs, initializer=init_worker, initargs=(self.tasks,))
+        if skip_existing:
+            for job, inputs in self.find_jobs().items():
+                if all(os.path.exists(inp) for inp in inputs):
+                    self.ignored[job] = [file_signature(inp) for inp in inputs]
+
+    def settled(self, fname, now):
+        """Records size and modification time of fname. True once they have
+        not changed for settle seconds."""
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            self.files.pop(fname, None)
+            return False
+        signature = file_signature(fname, stat)
+        if self.files.get(fname, (None,))[0] != signature:
+            self.files[fname] = (signature, now)
+        return now - self.files[fname][1] >= self.settle and now - stat.st_mtime >= self.settle
+
+    def find_jobs(self):
+        """Returns dictionary of (step, task, file) to input files of all
+        setup and subject steps whose outputs are missing or older than their
+        inputs."""
+        jobs = {}
+        candidates = []
+        for fname in pupil_catalog.iter_files(self.datadirs):
+            candidates.append(fname)
+            for task, match in pupil_tasks.match_setup(fname):
+                if task in self.tasks:
+                    outfile = pupil_tasks.setup_output_path(task, fname, match)
+                    jobs[('setup', task, fname)] = ([fname], outfile)
+                    # Setup output may be written outside the watched folders
+                    if os.path.exists(outfile):
+                        candidates.append(outfile)
+        for fname in sorted(set(candidates)):
+            for task, match in pupil_tasks.match_tasks(fname):
+                if task not in self.tasks:
+                    continue
+                meta = pupil_catalog.parse_session(fname, task, match)
+                if self.timepoints and meta['timepoint'] not in self.timepoints:
+                    continue
+                jobs[('subject', task, fname)] = (pupil_tasks.input_files(task, fname),
+                                                  meta['output_path'])
+        todo = {}
+        for job, (inputs, outfile) in jobs.items():
+            input_mtimes = [pupil_catalog.file_mtime(inp) for inp in inputs]
+            output_mtime = pupil_catalog.file_mtime(outfile)
+            if None in input_mtimes or output_mtime is None or output_mtime < max(input_mtimes):
+                todo[job] = inputs
+        return todo
+
+    def poll(self):
+        """Dispatches settled jobs and handles finished ones. Returns number
+        of jobs dispatched and number of jobs waiting for files to settle."""
+        self.collect()
+        now = time.time()
+        dispatched, waiting = 0, 0
+        for job, inputs in sorted(self.find_jobs().items()):
+            if job in self.running:
+                continue
+            missing = [inp for inp in inputs if not os.path.exists(inp)]
+            if missing:
+                if job not in self.missing:
+                    print('Waiting for {0}'.format(missing[0]))
+                    self.missing.add(job)
+                continue
+            self.missing.discard(job)
+            if not all([self.settled(inp, now) for inp in inputs]):
+                waiting += 1
+                continue
+            signature = [self.files[inp][0] for inp in inputs]
+            if signature in (self.failed.get(job), self.ignored.get(job)):
+                continue
+            self.failed.pop(job, None)
+            self.ignored.pop(job, None)
+            step, task, fname = job
+            print('Starting {0} {1} {2}'.format(step, task, fname))
+            if self.journal and step == 'subject':
+                pupil_journal.record(self.journal, task, fname, 'running', attempt=1)
+            self.running.add(job)
+            self.signatures[job] = signature
+            self.pool.apply_async(run_job, (job,), callback=self.results.put)
+            dispatched += 1
+        return dispatched, waiting
+
+    def collect(self, timeout=None):
+        """Handles jobs finished so far. If timeout is given, waits up to
+        timeout seconds for a job to finish."""
+        finished = []
+        while True:
+            try:
+                if timeout is not None and not finished:
+                    finished.append(self.results.get(timeout=timeout))
+                else:
+                    finished.append(self.results.get(block=False))
+            except queue.Empty:
+                break
+        for job, error, seconds in finished:
+            step, task, fname = job
+            self.running.discard(job)
+            signature = self.signatures.pop(job)
+            print('{0} {1} {2} {3} ({4:.1f} s)'.format('FAILED' if error else 'Finished',
+                                                       step, task, fname, seconds))
+            if error:
+                print(error)
+                self.failed[job] = signature
+            if self.journal and step == 'subject':
+                pupil_journal.record(self.journal, task, fname, 'failed' if error else 'done',
+                                     attempt=1, duration=seconds, error=error)
+        if finished and self.catalog:
+            pupil_catalog.crawl(self.catalog, self.datadirs, verbose=False)
+            for job, error, seconds in finished:
+                if error and job[0] == 'subject':
+                    pupil_catalog.mark_status(self.catalog, job[2], job[1], 'failed')
+        return len(finished)
+
+    def run(self, interval=10., once=False):
+        """Polls until interrupted. If once, returns when no settled job is
+        left to run."""
+        try:
+            while True:
+                dispatched, waiting = self.poll()
+                if once and not (dispatched or waiting or self.running):
+                    break
+                if self.running:
+                    # Wake up early when a job finishes
+                    self.collect(timeout=interval)
+                else:
+                    time.sleep(interval)
+        except KeyboardInterrupt:
+            print('Stopping, {0} jobs were running'.format(len(self.running)))
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+        return sorted(self.failed)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Process new pupillometry sessions as they '
+                                     'are uploaded.')
+    parser.add_argument('datadirs', nargs='+', help='Directories to watch (recursively)')
+    parser.add_argument('--task', action='append', choices=sorted(pupil_tasks.TASKS),
+                        help='Task to process (repeatable, default all)')
+    parser.add_argument('--timepoint', action='append', type=int,
+                        help='Timepoint to process (repeatable, default all)')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--settle', type=float, default=30.,
+                        help='Seconds a file must be unchanged before it is processed')
+    parser.add_argument('--interval', type=float, default=10., help='Seconds between polls')
+    parser.add_argument('--catalog', help='Catalog database to update (see pupil_catalog.py)')
+    parser.add_argument('--journal', help='Append status of each session to this file')
+    parser.add_argument('--skip-existing', action='store_true',
+                        help='Only process files that change after the watcher starts')
+    parser.add_argument('--once', action='store_true',
+                        help='Exit once all settled sessions are processed')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    datadirs = [os.path.abspath(d) for d in args.datadirs]
+    if args.catalog:
+        pupil_catalog.crawl(args.catalog, datadirs)
+    watcher = Watcher(datadirs, tasks=args.task, timepoints=args.timepoint, jobs=args.jobs,
+                      settle=args.settle, catalog=args.catalog, journal=args.journal,
+                      skip_existing=args.skip_existing)
+    print('Watching {0} (Ctrl-C to stop)'.format(', '.join(datadirs)))
+    failed = watcher.run(interval=args.interval, once=args.once)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
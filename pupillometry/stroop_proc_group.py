@@ -9,6 +9,7 @@ Takes as input datafiles created by stroop_proc_subject.py. This includes:
     <session>-<subject>_SessionData.csv
     <session>-<subject>_PSTCdata.csv
     <session>-<subject>_BlinkPct.txt
+    <session>-<subject>_GLMinput.npz (optional, used for the group GLM)
     
 Calculates subject level measures of pupil dilation.
 Plots group level PTSC. Output can be used for statistical analysis.
@@ -24,15 +25,10 @@ from datetime import datetime
 from glob import glob
 import json
 import pupil_utils
-try:
-    # for Python2
-    import Tkinter as tkinter
-    import tkFileDialog as filedialog
-except ImportError:
-    # for Python3
-    import tkinter
-    from tkinter import filedialog
-    
+import pupil_stats
+import pupil_aggregate
+import pupil_glm
+from functools import partial
     
 def glob_files(datadir, suffix):
     globstr = os.path.join(datadir, '*'+suffix)
@@ -63,17 +59,29 @@ def get_blink_data(datadir):
     return blinkdf    
 
 
-def get_pstc_data(datadir):
+def read_pstc_file(sub_file, exclude=(), tmax=3.0):
+    """Reads one subject PSTC file for streaming group averages, keeping
+    timepoints up to tmax. Returns None if (Subject, Session) is in exclude."""
+    subdf = pd.read_csv(sub_file)
+    subdf.Subject = subdf.Subject.astype('str')
+    subdf['Session'] = str(int(pupil_utils.get_tpfolder(sub_file)))
+    if (subdf.Subject.iloc[0], subdf.Session.iloc[0]) in exclude:
+        return None
+    return subdf[subdf.Timepoint<=tmax]
+
+
+def get_pstc_accumulator(datadir, blink_df, n_jobs=1):
+    """Streams PSTCs of sessions with BlinkPct < .5 into an accumulator of 
+    the group mean, SD and SEM that also keeps each session's Incongruent - Congruent 
+    difference for the cluster test. Each file is read once and memory does 
+    not grow with the number of sessions beyond one difference timecourse 
+    per session."""
+    highblink = blink_df[~(blink_df.BlinkPct<.5)]
+    exclude = set(zip(highblink.Subject, highblink.Session))
     pstc_filelist = glob_files(datadir, suffix='_PSTCdata.csv')
-    pstc_list = []
-    for sub_file in pstc_filelist:
-        subdf = pd.read_csv(sub_file)
-        subdf['Session'] = pupil_utils.get_tpfolder(sub_file)
-        pstc_list.append(subdf)
-    pstcdf = pd.concat(pstc_list).reset_index(drop=True)
-    pstcdf.Session = pstcdf.Session.astype(int)
-    pstcdf.Subject = pstcdf.Subject.astype('str')
-    return pstcdf
+    acc = pupil_aggregate.accumulate_pstc(pstc_filelist, partial(read_pstc_file, exclude=exclude),
+                                          n_jobs=n_jobs, contrast=('Incongruent', 'Congruent'))
+    return acc
 
 
 def get_glm_data(datadir):
@@ -95,18 +103,47 @@ def unstack_conditions(dflong):
     return df
 
 
-def plot_group_pstc(pstcdf, outfile, trial_start=0.):
-    pstcdf = pstcdf[pstcdf.BlinkPct<.5]
-    pstcdf['Subject_Session'] =  pstcdf.Subject.astype('str') + "_" + pstcdf.Session.astype('str')
-    p = sns.lineplot(data=pstcdf, x="Timepoint",y="Dilation", hue="Condition")
-    kernel = pupil_utils.pupil_irf(pstcdf.Timepoint.unique(), s1=1000., tmax=1.30)
-    plt.plot(pstcdf.Timepoint.unique(), kernel, color='dimgrey', linestyle='--')
+def get_second_level(datadir, blink_df):
+    """Refits session GLMs from GLM input saved by stroop_proc_subject.py 
+    (see pupil_glm.py) and fits fixed and random effects group models of each 
+    contrast with Session as covariate. Sessions with 50% or more blinks 
+    are excluded. Returns session and group results, both None if there is no 
+    GLM input."""
+    glm_inputs = pupil_glm.load_inputs([datadir], 'stroop')
+    if not glm_inputs:
+        return None, None
+    sess_glm = pupil_glm.group_glm(glm_inputs, 'stroop')
+    sess_glm = pd.merge(sess_glm, blink_df, on=['Subject','Session'])
+    sess_glm = sess_glm[sess_glm.BlinkPct<.5].drop(columns='BlinkPct')
+    group_glm = pupil_stats.second_level(sess_glm, covariates=['Session'])
+    return sess_glm, group_glm
+
+
+def plot_group_pstc(summarydf, outfile, trial_start=0., clusters=None):
+    """Plot group mean PSTC of each condition with SEM band, from the summary
+    of the accumulator returned by get_pstc_accumulator. If a dataframe of 
+    clusters from pupil_stats.cluster_test_diff is given, clusters with p<.05 
+    are shaded."""
+    fig, ax = plt.subplots()
+    for color, (cond, conddf) in zip(sns.color_palette(), summarydf.groupby('Condition')):
+        ax.plot(conddf.Timepoint, conddf.Mean, color=color, label=cond)
+        ax.fill_between(conddf.Timepoint, conddf.Mean - conddf.SEM, conddf.Mean + conddf.SEM,
+                        color=color, alpha=.2, linewidth=0)
+    ax.set_xlabel('Timepoint')
+    ax.set_ylabel('Dilation')
+    ax.legend(title='Condition')
+    timepoints = summarydf.Timepoint.unique()
+    kernel = pupil_utils.pupil_irf(timepoints, s1=1000., tmax=1.30)
+    plt.plot(timepoints, kernel, color='dimgrey', linestyle='--')
     plt.axvline(trial_start, color='k', linestyle='--')
-    p.figure.savefig(outfile, dpi=300)  
-    plt.close()    
+    if clusters is not None:
+        for cluster in clusters[clusters.pval<.05].itertuples():
+            plt.axvspan(cluster.Start, cluster.Stop, color='grey', alpha=.2)
+    fig.savefig(outfile, dpi=300)
+    plt.close(fig)    
     
     
-def proc_group(datadir):
+def proc_group(datadir, n_perm=5000, n_jobs=1):
     sessdf = get_sess_data(datadir)
     sessdf_wide = unstack_conditions(sessdf)
     sessdf_wide = sessdf_wide.astype({"Subject": str, "Session": str})    
@@ -119,12 +156,27 @@ def proc_group(datadir):
     outfile = os.path.join(datadir, 'stroop_group_data_' + tstamp + '.csv')
     print('Writing processed data to {0}'.format(outfile))
     alldat.to_csv(outfile, index=False)
-    pstcdf = get_pstc_data(datadir)    
-    pstcdf = pstcdf.astype({"Subject": str, "Session": str})
-    pstcdf = pd.merge(pstcdf, blink_df, on=['Subject','Session'])
-    pstcdf = pstcdf[pstcdf.Timepoint<=3.0]
+    sess_glm, group_glm = get_second_level(datadir, blink_df)
+    if sess_glm is not None:
+        glm_outfile = os.path.join(datadir, 'stroop_group_GLM_' + tstamp + '.csv')
+        print('Writing session GLM results to {0}'.format(glm_outfile))
+        sess_glm.to_csv(glm_outfile, index=False)
+        level2_outfile = os.path.join(datadir, 'stroop_group_2ndlevel_' + tstamp + '.csv')
+        print('Writing group GLM results to {0}'.format(level2_outfile))
+        group_glm.to_csv(level2_outfile, index=False)
+    pstc_acc = get_pstc_accumulator(datadir, blink_df, n_jobs=n_jobs)
+    diff, timepoints = pstc_acc.contrast_diffs()
+    clusterdf = pupil_stats.cluster_test_diff(diff, timepoints, 'Incongruent-Congruent', 
+                                              n_perm=n_perm, n_jobs=n_jobs)
+    cluster_outfile = os.path.join(datadir, 'stroop_group_clusters_' + tstamp + '.csv')
+    print('Writing cluster permutation results to {0}'.format(cluster_outfile))
+    clusterdf.to_csv(cluster_outfile, index=False)
     pstc_outfile = os.path.join(datadir, 'stroop_group_pstc_' + tstamp + '.png')
-    plot_group_pstc(pstcdf, pstc_outfile, trial_start=0.)
+    pstc_summary = pstc_acc.summary()
+    summary_outfile = os.path.join(datadir, 'stroop_group_pstc_' + tstamp + '.csv')
+    print('Writing group PSTC to {0}'.format(summary_outfile))
+    pstc_summary.to_csv(summary_outfile, index=False)
+    plot_group_pstc(pstc_summary, pstc_outfile, trial_start=0., clusters=clusterdf)
 
 
 if __name__ == '__main__':
@@ -136,14 +188,13 @@ if __name__ == '__main__':
                   <session>-<subject>_PSTCdata.csv
                   <session>-<subject>_BlinkPct.json
                   <session>-<subject>_GLMresults.json
+                  <session>-<subject>_GLMinput.npz (optional, for group GLM)
               Calculates subject level measures of pupil dilation. Plots group 
               level PTSC. Output can be used for statistical analysis.""")
         print('')
         
-        root = tkinter.Tk()
-        root.withdraw()
         # Select folder containing all data to process
-        datadir = filedialog.askdirectory(title='Choose directory containing subject data')
+        datadir = pupil_utils.ask_directory('Choose directory containing subject data')
         proc_group(datadir)
 
     else:
@@ -27,7 +27,6 @@ import os
 import sys
 import numpy as np
 import pandas as pd
-import json
 import matplotlib.pyplot as plt
 import seaborn as sns
 import nitime.timeseries as ts
@@ -35,16 +34,11 @@ import nitime.analysis as nta
 import nitime.viz as viz
 from nistats.regression import ARModel, OLSModel
 import pupil_utils
+import pupil_tasks
+import pupil_dataset
+import pupil_epochs
+import pupil_eprime
 import re
-try:
-    # for Python2
-    import Tkinter as tkinter
-    import tkFileDialog as filedialog
-except ImportError:
-    # for Python3
-    import tkinter
-    from tkinter import filedialog
-    
     
 def get_sessdf(dfresamp, eprime):
     """Create separate dataframes:
@@ -54,22 +48,21 @@ def get_sessdf(dfresamp, eprime):
     dfresamp = dfresamp.loc[dfresamp['CurrentObject']=="Stimulus"]
     sessdf_cols = ['Subject','Session','TrialId', 'Timestamp']
     sessdf = dfresamp.reset_index().groupby(['TrialId'])[sessdf_cols].first()
-    assert (sessdf.shape[0] == eprime.shape[0]), "Number of trials in pupil data and eprime data do not match!"
-    eprimecols = ['TrialList.Sample','Condition'] + [i for i in eprime.columns if re.search(r'Stimulus.*RT$', i)]
-    eprimesub = eprime[eprimecols]
-    eprimesub.columns = ['TrialId','Condition','RT']
-    sessdf = sessdf.join(eprimesub.set_index('TrialId'))    
+    # E-Prime trials are matched to gaze trials on stimulus onset time
+    onsets = (sessdf['Timestamp'] - pd.Timestamp(0)).dt.total_seconds()
+    eprime_trials = pupil_eprime.align_trials(onsets, eprime)
+    eprimecols = ['Condition'] + [i for i in eprime.columns if re.search(r'Stimulus.*RT$', i)]
+    eprimesub = eprime_trials[eprimecols]
+    eprimesub.columns = ['Condition','RT']
+    sessdf = sessdf.join(eprimesub)    
     sessdf['PrevCondition'] = sessdf['Condition'].shift()
     newcols = ['DilationMean','DilationMax','DilationSD','ConstrictionMax']
     sessdf = sessdf.join(pd.DataFrame(index=sessdf.index, columns=newcols))
     return sessdf
     
 def get_eprime_fname(pupil_fname):
-    pupildir, pupilfile = os.path.split(pupil_fname)
-    edatdir = pupildir.replace('Gaze data', 'Edat')   
-    edatfile = os.path.splitext(pupilfile)[0] + '-edat.csv'
-    edat_fname = os.path.join(edatdir, edatfile)  
-    return edat_fname
+    """Path of the E-Prime export of a gaze file, as listed in pupil_tasks"""
+    return pupil_tasks.eprime_path('stroop', pupil_fname)
     
 def save_total_blink_pct(dfresamp, infile):
     """Calculate and save out percent of trials with blinks in session"""
@@ -79,9 +72,7 @@ def save_total_blink_pct(dfresamp, infile):
     blink_dict['BlinkPct'] = float(dfresamp.BlinksLR.mean())
     blink_dict['Subject'] = str(dfresamp.loc[dfresamp.index[0], 'Subject'])
     blink_dict['Session'] = int(dfresamp.loc[dfresamp.index[0], 'Session'])
-    blink_json = json.dumps(blink_dict)
-    with open(outfile, 'w') as f:
-        f.write(blink_json)
+    pupil_utils.write_json_atomic(blink_dict, outfile)
         
     
 def get_blink_pct(dfresamp, infile=None):
@@ -94,20 +85,6 @@ def get_blink_pct(dfresamp, infile=None):
     return trial_blinkpct
 
 
-def get_trial_dils(pupil_dils, onset, tpre, tpost, samp_rate):
-    """Given pupil dilations for entire session and an onset, returns a 
-    normalized timecourse for the trial. Calculates a baseline to subtract from
-    trial data."""
-    onset_idx = int(pupil_dils.index.get_loc(onset))
-    pre_idx = int(onset_idx - (tpre/(1/samp_rate)))
-    post_idx = int(onset_idx + (tpost/(1/samp_rate)) + 1)
-    baseline = pupil_dils.iloc[pre_idx:onset_idx].mean()
-#    baseline = pupil_dils[onset]
-    #trial_dils = pupil_dils[onset:post_event] - baseline
-    trial_dils = pupil_dils.iloc[pre_idx:post_idx] - baseline
-    return trial_dils
-
-
 def initiate_condition_df(tpre, tpost, samp_rate):
     """Initiate dataframe to hold trial data for target and condition trials. 
     Index will represent time relative to trial start with interval based on 
@@ -124,11 +101,20 @@ def initiate_condition_df(tpre, tpost, samp_rate):
     return condf, incondf, neutraldf
 
 
-def proc_all_trials(sessdf, pupil_dils, tpre=.5, tpost=2.5, samp_rate=30.):
-    """For each trial, calculates the pupil dilation timecourse and saves to 
-    appropriate dataframe depending on trial condition.
-    Saves summary metric of max dilation and standard deviation of dilation 
-    to session level dataframe."""
+def append_trials(conddf, epochs, trials, condition):
+    """Adds a column with the epoch of each trial in condition to conddf"""
+    is_cond = (trials.Condition==condition).values
+    trialdf = pd.DataFrame(epochs[is_cond].T, index=conddf.index, 
+                           columns=trials.TrialId.values[is_cond])
+    return pd.concat([conddf, trialdf], axis=1)
+
+
+def proc_all_trials(sessdf, pupil_dils, tpre=.5, tpost=2.5, samp_rate=30., windows=((0.5, 1.5),)):
+    """Calculates the pupil dilation timecourse of all trials at once and saves 
+    to appropriate dataframe depending on trial condition.
+    Saves summary metrics of each trial (max, mean and standard deviation of 
+    dilation, peak latency, AUC, mean dilation in each window) to session 
+    level dataframe. Trials with >33% blinks are skipped."""
     condf, incondf, neutraldf = initiate_condition_df(tpre, tpost, samp_rate)
     # Filter trials for subjects with RT data
     # Some subjects have RT==0 for almost all trials, skip these subjects
@@ -138,33 +124,17 @@ def proc_all_trials(sessdf, pupil_dils, tpre=.5, tpost=2.5, samp_rate=30.):
         sessdf = sessdf.loc[sessdf.RT>=250]
         # Filter out trials that are too long (more than 3 SDs above the mean)
         sessdf = sessdf.loc[sessdf.RT < sessdf.RT.mean() + (3*sessdf.RT.std())]
-    for trial_number in sessdf.TrialId.unique():
-        trial_series = sessdf.loc[sessdf.TrialId==trial_number]
-        if trial_series['BlinkPct'].iat[0]>0.33:
-            continue
-        onset = trial_series.Timestamp.iat[0]
-        trial_dils = get_trial_dils(pupil_dils, onset, tpre, tpost, samp_rate)
-        # Depending on sampling rate, trial_dils and condf may not be identical length
-        # If off by 1 sample, cut first sample (from tpre period) from trial_dils
-        if len(trial_dils)==len(condf)+1:
-            trial_dils = trial_dils[1:]
-        """
-        If trial_dils and conddf are different lengths, cut first sample of trial_dils
-        """
-        
-        sessdf.loc[sessdf.TrialId==trial_series.TrialId.iat[0],'DilationMax'] = trial_dils.max()
-        sessdf.loc[sessdf.TrialId==trial_series.TrialId.iat[0],'DilationMean'] = trial_dils.mean()
-        sessdf.loc[sessdf.TrialId==trial_series.TrialId.iat[0],'DilationSD'] = trial_dils.std()
-        sessdf.loc[sessdf.TrialId==trial_series.TrialId.iat[0],'ConstrictionMax'] = trial_dils.min()
-        if (trial_series.Condition=='C').all():
-            condf[trial_number] = np.nan
-            condf.loc[condf.index[:len(trial_dils)], trial_number] = trial_dils.values
-        elif (trial_series.Condition=='I').all():
-            incondf[trial_number] = np.nan
-            incondf.loc[incondf.index[:len(trial_dils)], trial_number] = trial_dils.values
-        elif (trial_series.Condition=='N').all():
-            neutraldf[trial_number] = np.nan
-            neutraldf.loc[neutraldf.index[:len(trial_dils)], trial_number] = trial_dils.values 
+    sessdf = sessdf.copy()
+    trials = sessdf[~(sessdf.BlinkPct>0.33)]
+    trials, onset_idx = pupil_epochs.match_onsets(pupil_dils.index, trials)
+    epochs, times = pupil_epochs.get_epochs(pupil_dils.values, onset_idx, tpre, tpost, samp_rate)
+    metrics = pupil_epochs.epoch_metrics(epochs, times, windows)
+    metrics.index = trials.index
+    for col in metrics.columns:
+        sessdf[col] = metrics[col]
+    condf = append_trials(condf, epochs, trials, 'C')
+    incondf = append_trials(incondf, epochs, trials, 'I')
+    neutraldf = append_trials(neutraldf, epochs, trials, 'N')
     return sessdf, condf, incondf, neutraldf
             
 
@@ -197,54 +167,80 @@ def plot_event(signal_filt, con_ts, incon_ts, neut_ts, kernel, infile, plot_kern
     if plot_kernel:
         ax.plot((all_era.eta.time*(10**-12)), kernel)
     ax.legend(['Congruent','Incongruent','Neutral'])
-    fig.savefig(outfile)
+    pupil_utils.savefig_atomic(fig, outfile)
     plt.close(fig)
 
     
-def ts_glm(pupilts, con_onsets, incon_onsets, neut_onsets, blinks, sampling_rate=30.):
+def glm_contrasts(beta, cov, dof, columns):
+    """Evaluates the stroop contrasts and F-tests declared in pupil_tasks for 
+    a fitted GLM. Columns names the design columns, or maps each condition to 
+    its weights over the design (FIR model)."""
+    spec = pupil_tasks.TASKS['stroop']
+    return pupil_utils.contrast_results(beta, cov, dof, columns, spec['contrasts'], 
+                                        spec['f_tests'])
+
+
+def ts_glm(pupilts, con_onsets, incon_onsets, neut_onsets, blinks, sampling_rate=30., 
+           upsample_rate=1000., model='canonical', fir_window=(0., 4.), irf_params=None):
     """
-    Currently runs the following contrasts:
-        Incongruent: [0,1,0,0,0]
-        Congruent:   [0,0,1,0,0]
-        Neutral:     [0,0,0,1,0]  
-        Incon-Neut:  [0,1,0,-1,0]
-        Con-Neut:    [0,0,1,-1,0]
-        Incon-Con:   [0,1,-1,0,0]
+    Onsets are exact times (sec) from the start of the session. 
+    If model is 'canonical', regressors are the pupil irf convolved with onsets.
+    They are built at upsample_rate and decimated to the signal, so onsets are 
+    not snapped to the resampled grid.
+    If model is 'fir', a finite impulse response model estimates a free-form 
+    response for each condition over fir_window. Contrasts use the mean 
+    response over the window, and FIR estimates are returned under 'FIR'.
+    Irf_params can be a dictionary overriding the default s1, n1, and tmax of 
+    the canonical pupil irf (e.g. output of fit_irf).
+    Contrasts are declared in pupil_tasks.TASKS (Incongruent, Congruent, 
+    Neutral, Incon-Neut, Con-Neut and Incon-Con) and returned with their t 
+    under the contrast name, and effect, SE and p as <name>_effect, <name>_se 
+    and <name>_p. F-tests are returned as <name> and <name>_p.
     """
     signal_filt = ts.TimeSeries(pupilts, sampling_rate=sampling_rate)
-    con_ts = get_event_ts(pupilts, con_onsets)    
-    incon_ts = get_event_ts(pupilts, incon_onsets)
-    neut_ts = get_event_ts(pupilts, neut_onsets)    
+    sample_times = pupil_utils.get_sample_times(pupilts)
+    if model == 'fir':
+        onsets = [pupil_utils.get_onset_samples(incon_onsets, sample_times, 'Incongruent'),
+                  pupil_utils.get_onset_samples(con_onsets, sample_times, 'Congruent'),
+                  pupil_utils.get_onset_samples(neut_onsets, sample_times, 'Neutral')]
+        fit, firdf, mean_c = pupil_utils.fir_glm(pupilts.values, onsets, blinks.values,
+                                                 ['Incongruent','Congruent','Neutral'], 
+                                                 sampling_rate, fir_window=fir_window)
+        resultdict = glm_contrasts(fit['beta'], fit['cov'], fit['dof'], mean_c)
+        resultdict['FIR'] = firdf
+        return resultdict
     kernel_end_sec = 3.
-    kernel_length = kernel_end_sec / (1/sampling_rate)
-    kernel_x = np.linspace(0, kernel_end_sec, int(kernel_length)) 
-    con_reg, con_td_reg = pupil_utils.regressor_tempderiv(con_ts, kernel_x, s1=1000., tmax=1.30)
-    incon_reg, incon_td_reg = pupil_utils.regressor_tempderiv(incon_ts, kernel_x, s1=1000., tmax=1.30)
-    neut_reg, neut_td_reg = pupil_utils.regressor_tempderiv(neut_ts, kernel_x, s1=1000., tmax=1.30)
-    #kernel = pupil_utils.pupil_irf(kernel_x, s1=1000., tmax=1.30)
+    irf = {'s1':1000., 'n1':10.1, 'tmax':1.30}
+    if irf_params:
+        irf.update((k, irf_params[k]) for k in irf if k in irf_params)
+    event_regs, outside = pupil_utils.event_design_precise([incon_onsets, con_onsets, neut_onsets], 
+                                                           sample_times, kernel_end_sec=kernel_end_sec, 
+                                                           upsample_rate=upsample_rate, **irf)
+    pupil_utils.print_outside_onsets(outside, ['Incongruent','Congruent','Neutral'])
+    #kernel, _ = pupil_utils.get_irf_kernels(sampling_rate, kernel_end_sec, s1=1000., tmax=1.30)
     #plot_event(signal_filt, con_ts, incon_ts, neut_ts, kernel, pupil_fname)
     intercept = np.ones_like(signal_filt.data)
-    X = np.array(np.vstack((intercept, incon_reg, con_reg, neut_reg, blinks.values)).T)
+    X = np.column_stack((intercept, event_regs, blinks.values))
     Y = np.atleast_2d(signal_filt).T
     model = ARModel(X, rho=1.).fit(Y)
-    tIncon = float(model.Tcontrast([0,1,0,0,0]).t)
-    tCon = float(model.Tcontrast([0,0,1,0,0]).t)
-    tNeut = float(model.Tcontrast([0,0,0,1,0]).t)
-    tIncon_Neut = float(model.Tcontrast([0,1,0,-1,0]).t)
-    tCon_Neut = float(model.Tcontrast([0,0,1,-1,0]).t)
-    tIncon_Con = float(model.Tcontrast([0,1,-1,0,0]).t)   
-    resultdict = {'Incon_t':tIncon, 'Con_t':tCon, 'Neut_t':tNeut,
-                  'InconNeut_t':tIncon_Neut, 'ConNeut_t':tCon_Neut, 
-                  'InconCon_t':tIncon_Con}
+    resultdict = glm_contrasts(model.theta, model.vcov(), model.df_resid, 
+                               ['Intercept','Incongruent','Congruent','Neutral','Blinks'])
     return resultdict
 
 
+def fit_irf(pupilts, con_onsets, incon_onsets, neut_onsets, blinks):
+    """Grid search for the pupil irf shape (n1, tmax) that best fits this 
+    subject's data. Onsets are exact times (sec) from the start of the session."""
+    irf_fit, _ = pupil_utils.fit_irf_grid(pupilts.values, [incon_onsets, con_onsets, neut_onsets],
+                                          pupil_utils.get_sample_times(pupilts), blinks.values,
+                                          kernel_end_sec=3., s1=1000.)
+    return irf_fit
+
+
 def save_glm_results(glm_results, infile):
     """Calculate and save out percent of trials with blinks in session"""
-    glm_json = json.dumps(glm_results)
     outfile = pupil_utils.get_proc_outfile(infile, '_GLMresults.json')
-    with open(outfile, 'w') as f:
-        f.write(glm_json)
+    pupil_utils.write_json_atomic(glm_results, outfile)
         
         
 def plot_pstc(allconddf, infile, trial_start=0.):
@@ -252,7 +248,7 @@ def plot_pstc(allconddf, infile, trial_start=0.):
     outfile = pupil_utils.get_proc_outfile(infile, '_PSTCplot.png')
     p = sns.lineplot(data=allconddf, x="Timepoint",y="Dilation", hue="Condition", legend="brief")
     plt.axvline(trial_start, color='k', linestyle='--')
-    p.figure.savefig(outfile)  
+    pupil_utils.savefig_atomic(p.figure, outfile)  
     plt.close()
     
 
@@ -260,68 +256,140 @@ def save_pstc(allconddf, infile):
     """Save out peristimulus timecourse plots"""
     outfile = pupil_utils.get_proc_outfile(infile, '_PSTCdata.csv')
     pstcdf = allconddf.groupby(['Subject','Condition','Timepoint']).mean().reset_index()
-    pstcdf.to_csv(outfile, index=False)
+    pupil_utils.to_csv_atomic(pstcdf, outfile, index=False)
     
 
-def proc_subject(filelist):
+def save_fir(firdf, infile):
+    """Save out FIR estimates of the response to each condition"""
+    outfile = pupil_utils.get_proc_outfile(infile, '_FIRdata.csv')
+    pupil_utils.to_csv_atomic(firdf, outfile, index=False)
+    
+
+def save_glm_input(glm_input, infile, subid, timepoint):
+    """Save out the cleaned signal, blinks, sample times and onsets of each
+    condition that the GLM is fit to, so it can be refit for the group with
+    pupil_glm.py without reprocessing raw data"""
+    outfile = pupil_utils.get_proc_outfile(infile, '_GLMinput.npz')
+    with pupil_utils.atomic_write(outfile, 'wb') as f:
+        np.savez_compressed(f, subject=str(subid), session=str(timepoint), **glm_input)
+
+
+QC_COLUMNS = ['Subject','Session','DiameterPupilLRResamp','DiameterPupilLRFilt','BlinksLR']
+
+
+def load_session(pupil_fname):
+    """Reads raw pupil data and eprime data of one session"""
+    if (os.path.splitext(pupil_fname)[-1] == ".gazedata") | (os.path.splitext(pupil_fname)[-1] == ".csv"):
+        df = pd.read_csv(pupil_fname, sep="\t")
+    elif os.path.splitext(pupil_fname)[-1] == ".xlsx":
+        df = pd.read_excel(pupil_fname, parse_dates=False)
+    else: 
+        raise IOError('Could not open {}'.format(pupil_fname))
+    eprime_fname = get_eprime_fname(pupil_fname)
+    eprime = pupil_eprime.read_eprime(eprime_fname)
+    return {'fname':pupil_fname, 'df':df, 'eprime':eprime, 'eprime_fname':eprime_fname}
+
+
+def process_session(session, glm_model='canonical', fit_subject_irf=False):
+    """Cleans pupil data of one session loaded by load_session, then 
+    calculates trial measures, peristimulus timecourses and GLM results. 
+    Nothing is written; returns dictionary of results for write_session."""
+    tpre = 0.250
+    tpost = 2.5
+    samp_rate = 30.
+    pupil_fname, df, eprime = session['fname'], session['df'], session['eprime']
+    subid = pupil_utils.get_subid(df['Subject'],pupil_fname)
+    timepoint = pupil_utils.get_timepoint(df['Session'], pupil_fname)
+    df = pupil_utils.deblink(df, inplace=True)
+    df.CurrentObject.replace('StimulusRecord','Stimulus',inplace=True)
+    dfresamp = pupil_utils.resamp_filt_lean(df, filt_type='band', string_cols=['TrialId','CurrentObject'])
+    edatsess = pupil_utils.get_timepoint(eprime['Session'], session['eprime_fname']) 
+    eprime = eprime.rename(columns={"Congruency":"Condition"})
+    sessdf = get_sessdf(dfresamp, eprime)
+    sessdf['BlinkPct'] = get_blink_pct(dfresamp)
+    dfresamp['zDiameterPupilLRFilt'] = pupil_utils.zscore(dfresamp['DiameterPupilLRFilt'])
+    sessdf, condf, incondf, neutraldf = proc_all_trials(sessdf, dfresamp['zDiameterPupilLRFilt'], 
+                                                  tpre, tpost, samp_rate)
+    # Trial, baseline and dilation of every sample for the per-sample dataset
+    samples = pupil_epochs.trial_samples(dfresamp['zDiameterPupilLRFilt'], sessdf, tpre, samp_rate)
+    onset_times = pupil_utils.get_onset_times(df, mask=df.CurrentObject=='Stimulus')
+    con_onsets = onset_times.reindex(sessdf.loc[sessdf.Condition=='C', 'TrialId'])
+    incon_onsets = onset_times.reindex(sessdf.loc[sessdf.Condition=='I', 'TrialId'])
+    neut_onsets = onset_times.reindex(sessdf.loc[sessdf.Condition=='N', 'TrialId'])
+    irf_params = None
+    if fit_subject_irf:
+        irf_params = fit_irf(dfresamp.zDiameterPupilLRFilt, con_onsets, incon_onsets, 
+                             neut_onsets, dfresamp.BlinksLR)
+    glm_results = ts_glm(dfresamp.zDiameterPupilLRFilt, con_onsets, incon_onsets, 
+                         neut_onsets, dfresamp.BlinksLR, model=glm_model, 
+                         irf_params=irf_params)
+    glm_input = {'signal':dfresamp.zDiameterPupilLRFilt.values.astype(np.float64), 
+                 'blinks':dfresamp.BlinksLR.values.astype(np.float64),
+                 'times':pupil_utils.get_sample_times(dfresamp),
+                 'conditions':np.array(['Incongruent','Congruent','Neutral']),
+                 'onsets_Incongruent':incon_onsets.values.astype(np.float64), 
+                 'onsets_Congruent':con_onsets.values.astype(np.float64),
+                 'onsets_Neutral':neut_onsets.values.astype(np.float64),
+                 'glm_model':np.array(glm_model)}
+    if irf_params:
+        glm_results['IRF_n1'] = irf_params['n1']
+        glm_results['IRF_tmax'] = irf_params['tmax']
+        # Refits with pupil_glm.py use the irf fit to this session
+        glm_input['irf_n1'] = np.float64(irf_params['n1'])
+        glm_input['irf_tmax'] = np.float64(irf_params['tmax'])
+    firdf = glm_results.pop('FIR', None)
+    if firdf is not None:
+        firdf['Subject'] = subid
+        firdf['Session'] = timepoint
+    # Set subject ID and session as (as type string)
+    glm_results['Subject'] = subid
+    glm_results['Session'] = timepoint
+    allconddf = pd.concat([reshape_df(condf), reshape_df(incondf), 
+                           reshape_df(neutraldf)]).reset_index(drop=True)
+    allconddf['Subject'] = subid
+    allconddf['Session'] = timepoint   
+    allconddf = allconddf[allconddf.Timepoint<3.0]
+    sessdf['Subject'] = subid
+    sessdf['Session'] = timepoint
+    return {'fname':pupil_fname, 'dfresamp':dfresamp[QC_COLUMNS].join(samples), 'sessdf':sessdf, 
+            'subid':subid, 'timepoint':timepoint, 'glm_results':glm_results, 
+            'firdf':firdf, 'glm_input':glm_input, 'allconddf':allconddf}
+
+
+def write_session(results, dataset=None):
+    """Saves all outputs of one session processed by process_session. If 
+    dataset is given, samples are also written to the per-sample dataset at 
+    that directory (see pupil_dataset.py)."""
+    pupil_fname = results['fname']
+    if dataset:
+        pupil_dataset.write_samples(results['dfresamp'], dataset, 'stroop', 
+                                    results['subid'], results['timepoint'])
+    pupil_utils.plot_qc(results['dfresamp'], pupil_fname)
+    save_total_blink_pct(results['dfresamp'], pupil_fname)
+    if results['firdf'] is not None:
+        save_fir(results['firdf'], pupil_fname)
+    save_glm_results(results['glm_results'], pupil_fname)
+    save_glm_input(results['glm_input'], pupil_fname, results['subid'], results['timepoint'])
+    plot_pstc(results['allconddf'], pupil_fname)
+    save_pstc(results['allconddf'], pupil_fname)
+    sessout = pupil_utils.get_proc_outfile(pupil_fname, '_SessionData.csv')    
+    pupil_utils.to_csv_atomic(results['sessdf'], sessout, index=False)
+
+
+def proc_subject(filelist, glm_model='canonical', fit_subject_irf=False, dataset=None):
     """Given an infile of raw pupil data, saves out:
         1. Session level data with dilation data summarized for each trial
         2. Dataframe of average peristumulus timecourse for each condition
         3. Plot of average peristumulus timecourse for each condition
-        4. Percent of samples with blinks """
-    tpre = 0.250
-    tpost = 2.5
-    samp_rate = 30.
+        4. Percent of samples with blinks 
+        5. GLM results (and FIR estimates if glm_model is 'fir')
+        6. GLM input (signal, blinks and onsets) for refitting with pupil_glm.py
+    If fit_subject_irf is True, the canonical GLM uses the pupil irf shape 
+    fitted to each subject and fitted parameters are saved with GLM results."""
     for pupil_fname in filelist:
         print('Processing {}'.format(pupil_fname))
-        if (os.path.splitext(pupil_fname)[-1] == ".gazedata") | (os.path.splitext(pupil_fname)[-1] == ".csv"):
-            df = pd.read_csv(pupil_fname, sep="\t")
-        elif os.path.splitext(pupil_fname)[-1] == ".xlsx":
-            df = pd.read_excel(pupil_fname, parse_dates=False)
-        else: 
-            raise IOError('Could not open {}'.format(pupil_fname))
-        subid = pupil_utils.get_subid(df['Subject'],pupil_fname)
-        timepoint = pupil_utils.get_timepoint(df['Session'], pupil_fname)
-        df = pupil_utils.deblink(df)
-        df.CurrentObject.replace('StimulusRecord','Stimulus',inplace=True)
-        dfresamp = pupil_utils.resamp_filt_data(df, filt_type='band', string_cols=['TrialId','CurrentObject'])
-        dfresamp = dfresamp.drop(columns='TrialId_x').rename(columns={'TrialId_y':'TrialId'})
-        eprime_fname = get_eprime_fname(pupil_fname)
-        eprime = pd.read_csv(eprime_fname, sep='\t', encoding='utf-16', skiprows=0)
-        if not np.array_equal(eprime.columns[:3], ['ExperimentName', 'Subject', 'Session']):
-            eprime = pd.read_csv(eprime_fname, sep='\t', encoding='utf-16', skiprows=1)
-        edatsess = pupil_utils.get_timepoint(eprime['Session'], eprime_fname) 
-        eprime = eprime.rename(columns={"Congruency":"Condition"})
-        pupil_utils.plot_qc(dfresamp, pupil_fname)
-        sessdf = get_sessdf(dfresamp, eprime)
-        sessdf['BlinkPct'] = get_blink_pct(dfresamp, pupil_fname)
-        dfresamp['zDiameterPupilLRFilt'] = pupil_utils.zscore(dfresamp['DiameterPupilLRFilt'])
-        sessdf, condf, incondf, neutraldf = proc_all_trials(sessdf, dfresamp['zDiameterPupilLRFilt'], 
-                                                      tpre, tpost, samp_rate)
-        condf_long = reshape_df(condf)
-        incondf_long = reshape_df(incondf)
-        neutraldf_long = reshape_df(neutraldf)
-        glm_results = ts_glm(dfresamp.zDiameterPupilLRFilt, 
-                             sessdf.loc[sessdf.Condition=='C', 'Timestamp'],
-                             sessdf.loc[sessdf.Condition=='I', 'Timestamp'],
-                             sessdf.loc[sessdf.Condition=='N', 'Timestamp'],
-                             dfresamp.BlinksLR)
-        # Set subject ID and session as (as type string)
-        glm_results['Subject'] = subid
-        glm_results['Session'] = timepoint
-        save_glm_results(glm_results, pupil_fname)
-        allconddf = condf_long.append(incondf_long).reset_index(drop=True)
-        allconddf = allconddf.append(neutraldf_long).reset_index(drop=True)
-        # Set subject ID and session as (as type string)
-        allconddf['Subject'] = subid
-        allconddf['Session'] = timepoint   
-        allconddf = allconddf[allconddf.Timepoint<3.0]
-        plot_pstc(allconddf, pupil_fname)
-        save_pstc(allconddf, pupil_fname)
-        sessdf['Subject'] = subid
-        sessdf['Session'] = timepoint
-        sessout = pupil_utils.get_proc_outfile(pupil_fname, '_SessionData.csv')    
-        sessdf.to_csv(sessout, index=False)
+        session = load_session(pupil_fname)
+        write_session(process_session(session, glm_model, fit_subject_irf), dataset)
 
     
 if __name__ == '__main__':
@@ -336,13 +404,9 @@ if __name__ == '__main__':
               Processes single subject data and outputs csv files for use in
               further group analysis.""")
         print('')
-        root = tkinter.Tk()
-        root.withdraw()
         # Select files to process
-        filelist = filedialog.askopenfilenames(parent=root,
-                                                    title='Choose Stroop pupil gazedata file to process',
-                                                    filetypes = (("xlsx files","*.xlsx"),("all files","*.*")))
-        filelist = list(filelist)
+        filelist = pupil_utils.ask_filenames('Choose Stroop pupil gazedata file to process',
+                                             filetypes=(("xlsx files","*.xlsx"),("all files","*.*")))
         # Run script
         proc_subject(filelist)
 
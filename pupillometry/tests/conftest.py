@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""The pupillometry scripts import each other as top level modules."""
+
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import pandas as pd
+import hvlt_recognition_proc_subject as hvlt
+
+
+def test_proc_all_trials_repeated_trialid_keeps_one_row_per_trial():
+    # Trial 1 resumes after trial 2, e.g. after an interruption
+    trialids = np.repeat([1, 2, 1, 3], 30)
+    n = len(trialids)
+    dfresamp = pd.DataFrame({'TrialId': trialids,
+                             'DiameterPupilLRFilt': np.linspace(3., 4., n),
+                             'BlinksLR': np.zeros(n)},
+                            index=pd.to_datetime(np.arange(1, n + 1) / 30., unit='s'))
+    trialsdf = hvlt.proc_all_trials(dfresamp)
+    assert len(trialsdf) == 4
+    assert sorted(trialsdf.TrialId) == [1, 1, 2, 3]
+    assert list(trialsdf.Condition) == ['old', 'old', 'new', 'old']
+    np.testing.assert_allclose(trialsdf.Duration, 29 / 30.)
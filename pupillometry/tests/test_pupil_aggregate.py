@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import os
+import numpy as np
+import pandas as pd
+import pupil_aggregate
+import pupil_stats
+import oddball_proc_group
+
+
+TIMEPOINTS = np.round(np.arange(-15, 76) / 30., 6)
+
+
+def subject_pstc(subject, seed, conditions=('Target', 'Standard'), timepoints=TIMEPOINTS):
+    rng = np.random.RandomState(seed)
+    return pd.concat([pd.DataFrame({'Subject': subject, 'Condition': cond, 'Timepoint': timepoints,
+                                    'Dilation': rng.normal(size=len(timepoints)) + i})
+                      for i, cond in enumerate(conditions)], ignore_index=True)
+
+
+def subjects(n=12):
+    pstcs = [subject_pstc(str(100 + i), i) for i in range(n)]
+    # Missing a condition or a timepoint, left out of the contrast only
+    pstcs.append(subject_pstc('200', 99, conditions=('Target',)))
+    pstcs.append(subject_pstc('201', 98, timepoints=TIMEPOINTS[:-1]))
+    return pstcs
+
+
+def test_summary_matches_concatenated_pstcs():
+    pstcs = subjects()
+    acc = pupil_aggregate.PSTCAccumulator()
+    for pstc in pstcs:
+        acc.update(pstc)
+    summary = acc.summary().set_index(['Condition', 'Timepoint'])
+    grouped = pd.concat(pstcs).groupby(['Condition', 'Timepoint']).Dilation
+    np.testing.assert_allclose(summary.Mean, grouped.mean().loc[summary.index])
+    np.testing.assert_allclose(summary.SD, grouped.std().loc[summary.index])
+    np.testing.assert_array_equal(summary.N, grouped.count().loc[summary.index])
+
+
+def test_merge_matches_single_pass():
+    pstcs = subjects()
+    single = pupil_aggregate.PSTCAccumulator(contrast=('Target', 'Standard'))
+    first = pupil_aggregate.PSTCAccumulator(contrast=('Target', 'Standard'))
+    second = pupil_aggregate.PSTCAccumulator(contrast=('Target', 'Standard'))
+    for i, pstc in enumerate(pstcs):
+        single.update(pstc)
+        (first if i % 2 else second).update(pstc)
+    merged = first.merge(second)
+    pd.testing.assert_frame_equal(merged.summary(), single.summary())
+    assert len(merged.diffs) == len(single.diffs)
+
+
+def test_contrast_diffs_match_pstc_array():
+    pstcs = subjects()
+    acc = pupil_aggregate.PSTCAccumulator(contrast=('Target', 'Standard'))
+    for pstc in pstcs:
+        acc.update(pstc)
+    diff, timepoints = acc.contrast_diffs()
+    data, ids, expected_times = pupil_stats.pstc_array(pd.concat(pstcs), ['Target', 'Standard'],
+                                                       id_cols=['Subject'])
+    np.testing.assert_allclose(timepoints, expected_times)
+    np.testing.assert_allclose(diff, data[:, 0, :] - data[:, 1, :])
+    clusters = pupil_stats.cluster_test_diff(diff, timepoints, 'Target-Standard', n_perm=200, seed=1)
+    expected = pupil_stats.cluster_test_pstc(pd.concat(pstcs), 'Target', 'Standard', 
+                                             id_cols=['Subject'], n_perm=200, seed=1)
+    pd.testing.assert_frame_equal(clusters, expected)
+    assert (clusters.N == 12).all()
+
+
+def test_oddball_pstc_accumulator_reads_each_file_once(tmp_path, monkeypatch):
+    datadir = tmp_path / 'Timepoint 1'
+    datadir.mkdir()
+    pstcs = subjects(4)[:4]
+    for pstc in pstcs:
+        fname = 'Oddball-Session1-{0}_PSTCdata.csv'.format(pstc.Subject.iloc[0])
+        pstc.to_csv(str(datadir / fname), index=False)
+    blink_df = pd.DataFrame({'Subject': ['100', '101', '102', '103'], 'Session': '1',
+                             'OddballSession': 'A', 'BlinkPct': [.1, .6, .1, .1]})
+    reads = []
+    read_csv = pd.read_csv
+    monkeypatch.setattr(pd, 'read_csv', lambda fname, *args, **kwargs: 
+                        reads.append(fname) or read_csv(fname, *args, **kwargs))
+    acc = oddball_proc_group.get_pstc_accumulator(str(datadir), blink_df)
+    assert len(reads) == 4 and len(set(reads)) == 4
+    diff, _ = acc.contrast_diffs()
+    # Session 101 has too many blinks
+    kept = [pstc for pstc in pstcs if pstc.Subject.iloc[0] != '101']
+    data, _, _ = pupil_stats.pstc_array(pd.concat(kept), ['Target', 'Standard'], id_cols=['Subject'])
+    np.testing.assert_allclose(np.sort(diff, axis=0), np.sort(data[:, 0] - data[:, 1], axis=0))
+    assert set(acc.summary().N) == {3}
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import pandas as pd
+import pupil_dataset
+
+
+def _clean_trials_frame():
+    # Shaped like the output of clean_trials: Trial is an index level and a column
+    times = pd.DatetimeIndex((np.arange(3) * 33333333).astype(np.int64))
+    trials = {}
+    for trial in ('3_1', '3_2'):
+        trials[trial] = pd.DataFrame({'Load': 3, 'Trial': trial, 'Condition': 'Record',
+                                      'DiameterPupilLRFilt': [3., 3.1, 3.2],
+                                      'BlinksLR': [0., 0., 1.], 'Baseline': 3.,
+                                      'Dilation': [0., .1, .2]}, index=times)
+    return pd.concat(trials, names=['Trial', 'Timestamp'])
+
+
+def test_write_samples_clean_trials(tmpdir, monkeypatch):
+    monkeypatch.setattr(pupil_dataset, 'HAVE_PYARROW', False)
+    outfile = pupil_dataset.write_samples(_clean_trials_frame(), str(tmpdir), 'digitspan',
+                                          '101', 1)
+    df = pupil_dataset.read_partition(outfile)
+    assert list(df.columns) == ['Trial', 'Load', 'Condition', 'Timestamp', 'Diameter',
+                                'BlinkPct', 'Baseline', 'Dilation']
+    assert list(df.Trial) == ['3_1'] * 3 + ['3_2'] * 3
+    np.testing.assert_allclose(df.Timestamp, np.tile([0., 1/30., 2/30.], 2), atol=1e-6)
+    means = pupil_dataset.condition_means(str(tmpdir), 'Load')
+    assert list(means.N) == [4]
+    np.testing.assert_allclose(means.Dilation, .05)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import pandas as pd
+import pupil_epochs
+
+
+def session_index(n_samples=300):
+    return pd.to_datetime(np.arange(1, n_samples + 1) / 30., unit='s')
+
+
+def test_get_epochs_baseline_and_padding():
+    signal = np.arange(100, dtype=np.float64)
+    epochs, times = pupil_epochs.get_epochs(signal, [10, 98], tpre=.1, tpost=.1, samp_rate=30.)
+    np.testing.assert_allclose(times, np.arange(-3, 4) / 30.)
+    # Baseline is the mean of the 3 samples before onset
+    np.testing.assert_allclose(epochs[0], [-1., 0., 1., 2., 3., 4., 5.])
+    assert np.isnan(epochs[1, -2:]).all()
+
+
+def test_match_onsets_drops_and_reports_missing(capsys):
+    index = session_index()
+    trials = pd.DataFrame({'TrialId': [2, 3, 4],
+                           'Timestamp': [index[30], index[60] + pd.Timedelta('5ms'), index[90]]})
+    matched, onset_idx = pupil_epochs.match_onsets(index, trials)
+    np.testing.assert_array_equal(onset_idx, [30, 90])
+    assert list(matched.TrialId) == [2, 4]
+    assert '1 trials have no sample at their onset and were skipped: [3]' in capsys.readouterr().out
+
+
+def test_match_onsets_all_found(capsys):
+    index = session_index()
+    trials = pd.DataFrame({'TrialId': [1, 2], 'Timestamp': index[[0, 15]]})
+    matched, onset_idx = pupil_epochs.match_onsets(index, trials)
+    assert len(matched) == 2
+    assert capsys.readouterr().out == ''
+
+
+def test_epoch_metrics_window_and_peak():
+    times = np.arange(-3, 31) / 30.
+    epoch = np.where(times >= 0, np.sin(np.pi * np.clip(times, 0, 1)), 0.)
+    metrics = pupil_epochs.epoch_metrics(epoch[np.newaxis], times, windows=[(.25, .75)])
+    assert metrics.loc[0, 'PeakLatency'] == times[np.argmax(epoch)]
+    assert 'DilationMean_250_750ms' in metrics.columns
+    np.testing.assert_allclose(metrics.loc[0, 'DilationMax'], 1.)
+
+
+def test_trial_samples_matches_epochs():
+    index = session_index(12)
+    signal = pd.Series(np.arange(12.), index=index)
+    # Listed out of order, trial 4 has no sample at its onset
+    trials = pd.DataFrame({'TrialId': [3, 2, 4], 'Condition': ['Target', 'Standard', 'Target'],
+                           'Timestamp': [index[8], index[4], index[10] + pd.Timedelta('5ms')]})
+    samples = pupil_epochs.trial_samples(signal, trials, tpre=.1, samp_rate=30.)
+    assert samples.TrialId.isnull().sum() == 4
+    assert list(samples.TrialId[4:]) == [2] * 4 + [3] * 4
+    assert list(samples.Condition[4:]) == ['Standard'] * 4 + ['Target'] * 4
+    epochs, times = pupil_epochs.get_epochs(signal.values, [4, 8], .1, .1, 30.)
+    np.testing.assert_allclose(samples.Dilation.values[[4, 5, 8, 9]], epochs[:, 3:5].ravel())
+    np.testing.assert_allclose(samples.Baseline[4:], [2.] * 4 + [6.] * 4)
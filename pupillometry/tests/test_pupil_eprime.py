@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import io
+import os
+import pandas as pd
+import pupil_eprime
+
+
+def write_export(fname, encoding='utf-16'):
+    lines = [u'C:\\Experiments\\Stroop-101-1.edat2',
+             u'\t'.join(['ExperimentName', 'Subject', 'Session', 'TrialList.Sample',
+                         'Congruency', 'Stimulus.OnsetTime', 'Stimulus.RT', 'Comment'])]
+    for trial in range(1, 6):
+        lines.append(u'\t'.join(['Stroop', '101', '1', str(trial), 'CIN'[trial % 3],
+                                 str(10000 + 2000 * trial), '650', u'caf\xe9']))
+    with io.open(fname, 'w', encoding=encoding, newline='') as f:
+        f.write(u'\r\n'.join(lines) + u'\r\n')
+
+
+def test_read_eprime_utf16_header_and_cache(tmpdir):
+    fname = str(tmpdir.mkdir('Raw Pupil Data').mkdir('101').join('Stroop-101-1.csv'))
+    write_export(fname)
+    encoding, skiprows, header = pupil_eprime.sniff_header(fname)
+    assert encoding == 'utf-16' and skiprows == 1
+    df = pupil_eprime.read_eprime(fname)
+    assert list(df.columns) == ['Subject', 'Session', 'TrialList.Sample', 'Congruency',
+                                'Stimulus.OnsetTime', 'Stimulus.RT']
+    assert len(df) == 5
+    cachefile = pupil_eprime.cache_path(fname)
+    assert cachefile == str(tmpdir.join('Processed Pupil Data', '101', 'Stroop-101-1.pkl'))
+    assert os.path.exists(cachefile)
+    pd.testing.assert_frame_equal(pupil_eprime.read_eprime(fname), df)
+
+
+def test_sniff_encoding():
+    assert pupil_eprime.sniff_encoding(u'Subject\tSession'.encode('utf-16-le')) == 'utf-16-le'
+    assert pupil_eprime.sniff_encoding(u'caf\xe9 Subject\tSession'.encode('utf-8')) == 'utf-8'
+    assert pupil_eprime.sniff_encoding(u'caf\xe9 Subject\tSession'.encode('cp1252')) == 'cp1252'
+
+
+def test_align_trials_skips_missing_trial(capsys):
+    eprime = pd.DataFrame({'TrialList.Sample': [1, 2, 3, 4],
+                           'Congruency': ['C', 'I', 'N', 'C'],
+                           'Stimulus.OnsetTime': [12000., 14000., 16000., 18000.]})
+    # Gaze recording is missing trial 2 and has its own clock and numbering
+    gaze_onsets = pd.Series([2.01, 6.0, 8.02], index=[11, 13, 14])
+    aligned = pupil_eprime.align_trials(gaze_onsets, eprime)
+    assert list(aligned['Congruency']) == ['C', 'N', 'C']
+    assert list(aligned.index) == [11, 13, 14]
+    assert 'Matched 3 of 3 gaze and 4 E-Prime trials' in capsys.readouterr().out
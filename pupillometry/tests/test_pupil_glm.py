@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import numpy as np
+from nistats.regression import ARModel
+import pupil_utils
+import pupil_glm
+from test_pupil_utils import simulated_session
+
+
+def oddball_input(**irf):
+    signal, onsets, sample_times, blinks = simulated_session()
+    glm_input = {'signal': signal, 'blinks': blinks, 'times': sample_times,
+                 'conditions': np.array(['Target', 'Standard']),
+                 'onsets_Target': onsets[0], 'onsets_Standard': onsets[1],
+                 'subject': np.array('101'), 'session': np.array('1'),
+                 'oddball_session': np.array('1')}
+    glm_input.update(('irf_' + k, np.float64(v)) for k, v in irf.items())
+    return glm_input
+
+
+def test_load_inputs_walks_directories(tmpdir):
+    glm_input = oddball_input()
+    np.savez(str(tmpdir.mkdir('101').mkdir('Timepoint 1').join('Oddball-101_GLMinput.npz')),
+             **glm_input)
+    glm_input['conditions'] = np.array(['Incongruent', 'Congruent', 'Neutral'])
+    np.savez(str(tmpdir.mkdir('102').join('Stroop-102_GLMinput.npz')), **glm_input)
+    inputs = pupil_glm.load_inputs([str(tmpdir)], 'oddball')
+    assert [i['fname'].endswith('Oddball-101_GLMinput.npz') for i in inputs] == [True]
+
+
+def test_group_glm_matches_subject_model():
+    glm_input = oddball_input()
+    glmdf = pupil_glm.group_glm([glm_input], 'oddball').set_index('Contrast')
+    X = pupil_glm.build_design(glm_input, 'oddball')
+    model = ARModel(X, rho=1.).fit(glm_input['signal'][:, np.newaxis])
+    contrast = model.Tcontrast([0, 1, -1, 0])
+    np.testing.assert_allclose(glmdf.loc['ContrastT', 'T'], np.ravel(contrast.t)[0], rtol=1e-8)
+    np.testing.assert_allclose(glmdf.loc['ContrastT', 'Beta'], np.ravel(contrast.effect)[0],
+                               rtol=1e-8)
+    assert glmdf.loc['ContrastT', 'DOF'] == model.df_resid
+
+
+def test_build_design_uses_session_irf():
+    glm_input = oddball_input(n1=9., tmax=1.1)
+    X = pupil_glm.build_design(glm_input, 'oddball')
+    onsets = [glm_input['onsets_Target'], glm_input['onsets_Standard']]
+    expected, _ = pupil_utils.event_design_precise(onsets, glm_input['times'], s1=50000.,
+                                                   n1=9., tmax=1.1)
+    np.testing.assert_allclose(X[:, 1:3], expected)
+
+
+def test_load_inputs_skips_fir_sessions(tmpdir, capsys):
+    np.savez(str(tmpdir.join('Oddball-101_GLMinput.npz')), glm_model=np.array('canonical'),
+             **oddball_input())
+    np.savez(str(tmpdir.join('Oddball-102_GLMinput.npz')), glm_model=np.array('fir'),
+             **oddball_input())
+    inputs = pupil_glm.load_inputs([str(tmpdir)], 'oddball')
+    assert [i['fname'].endswith('Oddball-101_GLMinput.npz') for i in inputs] == [True]
+    assert 'Oddball-102_GLMinput.npz' in capsys.readouterr().out
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import os
+import pytest
+import pupil_journal
+import pupil_utils
+
+
+def test_journal_last_status_and_attempts(tmpdir):
+    journal = str(tmpdir.join('cohort.jsonl'))
+    for fname in ('a.gazedata', 'b.gazedata'):
+        pupil_journal.record(journal, 'oddball', fname, 'pending')
+    pupil_journal.record(journal, 'oddball', 'a.gazedata', 'running', attempt=1)
+    pupil_journal.record(journal, 'oddball', 'a.gazedata', 'failed', attempt=1, error='x')
+    pupil_journal.record(journal, 'oddball', 'a.gazedata', 'running', attempt=2)
+    pupil_journal.record(journal, 'oddball', 'a.gazedata', 'done', attempt=2)
+    pupil_journal.record(journal, 'oddball', 'b.gazedata', 'running', attempt=1)
+    # Line cut off by a crash
+    with open(journal, 'a') as f:
+        f.write('{"task": "oddball", "file": "b.gaz')
+    entries = pupil_journal.read_journal(journal)
+    assert entries[('oddball', 'a.gazedata')]['attempts'] == 2
+    assert entries[('oddball', 'b.gazedata')]['status'] == 'running'
+    assert pupil_journal.completed(journal) == set([('oddball', 'a.gazedata')])
+    assert pupil_journal.summarize(journal) == {'done': 1, 'running': 1}
+
+
+def test_atomic_write_keeps_previous_file(tmpdir):
+    outfile = str(tmpdir.join('Oddball-101_SessionData.csv'))
+    with pupil_utils.atomic_write(outfile) as f:
+        f.write('first')
+    with pytest.raises(RuntimeError):
+        with pupil_utils.atomic_write(outfile) as f:
+            f.write('partial')
+            raise RuntimeError('crash while writing')
+    with open(outfile) as f:
+        assert f.read() == 'first'
+    assert os.listdir(str(tmpdir)) == ['Oddball-101_SessionData.csv']
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import pupalz
+import pupil_journal
+import pupil_pipeline
+
+
+def _process(item, data):
+    if item == 1:
+        # Cannot be pickled back from the worker
+        return lambda: data
+    return data * 2
+
+
+def test_run_pipeline_worker_error_releases_slot():
+    written = {}
+
+    def write(item, result):
+        written[item] = result
+
+    failed, stats = pupil_pipeline.run_pipeline(range(5), lambda item: item, _process, write,
+                                                n_workers=2, verbose=False)
+    assert [item for item, _ in failed] == [1]
+    assert written == {0: 0, 2: 4, 3: 6, 4: 8}
+    assert stats['process'].count == 5
+
+
+def test_run_pipelined_retries(monkeypatch, tmpdir):
+    calls = []
+
+    def process(item, data):
+        calls.append(item)
+        if calls.count(item) == 1 and item[1] == 'b':
+            raise ValueError('first attempt')
+        return data
+
+    monkeypatch.setattr(pupalz, '_load', lambda item: item)
+    monkeypatch.setattr(pupalz, '_process', process)
+    monkeypatch.setattr(pupalz, '_write', lambda item, results, dataset=None: None)
+    journal = str(tmpdir.join('journal.jsonl'))
+    sessions = [{'task': 'oddball', 'raw_path': 'a'}, {'task': 'oddball', 'raw_path': 'b'}]
+    failed = pupalz.run_pipelined(sessions, journal=journal, retries=1, backoff=0.)
+    assert failed == []
+    assert calls.count(('oddball', 'b')) == 2
+    entries = pupil_journal.read_journal(journal)
+    assert entries[('oddball', 'b')]['status'] == 'done'
+    assert entries[('oddball', 'b')]['attempt'] == 2
+    assert entries[('oddball', 'b')]['attempts'] == 2
+    assert entries[('oddball', 'a')]['attempts'] == 1
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import warnings
+import pandas as pd
+import pupil_redcap
+
+
+def _write_recall(datadir, subject, dilation):
+    dfrecall = pd.DataFrame({'Subject': subject, 'Session': 1,
+                             'Timestamp': [ts for ts, _ in pupil_redcap.FLUENCY_QUARTILES],
+                             'Baseline': 3., 'Diameter': 3.5, 'Dilation': dilation,
+                             'BlinkPct': .1})
+    fname = datadir.join('HVLT-Recall-{0}_ProcessedPupil_Quartiles.csv'.format(subject))
+    dfrecall.to_csv(str(fname), index=False)
+
+
+def test_update_export_adds_records(tmpdir):
+    datadir = tmpdir.mkdir('data')
+    outfile = str(tmpdir.join('redcap.csv'))
+    for subject in ('101', '102'):
+        _write_recall(datadir, subject, .5)
+    pupil_redcap.update_export(str(datadir), outfile, verbose=False)
+    # A column of the existing export that holds text
+    export = pd.read_csv(outfile, dtype={'subject': str})
+    export['maxtime_digitspan_3'] = 'pending'
+    export.to_csv(outfile, index=False)
+    for subject in ('103', '104', '105'):
+        _write_recall(datadir, subject, .25)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        changes = pupil_redcap.update_export(str(datadir), outfile, verbose=False)
+    assert list(changes.index.get_level_values('subject')) == ['103', '104', '105']
+    export = pd.read_csv(outfile, dtype={'subject': str}).set_index('subject')
+    assert list(export.index) == ['101', '102', '103', '104', '105']
+    assert list(export['dilation_hvlt_recall_1_15']) == [.5, .5, .25, .25, .25]
+    assert list(export['maxtime_digitspan_3'].iloc[:2]) == ['pending', 'pending']
+    assert export['maxtime_digitspan_3'].iloc[2:].isnull().all()
+
+
+def test_update_export_replaces_changed_file(tmpdir):
+    datadir = tmpdir.mkdir('data')
+    outfile = str(tmpdir.join('redcap.csv'))
+    _write_recall(datadir, '101', .5)
+    pupil_redcap.update_export(str(datadir), outfile, verbose=False)
+    _write_recall(datadir, '101', .75)
+    pupil_redcap.update_export(str(datadir), outfile, n_jobs=1, full=True, verbose=False)
+    export = pd.read_csv(outfile, dtype={'subject': str})
+    assert len(export) == 1
+    assert export['dilation_hvlt_recall_45_60'].iat[0] == .75
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import pupil_segments
+
+
+OBJECTS = ['Ready', 'Ready', 'Digit', 'Digit', 'Recall', 'Recall', 'Recall', None,
+           'Ready', 'Digit', 'Recall', 'Recall', 'Ready']
+
+
+def test_segment_sequence_rules():
+    rules = [('Ready', '^Ready$', None), ('Record', '^Digit$', '^Recall$')]
+    segments = pupil_segments.segment(OBJECTS, rules)
+    assert list(segments.Phase) == ['Ready', 'Record', 'Ready', 'Record', 'Ready']
+    assert list(segments.Trial) == [1, 1, 2, 2, 3]
+    assert list(segments.Start) == [0, 2, 8, 9, 12]
+    assert list(segments.Stop) == [2, 7, 9, 12, 13]
+
+
+def test_segment_blocks():
+    segments = pupil_segments.segment(OBJECTS, [('Recall', '^Recall$', None)], trials='block')
+    assert list(segments.Trial) == [1, 2]
+
+
+def test_segment_index():
+    idx = pupil_segments.segment_index([2, 9], [4, 12])
+    np.testing.assert_array_equal(idx, [2, 3, 9, 10, 11])
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import os
+import socket
+import pytest
+import pupil_server
+
+
+def _bound_socket(path, listen):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    if listen:
+        sock.listen(1)
+    return sock
+
+
+def test_remove_stale_socket(tmpdir):
+    path = str(tmpdir.join('pupil.sock'))
+    _bound_socket(path, listen=False).close()
+    assert os.path.exists(path)
+    pupil_server.remove_stale_socket(path)
+    assert not os.path.exists(path)
+    # Nothing to remove
+    pupil_server.remove_stale_socket(path)
+
+
+def test_remove_stale_socket_keeps_live_socket(tmpdir):
+    path = str(tmpdir.join('pupil.sock'))
+    sock = _bound_socket(path, listen=True)
+    try:
+        with pytest.raises(IOError):
+            pupil_server.remove_stale_socket(path)
+        assert os.path.exists(path)
+    finally:
+        sock.close()
+
+
+def test_remove_stale_socket_keeps_other_files(tmpdir):
+    path = tmpdir.join('data.csv')
+    path.write('Subject,Dilation\n')
+    with pytest.raises(IOError):
+        pupil_server.remove_stale_socket(str(path))
+    assert path.read() == 'Subject,Dilation\n'
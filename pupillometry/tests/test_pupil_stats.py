@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import pandas as pd
+import pupil_stats
+
+
+def test_cluster_permutation_test_finds_effect():
+    rng = np.random.RandomState(0)
+    timepoints = np.arange(60) / 30.
+    diff = rng.normal(size=(20, 60))
+    diff[:, 20:40] += 1.5
+    clusterdf, tobs = pupil_stats.cluster_permutation_test(diff, timepoints, n_perm=500,
+                                                           chunk_size=200, seed=1)
+    assert tobs.shape == (60,)
+    best = clusterdf.loc[clusterdf.Mass.idxmax()]
+    assert best.Direction == 'positive'
+    assert timepoints[19] <= best.Start <= timepoints[22]
+    assert timepoints[37] <= best.Stop <= timepoints[40]
+    assert best.pval < .01
+
+
+def test_cluster_permutation_test_seed_and_jobs():
+    rng = np.random.RandomState(2)
+    diff = rng.normal(size=(12, 30)) + np.sin(np.arange(30) / 5.)
+    timepoints = np.arange(30) / 30.
+    first, _ = pupil_stats.cluster_permutation_test(diff, timepoints, n_perm=300, chunk_size=100,
+                                                    seed=3)
+    second, _ = pupil_stats.cluster_permutation_test(diff, timepoints, n_perm=300, chunk_size=100,
+                                                     seed=3, n_jobs=2)
+    pd.testing.assert_frame_equal(first, second)
+
+
+def test_second_level_intercept_matches_weighted_mean():
+    rng = np.random.RandomState(0)
+    glmdf = pd.DataFrame({'Subject': ['101', '102', '103', '104', '105', '106'],
+                          'Session': '1', 'Contrast': 'Target - Standard',
+                          'Beta': rng.normal(1., .5, 6), 'SE': rng.uniform(.1, .4, 6)})
+    resultdf = pupil_stats.second_level(glmdf).set_index('Model')
+    w = 1. / glmdf.SE.values**2
+    fixed = np.sum(w * glmdf.Beta) / w.sum()
+    np.testing.assert_allclose(resultdf.loc['fixed', 'Estimate'], fixed)
+    np.testing.assert_allclose(resultdf.loc['fixed', 'SE'], 1. / np.sqrt(w.sum()))
+    # DerSimonian-Laird between-session variance
+    Q = np.sum(w * (glmdf.Beta - fixed)**2)
+    tau2 = max(0., (Q - 5) / (w.sum() - np.sum(w**2) / w.sum()))
+    np.testing.assert_allclose(resultdf.loc['random', 'Tau2'], tau2)
+    w_re = 1. / (glmdf.SE.values**2 + tau2)
+    np.testing.assert_allclose(resultdf.loc['random', 'Estimate'],
+                               np.sum(w_re * glmdf.Beta) / w_re.sum())
+    assert (resultdf.N == 6).all()
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+import pupil_utils
+
+
+SAMPLE_TIMES = np.arange(1, 301) / 30.
+
+
+def test_get_onset_samples_bins():
+    # Bins are closed on the right, so an onset on a sample belongs to it
+    onsets = np.array([SAMPLE_TIMES[0], SAMPLE_TIMES[10], SAMPLE_TIMES[10] + .01, SAMPLE_TIMES[-1]])
+    idx = pupil_utils.get_onset_samples(onsets, SAMPLE_TIMES)
+    np.testing.assert_array_equal(idx, [0, 10, 11, 299])
+
+
+def test_get_onset_samples_reports_outside(capsys):
+    onsets = np.array([-1., 2., np.nan, 10.5, 20.])
+    idx = pupil_utils.get_onset_samples(onsets, SAMPLE_TIMES, 'Target')
+    np.testing.assert_array_equal(idx, [59])
+    out = capsys.readouterr().out
+    assert '4 Target onsets fall outside the signal' in out
+    assert '-1.' in out and '20.' in out
+
+
+def test_get_onset_samples_inside_is_silent(capsys):
+    pupil_utils.get_onset_samples(SAMPLE_TIMES[:5], SAMPLE_TIMES, 'Target')
+    assert capsys.readouterr().out == ''
+
+
+def simulated_session(n1=9., tmax=1.1, s1=50000., kernel_end_sec=2.5, seed=0):
+    """Pupil signal of a session with two conditions, built with the precise 
+    design of ts_glm, plus AR(1) noise and a blink nuisance regressor."""
+    rng = np.random.RandomState(seed)
+    sample_times = np.arange(1, 3001) / 30.
+    onsets = [np.sort(rng.uniform(1., 95., 30)), np.sort(rng.uniform(1., 95., 30))]
+    event_regs, _ = pupil_utils.event_design_precise(onsets, sample_times, kernel_end_sec=kernel_end_sec,
+                                                   s1=s1, n1=n1, tmax=tmax)
+    blinks = (rng.uniform(size=len(sample_times)) < .05).astype(np.float64)
+    noise = np.zeros(len(sample_times))
+    for i in range(1, len(noise)):
+        noise[i] = .5 * noise[i-1] + rng.normal(scale=.02)
+    signal = 1. + event_regs.dot([.8, .3]) - .2 * blinks + noise
+    return signal, onsets, sample_times, blinks
+
+
+def test_precise_lag_matrix_matches_event_design_precise():
+    _, onsets, sample_times, _ = simulated_session()
+    kernel, _ = pupil_utils.get_irf_kernels(1000., 2.5)
+    X, _ = pupil_utils.event_design_precise(onsets, sample_times)
+    t0, _, starts, stops, counts = pupil_utils.upsample_bins(sample_times)
+    for i, cond_onsets in enumerate(onsets):
+        onset_idx, outside = pupil_utils.upsample_onsets(cond_onsets, sample_times, t0)
+        lagmat = pupil_utils.precise_lag_matrix(onset_idx, len(kernel), starts, stops, counts)
+        np.testing.assert_allclose(lagmat.dot(kernel), X[:, i], atol=1e-12)
+
+
+def test_fit_irf_grid_scores_glm_model():
+    signal, onsets, sample_times, blinks = simulated_session(n1=9., tmax=1.1)
+    irf_fit, rss = pupil_utils.fit_irf_grid(signal, onsets, sample_times, blinks)
+    assert rss.shape == (17, 27)
+    assert (irf_fit['n1'], irf_fit['tmax']) == (9., 1.1)
+    # Rss of a candidate is that of the AR model ts_glm fits with its kernel
+    event_regs, _ = pupil_utils.event_design_precise(onsets, sample_times, s1=50000., 
+                                                     n1=irf_fit['n1'], tmax=irf_fit['tmax'])
+    X = np.column_stack((np.ones(len(signal)), event_regs, blinks))
+    model = pupil_utils.ARModel(X, rho=1.).fit(signal[:, np.newaxis])
+    np.testing.assert_allclose(irf_fit['rss'], model.SSE[0], rtol=1e-8)
+
+
+def test_fit_irf_grid_custom_grid():
+    signal, onsets, sample_times, blinks = simulated_session(n1=9., tmax=1.1)
+    irf_fit, rss = pupil_utils.fit_irf_grid(signal, onsets, sample_times, blinks, 
+                                            n1_grid=[8., 9.], tmax_grid=[1., 1.1, 1.2], 
+                                            chunk_size=4)
+    assert rss.shape == (2, 3)
+    assert (irf_fit['n1'], irf_fit['tmax']) == (9., 1.1)
+    assert irf_fit['rss'] == rss.min()
+
+
+class _FakeDialog(object):
+    def askopenfilenames(self, **kwargs):
+        self.kwargs = kwargs
+        return ('a.gazedata', 'b.gazedata')
+
+
+def test_ask_filenames_returns_list(monkeypatch):
+    dialog = _FakeDialog()
+    monkeypatch.setattr(pupil_utils, '_filedialog', lambda: (dialog, 'root'))
+    files = pupil_utils.ask_filenames('Choose', filetypes=(('all files', '*.*'),))
+    assert files == ['a.gazedata', 'b.gazedata']
+    assert dialog.kwargs == {'parent': 'root', 'title': 'Choose',
+                             'filetypes': (('all files', '*.*'),)}
+
+
+def raw_session(n_samples=20000, n_extra=20, seed=0):
+    """Raw 60 Hz gaze data of a session with blinks, trial columns, a string
+    column and extra columns as exported by E-Prime."""
+    rng = np.random.RandomState(seed)
+    tettime = 1e6 + np.arange(n_samples) * 1000. / 60. + rng.uniform(0, 2, n_samples)
+    left = 3. + .2 * np.sin(np.arange(n_samples) / 200.) + rng.normal(scale=.01, size=n_samples)
+    right = left + .1
+    left[rng.uniform(size=n_samples) < .02] = -1.
+    right[rng.uniform(size=n_samples) < .02] = -1.
+    trial = np.arange(n_samples) // 180 + 1
+    df = pd.DataFrame({'Subject': 101, 'Session': 1, 'TrialId': trial, 'TETTime': tettime,
+                       'DiameterPupilLeftEye': left, 'DiameterPupilRightEye': right,
+                       'ValidityLeftEye': np.where(left < 0, 4, 0),
+                       'ValidityRightEye': np.where(right < 0, 4, 0),
+                       'CRESP': np.where(trial % 5 == 0, 1, 5), 'ACC': 1, 'RT': 500.,
+                       'CurrentObject': np.where(np.arange(n_samples) % 180 < 60,
+                                                 'Fixation', 'Stimulus')})
+    for i in range(n_extra):
+        df['Extra{0}'.format(i)] = rng.normal(size=n_samples)
+    return df
+
+
+def peak_memory(func, *args, **kwargs):
+    """Result of func and peak memory (bytes) allocated while it ran."""
+    tracemalloc = pytest.importorskip('tracemalloc')
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def test_resamp_filt_lean_matches_and_uses_less_memory():
+    def full(df):
+        return pupil_utils.resamp_filt_data(pupil_utils.deblink(df), string_cols=['CurrentObject'])
+
+    def lean(df):
+        df = pupil_utils.deblink(df, inplace=True)
+        return pupil_utils.resamp_filt_lean(df, string_cols=['CurrentObject'])
+
+    pupil_utils.warm_caches()
+    dffull, full_peak = peak_memory(full, raw_session())
+    dflean, lean_peak = peak_memory(lean, raw_session())
+    assert lean_peak < full_peak / 2
+    assert dflean.index.equals(dffull.index)
+    np.testing.assert_allclose(dflean.DiameterPupilLRResamp, dffull.DiameterPupilLRResamp,
+                               rtol=1e-9)
+    # Smoothing with running sums rounds differently from rolling().mean()
+    np.testing.assert_allclose(dflean.DiameterPupilLRFilt, dffull.DiameterPupilLRFilt,
+                               rtol=0, atol=1e-8)
+    np.testing.assert_array_equal(dflean.BlinksLR, dffull.BlinksLR)
+    assert list(dflean.CurrentObject) == list(dffull.CurrentObject)
+
+
+def test_event_design_matches_convolution():
+    onsets = [np.array([5, 40, 290]), np.array([0, 100, 101])]
+    X = pupil_utils.event_design(onsets, 300, tempderiv=True)
+    kernel, dkernel = pupil_utils.get_irf_kernels(30., 2.5)
+    for i, onset_idx in enumerate(onsets):
+        event_ts = np.zeros(300)
+        event_ts[onset_idx] = 1
+        np.testing.assert_allclose(X[:, i], pupil_utils.convolve_reg(event_ts, kernel), atol=1e-10)
+        td_reg = pupil_utils.orthogonalize(pupil_utils.convolve_reg(event_ts, dkernel), X[:, i])
+        np.testing.assert_allclose(X[:, 2 + i], td_reg, atol=1e-10)
+
+
+def test_get_irf_kernels_shared_and_read_only():
+    kernel, _ = pupil_utils.get_irf_kernels(30., 2.5)
+    assert pupil_utils.get_irf_kernels(30., 2.5)[0] is kernel
+    with pytest.raises(ValueError):
+        kernel[0] = 1.
+
+
+def test_compile_contrasts():
+    names, C = pupil_utils.compile_contrasts([('ContrastT', 'Target - Standard'),
+                                              ('Mean', '0.5*Target + .5 * Standard')],
+                                             ['Intercept', 'Target', 'Standard', 'Blinks'])
+    assert names == ['ContrastT', 'Mean']
+    np.testing.assert_array_equal(C, [[0, 1, -1, 0], [0, .5, .5, 0]])
+    with pytest.raises(ValueError):
+        pupil_utils.compile_contrasts([('Bad', 'Target - Neutral')], ['Target', 'Standard'])
+    with pytest.raises(ValueError):
+        pupil_utils.parse_contrast('Target Standard')
+
+
+def test_contrast_results_matches_t_contrasts():
+    beta = np.array([1., .8, .3])
+    cov = np.diag([.01, .04, .09])
+    results = pupil_utils.contrast_results(beta, cov, 100, ['Intercept', 'Target', 'Standard'],
+                                           [('ContrastT', 'Target - Standard')],
+                                           f_tests=[('Task_F', ['Target', 'Standard'])])
+    np.testing.assert_allclose(results['ContrastT'], .5 / np.sqrt(.13))
+    np.testing.assert_allclose(results['ContrastT_effect'], .5)
+    F, _ = pupil_utils.f_contrast(beta, cov, [[0, 1, 0], [0, 0, 1]], 100)
+    np.testing.assert_allclose(results['Task_F'], F)
+
+
+def test_fir_design_matches_lag_convolution():
+    onsets = [np.array([3, 10, 40]), np.array([0, 12, 47])]
+    n_samples, n_lags, first_lag = 50, 6, -1
+    X = pupil_utils.fir_design(onsets, n_samples, n_lags, first_lag=first_lag).toarray()
+    lag_matrix = np.eye(n_lags)
+    for i, onset_idx in enumerate(onsets):
+        sticks = np.zeros(n_samples)
+        sticks[onset_idx] = 1.
+        # Dense convolution with each lag, shifted by first_lag
+        for k in range(n_lags):
+            full = np.convolve(sticks, lag_matrix[k])
+            expected = full[-first_lag:n_samples - first_lag]
+            np.testing.assert_array_equal(X[:, i*n_lags + k], expected)
+
+
+def test_fit_ar1_fixed_rho_matches_direct_solution():
+    rng = np.random.RandomState(0)
+    X = np.column_stack([np.ones(200), rng.normal(size=(200, 2))])
+    y = X.dot([1., .5, -.3]) + rng.normal(size=200)
+    rho = .4
+    fit = pupil_utils.fit_ar1(sparse.csr_matrix(X), y, rho=rho)
+    W = np.eye(200) - rho * np.eye(200, k=-1)
+    W[0, 0] = np.sqrt(1. - rho**2)
+    Xw, yw = W.dot(X), W.dot(y)
+    beta = np.linalg.solve(Xw.T.dot(Xw), Xw.T.dot(yw))
+    resid = yw - Xw.dot(beta)
+    sigma2 = resid.dot(resid) / 197
+    np.testing.assert_allclose(fit['beta'], beta)
+    np.testing.assert_allclose(fit['cov'], sigma2 * np.linalg.inv(Xw.T.dot(Xw)))
+    assert fit['dof'] == 197 and fit['rho'] == rho
+
+
+def test_fir_glm_recovers_condition_responses():
+    rng = np.random.RandomState(0)
+    n_samples, n_lags = 3000, 31
+    timepoints = np.arange(n_lags) / 30.
+    responses = [np.sin(np.pi * timepoints), .5 * np.sin(np.pi * timepoints)]
+    onsets = [np.sort(rng.choice(np.arange(0, n_samples - n_lags, 3), 60, replace=False)) 
+              for _ in responses]
+    blinks = (rng.uniform(size=n_samples) < .05).astype(np.float64)
+    X = pupil_utils.fir_design(onsets, n_samples, n_lags).toarray()
+    noise = np.zeros(n_samples)
+    for i in range(1, n_samples):
+        noise[i] = .5 * noise[i-1] + rng.normal(scale=.05)
+    signal = 1. + X.dot(np.concatenate(responses)) - .2 * blinks + noise
+    fit, firdf, mean_contrasts = pupil_utils.fir_glm(signal, onsets, blinks, ['Target', 'Standard'],
+                                                     fir_window=(0., 1.))
+    assert 0.3 < fit['rho'] < 0.7
+    for cond, response in zip(['Target', 'Standard'], responses):
+        np.testing.assert_allclose(firdf.Beta[firdf.Condition == cond], response, atol=.05)
+        np.testing.assert_allclose(mean_contrasts[cond].dot(fit['beta']), response.mean(), atol=.02)
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import pandas as pd
+import oddball_proc_subject
+import stroop_proc_subject
+from test_pupil_utils import simulated_session
+
+
+def session_series(signal, sample_times, blinks):
+    index = pd.to_datetime(sample_times, unit='s')
+    return pd.Series(signal, index=index), pd.Series(blinks, index=index)
+
+
+def test_oddball_fit_irf_recovers_shape():
+    signal, onsets, sample_times, blinks = simulated_session(n1=9., tmax=1.1)
+    pupilts, blinkts = session_series(signal, sample_times, blinks)
+    trg_onsets = pd.Series(onsets[0])
+    irf_fit = oddball_proc_subject.fit_irf(pupilts, trg_onsets, pd.Series(onsets[1]), blinkts)
+    assert (irf_fit['n1'], irf_fit['tmax']) == (9., 1.1)
+
+
+def test_stroop_fit_irf_recovers_shape():
+    signal, onsets, sample_times, blinks = simulated_session(n1=11., tmax=1.3, kernel_end_sec=3.)
+    pupilts, blinkts = session_series(signal, sample_times, blinks)
+    # S1 only scales the irf, the betas absorb it
+    # Congruent and incongruent trials, no neutral trials in this session
+    irf_fit = stroop_proc_subject.fit_irf(pupilts, pd.Series(onsets[1]), pd.Series(onsets[0]),
+                                          pd.Series([np.nan]), blinkts)
+    assert (irf_fit['n1'], irf_fit['tmax']) == (11., 1.3)